@@ -0,0 +1,247 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Collector shared by the z/VM inspectors of one host.
+
+The collector owns the xCAT connection, the stats cache and the refresh
+scheduling of a ZVMInspector and serves its reads over a Unix domain socket.
+Agent processes load ZVMCollectorInspector, registered as the zvm_collector
+inspector, instead of querying xCAT themselves.
+
+Each message is a 4 bytes big endian length followed by a JSON document.
+A request is {"m": <meter>, "n": <instance name>}, a reply is either
+{"s": <stats>} or {"e": <error>, "msg": <message>}.
+"""
+
+import errno
+import os
+import struct
+import sys
+
+from ceilometer.compute.virt import inspector as virt_inspector
+from ceilometer.i18n import _
+from ceilometer.i18n import _LE
+from ceilometer.i18n import _LI
+from ceilometer.i18n import _LW
+import eventlet
+from eventlet.green import socket
+from eventlet import semaphore
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+from ceilometer_zvm.compute.virt.zvm import inspector as zvm_inspector
+from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
+
+
+collector_opts = [
+    cfg.StrOpt('collector_socket',
+               default='/var/run/ceilometer-zvm/collector.sock',
+               help="Unix domain socket the shared z/VM stats collector "
+                    "listens on"),
+    cfg.IntOpt('collector_timeout',
+               default=None,
+               help="Seconds the collector inspector waits for a reply of "
+                    "the collector. By default twice the refresh_budget, "
+                    "as a read may wait for the refresh of another one, "
+                    "or 600 without a refresh budget"),
+]
+
+
+CONF = cfg.CONF
+CONF.register_opts(collector_opts, group='zvm')
+LOG = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+ERR_NOT_FOUND = 'not_found'
+ERR_FAILED = 'failed'
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            if buf:
+                raise EOFError('Connection closed in the middle of a '
+                               'message')
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def send_message(sock, msg):
+    data = jsonutils.dumps(msg, separators=(',', ':')).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_message(sock):
+    """Returns the next message, None if the peer closed the connection."""
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    size = _HEADER.unpack(header)[0]
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError('Message of %d bytes exceeds the limit' % size)
+    data = _recv_exactly(sock, size)
+    if data is None:
+        raise EOFError('Connection closed in the middle of a message')
+    return jsonutils.loads(data.decode('utf-8'))
+
+
+class CollectorServer(object):
+    """Serve the stats of one ZVMInspector over a Unix domain socket."""
+
+    def __init__(self, inspector, path):
+        self.inspector = inspector
+        self.path = path
+        self.sock = None
+        # Reads are served from the cache, serialize them so that only one
+        # client triggers a refresh when the cache expires.
+        self._lock = semaphore.Semaphore()
+        self._pool = eventlet.GreenPool()
+
+    def listen(self):
+        try:
+            os.unlink(self.path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        self.sock = eventlet.listen(self.path, family=socket.AF_UNIX)
+        return self
+
+    def _handle_request(self, req):
+        try:
+            meter = req['m']
+            inst_name = req['n']
+        except (KeyError, TypeError):
+            return {'e': ERR_FAILED, 'msg': 'Malformed request'}
+        if meter not in zvmutils.CacheData._CTYPES:
+            return {'e': ERR_FAILED, 'msg': 'Unknown meter %s' % meter}
+        try:
+            with self._lock:
+                stat = self.inspector._get_inst_stat_by_name(meter,
+                                                            inst_name)
+        except virt_inspector.InstanceNotFoundException as err:
+            return {'e': ERR_NOT_FOUND, 'msg': str(err)}
+        except Exception as err:
+            LOG.exception(_LE("Failed to collect %(meter)s stats of "
+                              "%(inst)s"), {'meter': meter,
+                                            'inst': inst_name})
+            return {'e': ERR_FAILED, 'msg': str(err)}
+        return {'s': stat}
+
+    def _serve_client(self, conn):
+        try:
+            while True:
+                req = recv_message(conn)
+                if req is None:
+                    break
+                send_message(conn, self._handle_request(req))
+        except (EOFError, ValueError, socket.error) as err:
+            LOG.warning(_LW("Dropping collector client: %s"), err)
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        LOG.info(_LI("z/VM stats collector listening on %s"), self.path)
+        while True:
+            conn, _addr = self.sock.accept()
+            self._pool.spawn_n(self._serve_client, conn)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class ZVMCollectorInspector(zvm_inspector.ZVMInspector):
+    """z/VM inspector reading the stats from the shared collector."""
+
+    def __init__(self):
+        self.path = CONF.zvm.collector_socket
+        self._sock = None
+        self._lock = semaphore.Semaphore()
+
+    def _timeout(self):
+        if CONF.zvm.collector_timeout is not None:
+            return CONF.zvm.collector_timeout
+        if CONF.zvm.refresh_budget:
+            return 2 * CONF.zvm.refresh_budget
+        return 600
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout())
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _request(self, req):
+        with self._lock:
+            # A connection kept from a former read may have been closed by
+            # a restart of the collector, retry once on a new one.
+            for attempt in (1, 2):
+                reused = self._sock is not None
+                try:
+                    if self._sock is None:
+                        self._sock = self._connect()
+                    send_message(self._sock, req)
+                    resp = recv_message(self._sock)
+                    if resp is None:
+                        raise EOFError('Collector closed the connection')
+                    return resp
+                except (EOFError, ValueError, socket.error) as err:
+                    self._close()
+                    if (not reused or attempt == 2 or
+                            isinstance(err, socket.timeout)):
+                        msg = _("Failed to read from the z/VM stats "
+                                "collector at %(path)s: %(err)s") % {
+                                    'path': self.path, 'err': err}
+                        raise virt_inspector.InspectorException(msg)
+
+    def _get_inst_stat_by_name(self, meter, inst_name):
+        resp = self._request({'m': meter, 'n': inst_name})
+        if 's' in resp:
+            return resp['s']
+        if resp.get('e') == ERR_NOT_FOUND:
+            raise virt_inspector.InstanceNotFoundException(resp.get('msg'))
+        raise virt_inspector.InspectorException(resp.get('msg'))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    logging.register_options(CONF)
+    CONF(argv, project='ceilometer')
+    logging.setup(CONF, 'ceilometer-zvm-collector')
+
+    server = CollectorServer(zvm_inspector.ZVMInspector(),
+                             CONF.zvm.collector_socket).listen()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        zvmutils.stop_parse_pool()
@@ -0,0 +1,237 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Prometheus exporter of the z/VM guest stats.
+
+The exporter refreshes the stats of all guests with the ZVMInspector
+collection engine every exporter_interval seconds and serves the last
+snapshot in the Prometheus text format. Scrapes never reach xCAT.
+"""
+
+import sys
+import time
+
+from ceilometer.i18n import _LE
+from ceilometer.i18n import _LI
+import eventlet
+from eventlet import wsgi
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from ceilometer_zvm.compute.virt.zvm import inspector as zvm_inspector
+from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
+
+
+exporter_opts = [
+    cfg.StrOpt('exporter_host',
+               default='0.0.0.0',
+               help="Address the Prometheus exporter listens on"),
+    cfg.IntOpt('exporter_port',
+               default=9644,
+               help="Port the Prometheus exporter listens on"),
+    cfg.IntOpt('exporter_interval',
+               default=60,
+               help="Seconds between two refreshes of the exported stats"),
+]
+
+
+CONF = cfg.CONF
+CONF.register_opts(exporter_opts, group='zvm')
+LOG = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# (name, type, help, cpumem stat key)
+GUEST_METRICS = (
+    ('zvm_guest_cpus', 'gauge', 'Number of virtual cpus of the guest.',
+     'guest_cpus'),
+    ('zvm_guest_cpu_time_nanoseconds_total', 'counter',
+     'Cpu time used by the guest.', 'used_cpu_time'),
+    ('zvm_guest_memory_used_megabytes', 'gauge',
+     'Memory used by the guest.', 'used_memory'),
+)
+
+# (name, help, NIC stat key)
+NIC_METRICS = (
+    ('zvm_guest_nic_receive_bytes_total', 'Bytes received.', 'nic_rx'),
+    ('zvm_guest_nic_transmit_bytes_total', 'Bytes transmitted.', 'nic_tx'),
+    ('zvm_guest_nic_receive_packets_total', 'Frames received.',
+     'nic_fr_rx'),
+    ('zvm_guest_nic_transmit_packets_total', 'Frames transmitted.',
+     'nic_fr_tx'),
+    ('zvm_guest_nic_receive_drop_total', 'Received frames discarded.',
+     'nic_fr_rx_dsc'),
+    ('zvm_guest_nic_transmit_drop_total', 'Transmitted frames discarded.',
+     'nic_fr_tx_dsc'),
+    ('zvm_guest_nic_receive_errors_total', 'Receive errors.',
+     'nic_fr_rx_err'),
+    ('zvm_guest_nic_transmit_errors_total', 'Transmit errors.',
+     'nic_fr_tx_err'),
+)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (k, _escape(v))
+                    for k, v in sorted(labels.items()))
+
+
+class Exporter(object):
+    """Refresh the stats of all guests and render them for Prometheus."""
+
+    def __init__(self, inspector):
+        self.inspector = inspector
+        # Every guest is exported, whether or not the inspector is read.
+        self.inspector.demand = None
+        # Stats of the last refresh, replaced as a whole so that scrapes
+        # never see a refresh in progress.
+        self.snapshot = {'cpumem': [], 'vnics': [], 'disks': []}
+        self.last_refresh = 0
+        self.refresh_duration = 0
+        self.refresh_errors = 0
+
+    def refresh(self):
+        started = time.time()
+        try:
+            with zvmutils.request_priority(zvmutils.PRIORITY_BULK):
+                self.inspector._update_cache('cpumem')
+                if self.inspector.instances:
+                    self.inspector._update_cache('vnics',
+                                                 self.inspector.instances)
+                    self.inspector._update_cache('disks',
+                                                 self.inspector.instances)
+        except Exception:
+            self.refresh_errors += 1
+            LOG.exception(_LE("Failed to refresh the z/VM guest stats"))
+            return False
+        cache = self.inspector.cache
+        self.snapshot = dict(
+            (meter, sorted(cache.snapshot(meter).values(),
+                           key=lambda s: s['nodename']))
+            for meter in ('cpumem', 'vnics', 'disks'))
+        self.last_refresh = time.time()
+        self.refresh_duration = self.last_refresh - started
+        return True
+
+    def run(self, interval):
+        while True:
+            started = time.time()
+            self.refresh()
+            eventlet.sleep(max(0, interval - (time.time() - started)))
+
+    def render(self):
+        """Yields the exported metrics, one chunk per metric family."""
+        snapshot = self.snapshot
+        for name, mtype, mhelp, key in GUEST_METRICS:
+            lines = ['# HELP %s %s' % (name, mhelp),
+                     '# TYPE %s %s' % (name, mtype)]
+            for stat in snapshot['cpumem']:
+                lines.append('%s{%s} %s' % (
+                    name, _labels(instance=stat['nodename'],
+                                  userid=stat['userid']), stat[key]))
+            yield '\n'.join(lines) + '\n'
+
+        extra_fields = sorted(set(field for stat in snapshot['cpumem']
+                                  for field in stat.get('extra', ())))
+        for field in extra_fields:
+            name = 'zvm_guest_ipq_%s' % field
+            lines = ['# HELP %s Image_Performance_Query %s' % (
+                         name, zvmutils.IPQ_EXTRA_KWS[field].rstrip(':')),
+                     '# TYPE %s gauge' % name]
+            for stat in snapshot['cpumem']:
+                if field in stat.get('extra', ()):
+                    lines.append('%s{%s} %s' % (
+                        name, _labels(instance=stat['nodename'],
+                                      userid=stat['userid']),
+                        stat['extra'][field]))
+            yield '\n'.join(lines) + '\n'
+
+        for name, mhelp, key in NIC_METRICS:
+            lines = ['# HELP %s %s' % (name, mhelp),
+                     '# TYPE %s counter' % name]
+            for stat in snapshot['vnics']:
+                for nic in stat['nics']:
+                    lines.append('%s{%s} %s' % (
+                        name, _labels(instance=stat['nodename'],
+                                      userid=stat['userid'],
+                                      vswitch=nic['vswitch_name'],
+                                      vdev=nic['nic_vdev']), nic[key]))
+            yield '\n'.join(lines) + '\n'
+
+        lines = ['# HELP zvm_guest_disk_io_total I/Os started by the guest.',
+                 '# TYPE zvm_guest_disk_io_total counter']
+        for stat in snapshot['disks']:
+            lines.append('zvm_guest_disk_io_total{%s} %s' % (
+                _labels(instance=stat['nodename'], userid=stat['userid']),
+                stat['io_count']))
+        yield '\n'.join(lines) + '\n'
+
+        yield ('# HELP zvm_exporter_last_refresh_timestamp_seconds Time of '
+               'the last successful refresh.\n'
+               '# TYPE zvm_exporter_last_refresh_timestamp_seconds gauge\n'
+               'zvm_exporter_last_refresh_timestamp_seconds %s\n'
+               '# HELP zvm_exporter_refresh_duration_seconds Duration of the '
+               'last successful refresh.\n'
+               '# TYPE zvm_exporter_refresh_duration_seconds gauge\n'
+               'zvm_exporter_refresh_duration_seconds %s\n'
+               '# HELP zvm_exporter_refresh_errors_total Failed refreshes.\n'
+               '# TYPE zvm_exporter_refresh_errors_total counter\n'
+               'zvm_exporter_refresh_errors_total %d\n' % (
+                   self.last_refresh, self.refresh_duration,
+                   self.refresh_errors))
+
+        lines = ['# HELP zvm_collector_events_total Counters of the z/VM '
+                 'collection path.',
+                 '# TYPE zvm_collector_events_total counter']
+        for event, value in sorted(zvmutils.METRICS.snapshot().items()):
+            lines.append('zvm_collector_events_total{%s} %s' % (
+                _labels(event=event), value))
+        yield '\n'.join(lines) + '\n'
+
+        lines = ['# HELP zvm_collector_gauge Gauges of the z/VM collection '
+                 'path.',
+                 '# TYPE zvm_collector_gauge gauge']
+        for name, value in sorted(zvmutils.METRICS.gauge_snapshot().items()):
+            lines.append('zvm_collector_gauge{%s} %s' % (
+                _labels(name=name), value))
+        yield '\n'.join(lines) + '\n'
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '/') not in ('/', '/metrics'):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found\n']
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+        return (chunk.encode('utf-8') for chunk in self.render())
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    logging.register_options(CONF)
+    CONF(argv, project='ceilometer')
+    logging.setup(CONF, 'ceilometer-zvm-exporter')
+
+    exporter = Exporter(zvm_inspector.ZVMInspector())
+    eventlet.spawn_n(exporter.run, CONF.zvm.exporter_interval)
+
+    sock = eventlet.listen((CONF.zvm.exporter_host, CONF.zvm.exporter_port))
+    LOG.info(_LI("z/VM exporter listening on %(host)s:%(port)s"),
+             {'host': CONF.zvm.exporter_host, 'port': CONF.zvm.exporter_port})
+    try:
+        wsgi.server(sock, exporter, log=LOG)
+    finally:
+        zvmutils.stop_parse_pool()
@@ -12,13 +12,23 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import functools
+import time
 
 from ceilometer.compute.virt import inspector as virt_inspector
 from ceilometer.i18n import _
+from ceilometer.i18n import _LW
+import eventlet
 from oslo_config import cfg
+from oslo_log import log as logging
 from oslo_utils import timeutils
 from oslo_utils import units
 
+from ceilometer_zvm.compute.virt.zvm import profiling
+from ceilometer_zvm.compute.virt.zvm import scheduler
+from ceilometer_zvm.compute.virt.zvm import sharedcache
+from ceilometer_zvm.compute.virt.zvm import tracing
 from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
 
 
@@ -26,6 +36,19 @@ zvm_ops = [
     cfg.StrOpt('zvm_xcat_server',
                default=None,
                help='Host name or IP address of xCAT management_node'),
+    cfg.IntOpt('zvm_xcat_port',
+               default=443,
+               help='Port of the xCAT REST API on the management node'),
+    cfg.ListOpt('zvm_xcat_servers',
+                default=[],
+                help="Other xCAT endpoints, as host or host:port, serving "
+                     "the same z/VM host. Each request goes to the fastest "
+                     "healthy endpoint"),
+    cfg.BoolOpt('xcat_hedge_reads',
+                default=True,
+                help="Send a table or node read to a second xCAT endpoint "
+                     "as well when the first one fails or does not answer "
+                     "within its 95th percentile latency"),
     cfg.StrOpt('zvm_xcat_username',
                default=None,
                help='xCAT username'),
@@ -48,23 +71,237 @@ zvm_ops = [
     cfg.IntOpt('cache_update_interval',
                default=600,
                help="Cached data update interval"),
+    cfg.IntOpt('disk_update_interval',
+               default=600,
+               deprecated_for_removal=True,
+               help="Unused, the disk I/O data is refreshed with the other "
+                    "stats, every cache_update_interval"),
+    cfg.IntOpt('cache_max_entries',
+               default=20000,
+               help="Maximum number of guests cached per meter type, the "
+                    "least recently read ones are evicted first. 0 means "
+                    "no limit"),
+    cfg.IntOpt('cache_entry_ttl',
+               default=None,
+               help="Seconds a cached entry is served. By default an entry "
+                    "is served for two refresh cycles, or the tiered "
+                    "refresh max age plus one cycles with tiered_refresh, "
+                    "however long the cycles take"),
+    cfg.IntOpt('refresh_budget',
+               default=0,
+               help="Seconds a refresh of the cached data may take, 0 means "
+                    "no limit. When the budget is at risk the vswitch query "
+                    "is skipped first, then the cached inventory is reused, "
+                    "and the stats of the former refresh are served when "
+                    "it runs out"),
+    cfg.BoolOpt('adaptive_refresh',
+                default=False,
+                help="Learn the polling cycle of the agent and refresh the "
+                     "cached data once at the start of each cycle. "
+                     "cache_update_interval is used until the cycle is "
+                     "known"),
+    cfg.IntOpt('min_cache_update_interval',
+               default=30,
+               help="Minimum number of seconds between two refreshes of "
+                    "the cached data with adaptive_refresh"),
+    cfg.BoolOpt('tiered_refresh',
+                default=False,
+                help="Refresh the cpu and memory stats of busy guests every "
+                     "cycle and the ones of quiet guests in rotating "
+                     "subsets"),
+    cfg.IntOpt('tiered_refresh_max_age',
+               default=4,
+               help="Number of refresh cycles after which the stats of a "
+                    "quiet guest are refreshed at the latest"),
+    cfg.FloatOpt('tiered_refresh_cpu_threshold',
+                 default=5.0,
+                 help="Cpu usage, in percent of one cpu, from which a guest "
+                      "is refreshed every cycle"),
+    cfg.IntOpt('tiered_refresh_nic_threshold',
+               default=10 * 1024,
+               help="NIC traffic, in bytes per second, from which a guest "
+                    "is refreshed every cycle"),
+    cfg.IntOpt('demand_window',
+               default=0,
+               help="Seconds during which a meter, or a guest, stays "
+                    "collected after its last read. A refresh also collects "
+                    "the other meters in demand, and only the guests in "
+                    "demand. Must be at least the polling interval, or the "
+                    "guests drop out of demand between two polls. 0 "
+                    "collects every guest of the meter read"),
     cfg.StrOpt('zvm_xcat_ca_file',
                default=None,
                help="CA file for https connection to xcat"),
+    cfg.IntOpt('userid_cache_ttl',
+               default=600,
+               help="Seconds a resolved node to z/VM userid mapping is "
+                    "reused before it is looked up again"),
+    cfg.ListOpt('zvm_vswitches',
+                default=[],
+                help="Vswitches that NIC stats are collected from. When "
+                     "empty, the vswitches the managed guests are attached "
+                     "to are learned from a query of all vswitches"),
+    cfg.IntOpt('vswitch_query_concurrency',
+               default=4,
+               help="Number of vswitches queried in parallel"),
+    cfg.ListOpt('ipq_extra_fields',
+                default=['max_memory'],
+                help="Fields of the Image_Performance_Query output kept in "
+                     "addition to the cpu and memory usage, among "
+                     "%s" % ', '.join(sorted(zvmutils.IPQ_EXTRA_KWS))),
+    cfg.BoolOpt('zhcp_helper',
+                default=False,
+                help="Deploy a helper to the zHCP that runs the stats "
+                     "queries locally and returns only the fields used by "
+                     "the inspector"),
+    cfg.StrOpt('zhcp_helper_dir',
+               default='/var/opt/ceilometer-zvm',
+               help="Directory on the zHCP the helper is deployed to"),
+    cfg.StrOpt('zhcp_helper_python',
+               default='python',
+               help="Python interpreter that runs the helper on the zHCP"),
+    cfg.BoolOpt('xdsh_async',
+                default=False,
+                help="Run the long smcli queries on the zHCP in the "
+                     "background and poll for their output with short xdsh "
+                     "calls, instead of holding an xCAT request open until "
+                     "they end"),
+    cfg.StrOpt('xdsh_spool_dir',
+               default='/var/opt/ceilometer-zvm/jobs',
+               help="Directory on the zHCP the background queries write "
+                    "their output to"),
+    cfg.FloatOpt('xdsh_poll_interval',
+                 default=1.0,
+                 help="Seconds between two polls of a background query"),
+    cfg.IntOpt('xdsh_job_timeout',
+               default=600,
+               help="Seconds after which a background query is killed"),
+    cfg.IntOpt('parse_workers',
+               default=0,
+               help="Number of worker processes that parse large smcli "
+                    "outputs, 0 parses them in the agent process"),
+    cfg.IntOpt('parse_offload_threshold',
+               default=1024 * 1024,
+               help="Size in characters from which an smcli output is "
+                    "parsed in a worker process"),
+    cfg.FloatOpt('xcat_xdsh_rate',
+                 default=0,
+                 help="Maximum number of xdsh calls per second made to the "
+                      "xCAT MN, 0 means no limit"),
+    cfg.IntOpt('xcat_xdsh_burst',
+               default=4,
+               help="Number of xdsh calls that can be made at once after "
+                    "an idle time when xcat_xdsh_rate is set"),
+    cfg.IntOpt('xcat_xdsh_concurrency',
+               default=4,
+               help="Maximum number of xdsh calls in progress at a time, "
+                    "0 means no limit"),
+    cfg.FloatOpt('xcat_read_rate',
+                 default=0,
+                 help="Maximum number of table and node reads per second "
+                      "made to the xCAT MN, 0 means no limit"),
+    cfg.IntOpt('xcat_read_burst',
+               default=10,
+               help="Number of table and node reads that can be made at "
+                    "once after an idle time when xcat_read_rate is set"),
+    cfg.IntOpt('xcat_read_concurrency',
+               default=8,
+               help="Maximum number of table and node reads in progress at "
+                    "a time, 0 means no limit"),
+    cfg.BoolOpt('xcat_compression',
+                default=True,
+                help="Ask xCAT for gzip or deflate compressed responses. "
+                     "Responses the server does not compress are read "
+                     "as is"),
+    cfg.IntOpt('xcat_log_payload_limit',
+               default=1024,
+               help="Maximum number of characters of an xCAT request or "
+                    "response body written to the debug log, 0 means no "
+                    "limit"),
+    cfg.StrOpt('xcat_capture_file',
+               default=None,
+               help="File that full xCAT requests and responses are "
+                    "written to, independent of the log level"),
+    cfg.IntOpt('xcat_capture_max_bytes',
+               default=10 * 1024 * 1024,
+               help="Size in bytes at which the xCAT capture file is "
+                    "rotated"),
+    cfg.IntOpt('xcat_capture_backup_count',
+               default=5,
+               help="Number of rotated xCAT capture files kept"),
 ]
 
 
 CONF = cfg.CONF
 CONF.register_opts(zvm_ops, group='zvm')
+LOG = logging.getLogger(__name__)
+
+
+MemoryAllocatedStats = collections.namedtuple('MemoryAllocatedStats',
+                                              ['allocated'])
 
 
 class ZVMInspector(virt_inspector.Inspector):
 
+    # Refresh cycles a vswitch whose query fails keeps its former stats.
+    VSWITCH_STALE_CYCLES = 3
+    # Refresh cycles after which the vswitches in use are learned again.
+    VSWITCH_RELEARN_CYCLES = 30
+
     def __init__(self):
-        self.cache = zvmutils.CacheData()
+        ttl = CONF.zvm.cache_entry_ttl
+        max_cycles = 0
+        if ttl is None:
+            # Refreshes are driven by the reads, entries age in cycles.
+            ttl = 0
+            max_cycles = 2
+            if CONF.zvm.tiered_refresh:
+                max_cycles = CONF.zvm.tiered_refresh_max_age + 1
+        self.cache = zvmutils.CacheData(CONF.zvm.cache_max_entries, ttl,
+                                        max_cycles)
+        self.shared = sharedcache.get_shared_cache()
         self.cache_expiration = timeutils.utcnow_ts()
+        # Seconds taken by the last run of each refresh phase.
+        self.phase_durations = {}
+        self.scheduler = scheduler.RefreshScheduler(
+                            CONF.zvm.cache_update_interval,
+                            adaptive=CONF.zvm.adaptive_refresh,
+                            min_interval=CONF.zvm.min_cache_update_interval)
+        self.tiers = None
+        if CONF.zvm.tiered_refresh:
+            self.tiers = scheduler.TieredSelector(
+                                CONF.zvm.tiered_refresh_max_age,
+                                CONF.zvm.tiered_refresh_cpu_threshold,
+                                CONF.zvm.tiered_refresh_nic_threshold)
+        self.demand = None
+        if CONF.zvm.demand_window:
+            if CONF.zvm.demand_window < CONF.zvm.cache_update_interval:
+                LOG.warning(_LW("demand_window is shorter than "
+                                "cache_update_interval, guests drop out of "
+                                "demand between two refreshes"))
+            self.demand = scheduler.DemandTracker(CONF.zvm.demand_window)
+        # Meters whose cache misses were refreshed in bulk this cycle.
+        self.missed = set()
+        # Last I/O count of each guest and when it was read, to tell the
+        # I/O rate at the next refresh.
+        self.io_counts = {}
 
         self.instances = {}
+        self.userids = zvmutils.UseridCache(CONF.zvm.userid_cache_ttl)
+        # Last stats of each vswitch, the failed queries in a row of each
+        # vswitch, and the set of vswitches that the managed guests are
+        # attached to, None until learned at the vnics cycle learned_at.
+        self.vswitches = {}
+        self.vswitch_failures = {}
+        self.metered_vswitches = None
+        self.vswitches_learned_at = 0
+        # Path of the deployed zHCP helper, None until deployed.
+        self.zhcp_helper_path = None
+        unknown = set(CONF.zvm.ipq_extra_fields) - set(zvmutils.IPQ_EXTRA_KWS)
+        if unknown:
+            LOG.warning(_LW("Ignoring unknown ipq_extra_fields: %s"),
+                        ', '.join(sorted(unknown)))
+        profiling.PROFILER.install_signal_handler()
         self.zhcp_info = {
             'nodename': CONF.zvm.xcat_zhcp_nodename,
             'hostname': zvmutils.get_node_hostname(
@@ -81,67 +318,448 @@ class ZVMInspector(virt_inspector.Inspector):
                 # Not performance data returned for this virtual machine
                 continue
 
-            with zvmutils.expect_invalid_xcat_resp_data():
+            try:
                 guest_cpus = int(inst_pis[userid]['guest_cpus'])
                 used_cpu_time = inst_pis[userid]['used_cpu_time']
-                used_cpu_time = int(used_cpu_time.partition(' ')[0]) * units.k
+                used_cpu_time = int(used_cpu_time.partition(' ')[0])
                 used_memory = inst_pis[userid]['used_memory']
-                used_memory = int(used_memory.partition(' ')[0]) / units.Ki
+                used_memory = int(used_memory.partition(' ')[0])
+            except zvmutils.INVALID_RESP_DATA_ERRORS as err:
+                zvmutils.skip_invalid_record('cpumem', userid, err)
+                continue
+            extra = zvmutils.parse_extra_fields(
+                userid, ((k, inst_pis[userid][k])
+                         for k in CONF.zvm.ipq_extra_fields
+                         if k in inst_pis[userid]))
 
-            inst_stat = {'nodename': inst_name,
-                         'userid': userid,
-                         'guest_cpus': guest_cpus,
-                         'used_cpu_time': used_cpu_time,
-                         'used_memory': used_memory}
+            self._set_cpu_mem_stat(inst_name, userid, guest_cpus,
+                                   used_cpu_time, used_memory, extra)
 
-            self.cache.set('cpumem', inst_stat)
+    def _set_cpu_mem_stat(self, inst_name, userid, guest_cpus, used_cpu_time,
+                          used_memory, extra=None):
+        """Cache cpu and memory stats, cpu time in uS and memory in KB.
 
-    def _update_inst_nic_stat(self, instances):
-        vsw_dict = zvmutils.virutal_network_vswitch_query_iuo_stats(
+        extra holds the ipq_extra_fields as integers in the units of the
+        Image_Performance_Query output.
+        """
+        inst_stat = {'nodename': inst_name,
+                     'userid': userid,
+                     'guest_cpus': guest_cpus,
+                     'used_cpu_time': used_cpu_time * units.k,
+                     'used_memory': used_memory // units.Ki}
+        if extra:
+            inst_stat['extra'] = extra
+
+        self.cache.set('cpumem', inst_stat)
+        if self.tiers is not None:
+            self.tiers.record_cpu(userid.upper(), used_cpu_time)
+
+    def _record_nic_activity(self, userid, nics):
+        if self.tiers is not None:
+            self.tiers.record_nic(userid.upper(),
+                                  sum(nic['nic_rx'] + nic['nic_tx']
+                                      for nic in nics))
+
+    def _query_vswitch(self, vsw_name):
+        try:
+            vsw_dict = zvmutils.virutal_network_vswitch_query_iuo_stats(
+                                        self.zhcp_info['nodename'], vsw_name)
+        except zvmutils.ZVMException as err:
+            LOG.warning(_LW("Failed to query vswitch %(vsw)s, keep its "
+                            "cached stats: %(err)s"),
+                        {'vsw': vsw_name, 'err': err})
+            return None
+        for vsw in vsw_dict['vswitches']:
+            if vsw['vswitch_name'].upper() == vsw_name.upper():
+                return vsw
+        return None
+
+    def _vswitches_to_query(self):
+        """Returns the vswitches to query, None to query all of them.
+
+        An empty list means that no managed guest is attached to a vswitch,
+        until the vswitches are learned again.
+        """
+        if CONF.zvm.zvm_vswitches:
+            return CONF.zvm.zvm_vswitches
+        if (self.metered_vswitches is not None and
+                self.cache.cycles['vnics'] - self.vswitches_learned_at >=
+                self.VSWITCH_RELEARN_CYCLES):
+            # Guests may have been moved to other vswitches.
+            self.metered_vswitches = None
+        return self.metered_vswitches
+
+    def _learn_vswitches(self, vsw_names):
+        self.metered_vswitches = vsw_names
+        self.vswitches_learned_at = self.cache.cycles['vnics']
+
+    def _query_vswitches(self):
+        vsw_names = self._vswitches_to_query()
+        if vsw_names is None:
+            vsw_dict = zvmutils.virutal_network_vswitch_query_iuo_stats(
                                                     self.zhcp_info['nodename'])
-        with zvmutils.expect_invalid_xcat_resp_data():
-            for vsw in vsw_dict['vswitches']:
-                for nic in vsw['nics']:
-                    for inst_name, userid in instances.items():
-                        if nic['userid'].upper() == userid.upper():
-                            nic_entry = {
-                                'vswitch_name': vsw['vswitch_name'],
-                                'nic_vdev': nic['vdev'],
-                                'nic_fr_rx': int(nic['nic_fr_rx']),
-                                'nic_fr_tx': int(nic['nic_fr_tx']),
-                                'nic_fr_rx_dsc': int(nic['nic_fr_rx_dsc']),
-                                'nic_fr_tx_dsc': int(nic['nic_fr_tx_dsc']),
-                                'nic_fr_rx_err': int(nic['nic_fr_rx_err']),
-                                'nic_fr_tx_err': int(nic['nic_fr_tx_err']),
-                                'nic_rx': int(nic['nic_rx']),
-                                'nic_tx': int(nic['nic_tx'])}
-                            inst_stat = self.cache.get('vnics', inst_name)
-                            if inst_stat is None:
-                                inst_stat = {
-                                    'nodename': inst_name,
-                                    'userid': userid,
-                                    'nics': [nic_entry]
-                                }
-                            else:
-                                inst_stat['nics'].append(nic_entry)
-                            self.cache.set('vnics', inst_stat)
+            self.vswitches = dict((vsw['vswitch_name'], vsw)
+                                  for vsw in vsw_dict['vswitches'])
+            self.vswitch_failures = {}
+            userids = set(u.upper() for u in self.instances.values())
+            self._learn_vswitches(sorted(
+                vsw['vswitch_name'] for vsw in vsw_dict['vswitches']
+                if any(nic['userid'].upper() in userids
+                       for nic in vsw['nics'])))
+            return vsw_dict['vswitches']
+        if not vsw_names:
+            zvmutils.METRICS.incr('vswitch.skipped')
+            return []
+
+        priority = zvmutils.current_request_priority()
+        deadline = zvmutils.current_request_deadline()
+
+        def _query(vsw_name):
+            with zvmutils.request_priority(priority), \
+                    zvmutils.request_deadline(deadline):
+                return self._query_vswitch(vsw_name)
+
+        pool = eventlet.GreenPool(CONF.zvm.vswitch_query_concurrency)
+        for vsw_name, vsw in zip(vsw_names, pool.imap(_query, vsw_names)):
+            if vsw is not None:
+                self.vswitches[vsw_name] = vsw
+                self.vswitch_failures.pop(vsw_name, None)
+                continue
+            failures = self.vswitch_failures.get(vsw_name, 0) + 1
+            self.vswitch_failures[vsw_name] = failures
+            if (failures >= self.VSWITCH_STALE_CYCLES and
+                    self.vswitches.pop(vsw_name, None) is not None):
+                LOG.warning(_LW("Dropping the cached stats of vswitch "
+                                "%(vsw)s, not refreshed for %(n)d cycles"),
+                            {'vsw': vsw_name, 'n': failures})
+                zvmutils.METRICS.incr('vswitch.stale_dropped')
+        return [self.vswitches[vsw_name] for vsw_name in vsw_names
+                if vsw_name in self.vswitches]
+
+    def _update_inst_nic_stat(self, instances):
+        inst_names = dict((userid.upper(), inst_name)
+                          for inst_name, userid in instances.items())
+        for vsw in self._query_vswitches():
+            for nic in vsw['nics']:
+                inst_name = inst_names.get(nic['userid'].upper())
+                if inst_name is None:
+                    continue
+                try:
+                    nic_entry = {
+                        'vswitch_name': vsw['vswitch_name'],
+                        'nic_vdev': nic['vdev'],
+                        'nic_fr_rx': int(nic['nic_fr_rx']),
+                        'nic_fr_tx': int(nic['nic_fr_tx']),
+                        'nic_fr_rx_dsc': int(nic['nic_fr_rx_dsc']),
+                        'nic_fr_tx_dsc': int(nic['nic_fr_tx_dsc']),
+                        'nic_fr_rx_err': int(nic['nic_fr_rx_err']),
+                        'nic_fr_tx_err': int(nic['nic_fr_tx_err']),
+                        'nic_rx': int(nic['nic_rx']),
+                        'nic_tx': int(nic['nic_tx'])}
+                except zvmutils.INVALID_RESP_DATA_ERRORS as err:
+                    zvmutils.skip_invalid_record('vnics', nic['userid'], err)
+                    continue
+                inst_stat = self.cache.get('vnics', inst_name)
+                if inst_stat is None:
+                    inst_stat = {
+                        'nodename': inst_name,
+                        'userid': instances[inst_name],
+                        'nics': [nic_entry]
+                    }
+                else:
+                    inst_stat['nics'].append(nic_entry)
+                self.cache.set('vnics', inst_stat)
+
+        for inst_name in instances:
+            inst_stat = self.cache.get('vnics', inst_name)
+            if inst_stat is not None:
+                self._record_nic_activity(inst_stat['userid'],
+                                          inst_stat['nics'])
+
+    def _update_inst_disk_stat(self, instances):
+        io_counts = zvmutils.indicate_user_io(self.zhcp_info['nodename'],
+                                              instances.values())
+        now = time.time()
+        for inst_name, userid in instances.items():
+            io_count = io_counts.get(userid.upper())
+            if io_count is None:
+                continue
+            # I/Os per second since the last refresh, None on the first
+            # one and when the counter was reset by a guest logoff.
+            iops = None
+            last = self.io_counts.get(userid.upper())
+            if last is not None and io_count >= last[0] and now > last[1]:
+                iops = (io_count - last[0]) / (now - last[1])
+            self.io_counts[userid.upper()] = (io_count, now)
+            self.cache.set('disks', {'nodename': inst_name,
+                                     'userid': userid,
+                                     'io_count': io_count,
+                                     'iops': iops})
+
+    def _update_inst_stat_by_zhcp_helper(self, meter, instances):
+        """Collect stats with the zHCP helper, False if it failed."""
+        zhcp_node = self.zhcp_info['nodename']
+        vswitches = self._vswitches_to_query()
+        if meter == 'vnics' and vswitches == []:
+            zvmutils.METRICS.incr('vswitch.skipped')
+            return True
+        try:
+            if self.zhcp_helper_path is None:
+                self.zhcp_helper_path = zvmutils.deploy_zhcp_helper(zhcp_node)
+            stats = zvmutils.zhcp_helper_query(zhcp_node,
+                                               self.zhcp_helper_path, meter,
+                                               instances.values(),
+                                               vswitches or [])
+        except zvmutils.ZVMException as err:
+            LOG.warning(_LW("zHCP helper failed, falling back to smcli "
+                            "queries: %s"), err)
+            self.zhcp_helper_path = None
+            return False
+
+        for inst_name, userid in instances.items():
+            userid = userid.upper()
+            if userid in stats['cpumem']:
+                self._set_cpu_mem_stat(inst_name, userid,
+                                       *stats['cpumem'][userid])
+            if userid in stats['vnics']:
+                self.cache.set('vnics', {'nodename': inst_name,
+                                         'userid': userid,
+                                         'nics': stats['vnics'][userid]})
+                self._record_nic_activity(userid, stats['vnics'][userid])
+
+        if (meter == 'vnics' and vswitches is None and
+                instances is self.instances):
+            self._learn_vswitches(sorted(set(
+                nic['vswitch_name'] for nics in stats['vnics'].values()
+                for nic in nics)))
+        return True
+
+    def _select_tier(self, instances):
+        """Returns the instances whose cpu and memory stats are refreshed."""
+        selected = self.tiers.select(u.upper() for u in instances.values())
+        zvmutils.METRICS.incr('tiered_refresh.skipped',
+                              len(instances) - len(selected))
+        return dict((inst_name, userid)
+                    for inst_name, userid in instances.items()
+                    if userid.upper() in selected)
+
+    def _timed(self, phase, func, *args):
+        started = time.time()
+        result = func(*args)
+        self.phase_durations[phase] = time.time() - started
+        return result
+
+    def _plan_degradation(self, meter):
+        """Returns the degradations needed to end the refresh in time.
+
+        The vswitch query is skipped first, then the cached inventory is
+        reused, based on how long each phase took the last time.
+        """
+        degradations = set()
+        remaining = zvmutils.remaining_time()
+        if remaining is None:
+            return degradations
+        phases = set(['inventory', meter])
+        if self.tiers is not None:
+            phases.add('cpumem')
+        if self.demand is not None:
+            phases.update(m for m in self.demand.meters()
+                          if m in ('cpumem', 'vnics', 'disks'))
+        need = sum(self.phase_durations.get(p, 0) for p in phases)
+        if need > remaining and 'vnics' in phases:
+            degradations.add('skip_vswitch')
+            need -= self.phase_durations.get('vnics', 0)
+        if need > remaining and self.instances:
+            degradations.add('reuse_inventory')
+        for degradation in degradations:
+            zvmutils.METRICS.incr('degraded.%s' % degradation)
+        return degradations
+
+    def _restore(self, ctype, stats):
+        """Put back the former stats of the guests missing in the cache."""
+        for inst_name, inst_stat in stats.items():
+            if (self.instances.get(inst_name) == inst_stat['userid'] and
+                    self.cache.get(ctype, inst_name) is None):
+                self.cache.set(ctype, inst_stat)
 
     def _update_cache(self, meter, instances={}):
-        if instances == {}:
-            self.cache.clear()
-            self.cache_expiration = (timeutils.utcnow_ts() +
-                                     CONF.zvm.cache_update_interval)
-            instances = self.instances = zvmutils.list_instances(
-                                                                self.zhcp_info)
-        if meter == 'cpumem':
-            self._update_inst_cpu_mem_stat(instances)
-        if meter == 'vnics':
-            self._update_inst_nic_stat(instances)
+        if instances != {}:
+            self._refresh_inst_stat(meter, instances)
+            return
+
+        # Kept to be served again when the refresh budget runs out.
+        previous = dict((ctype, self.cache.snapshot(ctype))
+                        for ctype in ('cpumem', 'vnics', 'disks'))
+        # Quiet guests keep their cpu and memory stats until their turn
+        # comes.
+        if self.tiers is None:
+            self.cache.clear('cpumem')
+        self.cache.clear('vnics')
+        self.cache.clear('disks')
+        for ctype in ('cpumem', 'vnics', 'disks'):
+            self.cache.start_cycle(ctype)
+        self.missed.difference_update(('cpumem', 'vnics', 'disks'))
+        self.cache_expiration = (timeutils.utcnow_ts() +
+                                 CONF.zvm.cache_update_interval)
+        degradations = self._plan_degradation(meter)
+        try:
+            if 'reuse_inventory' in degradations:
+                instances = self.instances
+            else:
+                instances = self._timed('inventory', zvmutils.list_instances,
+                                        self.zhcp_info)
+            if instances != self.instances:
+                # Inventory changed, drop memoized userids of departed or
+                # renamed guests and learn the vswitches in use again.
+                self.userids.clear()
+                self.metered_vswitches = None
+                self.cache.retain(instances)
+                userids = set(u.upper() for u in instances.values())
+                self.io_counts = dict(
+                    (userid, count)
+                    for userid, count in self.io_counts.items()
+                    if userid in userids)
+                if self.demand is not None:
+                    self.demand.retain(instances)
+            self.userids.update(instances)
+            self.instances = instances
+
+            targets = self._refresh_targets(meter, instances)
+            if 'skip_vswitch' in degradations:
+                targets.pop('vnics', None)
+                self._restore('vnics', previous['vnics'])
+            for ctype in ('cpumem', 'vnics', 'disks'):
+                if targets.get(ctype):
+                    self._timed(ctype, self._refresh_inst_stat, ctype,
+                                targets[ctype])
+        except zvmutils.ZVMDeadlineExceeded as err:
+            LOG.warning(_LW("Refresh budget exhausted, serving the former "
+                            "stats: %s"), err)
+            zvmutils.METRICS.incr('degraded.stale')
+            for ctype, stats in previous.items():
+                self._restore(ctype, stats)
+
+    def _refresh_targets(self, meter, instances):
+        """Returns the instances to refresh for each meter in a cycle."""
+        meters = set([meter])
+        if self.demand is not None:
+            meters.update(m for m in self.demand.meters()
+                          if m in ('cpumem', 'vnics', 'disks'))
+        if self.tiers is not None:
+            # Busy guests and the guests whose turn came are refreshed
+            # every cycle, whatever the meter read.
+            meters.add('cpumem')
+
+        targets = {}
+        for ctype in meters:
+            if self.demand is None:
+                targets[ctype] = instances
+                continue
+            targets[ctype] = self.demand.instances(ctype, instances)
+            zvmutils.METRICS.incr('demand.skipped.%s' % ctype,
+                                  len(instances) - len(targets[ctype]))
+        if self.tiers is not None:
+            tier = self._select_tier(instances)
+            targets['cpumem'] = dict(
+                (inst_name, userid)
+                for inst_name, userid in targets['cpumem'].items()
+                if inst_name in tier)
+        return targets
+
+    def _refresh_inst_stat(self, meter, instances):
+        with tracing.span('cache.%s' % meter, cat='cache',
+                          guests=len(instances)):
+            if meter == 'disks':
+                self._update_inst_disk_stat(instances)
+                return
+            if (CONF.zvm.zhcp_helper and
+                    self._update_inst_stat_by_zhcp_helper(meter, instances)):
+                return
+            if meter == 'cpumem':
+                self._update_inst_cpu_mem_stat(instances)
+            if meter == 'vnics':
+                self._update_inst_nic_stat(instances)
+
+    def _shared_refresh(self, meter, refresh, names, interval):
+        """Refresh the stats of a meter once for all the nodes sharing the
+        cache backend.
+
+        The node holding the lease of the meter runs refresh and publishes
+        the cached stats, the other ones load them.
+
+        @names:        cache types, or 'inventory', published after refresh.
+        @interval:     seconds the lease is held.
+        """
+        if self.shared is None:
+            refresh()
+            return
+        if not self.shared.acquire(meter, interval):
+            stats = self.shared.wait(meter, CONF.zvm.cache_lease_wait)
+            if stats is not None:
+                zvmutils.METRICS.incr('shared_cache.loaded.%s' % meter)
+                for name in names:
+                    self._load_shared(name, stats if name == meter else
+                                      self.shared.fetch(name))
+                return
+            LOG.warning(_LW("No %s stats published by the holder of the "
+                            "refresh lease, refreshing them"), meter)
+        refresh()
+        zvmutils.METRICS.incr('shared_cache.published.%s' % meter)
+        for name in names:
+            entries = (self.instances if name == 'inventory' else
+                       self.cache.snapshot(name))
+            if entries:
+                self.shared.publish(name, entries, self.cache.ttl or
+                                    interval * max(1, self.cache.max_cycles))
+
+    def _load_shared(self, name, entries):
+        """Replace the cached stats, or the inventory, by published ones."""
+        if entries is None:
+            return
+        if name == 'inventory':
+            if entries != self.instances:
+                self.userids.clear()
+                self.metered_vswitches = None
+                self.cache.retain(entries)
+            self.userids.update(entries)
+            self.instances = entries
+            return
+        self.cache.clear(name)
+        self.cache.start_cycle(name)
+        self.missed.discard(name)
+        for inst_stat in entries.values():
+            self.cache.set(name, inst_stat)
 
     def _check_expiration_and_update_cache(self, meter):
         now = timeutils.utcnow_ts()
+        deadline = None
+        if CONF.zvm.refresh_budget:
+            deadline = time.time() + CONF.zvm.refresh_budget
+        self.scheduler.record_read()
         if now >= self.cache_expiration:
-            self._update_cache(meter)
+            started = time.time()
+            with zvmutils.request_priority(zvmutils.PRIORITY_BULK), \
+                    zvmutils.request_deadline(deadline), \
+                    profiling.PROFILER.profile('refresh-%s' % meter), \
+                    tracing.span('refresh.%s' % meter, cat='refresh'):
+                self._shared_refresh(meter,
+                                     functools.partial(self._update_cache,
+                                                       meter),
+                                     ('inventory', 'cpumem', 'vnics',
+                                      'disks'),
+                                     CONF.zvm.cache_update_interval)
+            self.cache_expiration = self.scheduler.next_expiration(
+                                            started, time.time() - started)
+
+    def _get_userid(self, inst_name):
+        userid = self.instances.get(inst_name)
+        if userid is None:
+            if inst_name not in self.userids:
+                # Guests missing from the cached inventory are usually
+                # onboarded in batches, resolve all of them with one query.
+                self.userids.update(zvmutils.get_userids(), [inst_name])
+            userid = self.userids.get(inst_name)
+        return userid
 
     def _get_inst_stat(self, meter, instance):
         inst_name = zvmutils.get_inst_name(instance)
@@ -150,16 +768,37 @@ class ZVMInspector(virt_inspector.Inspector):
             msg = _("Can not get vm info in shutdown state "
                     "for %s") % inst_name
             raise virt_inspector.InstanceShutOffException(msg)
+        return self._get_inst_stat_by_name(meter, inst_name)
+
+    def _missing(self, meter, inst_name, userid):
+        """Returns the guests to refresh on a cache miss of inst_name.
 
+        The first miss of a meter in a cycle refreshes all the guests of
+        the inventory missing from the cache at once, as the next ones read
+        would miss too. Later misses only refresh the guest read.
+        """
+        instances = {inst_name: userid}
+        if self.instances and meter not in self.missed:
+            self.missed.add(meter)
+            cached = self.cache.snapshot(meter)
+            instances.update((name, uid)
+                             for name, uid in self.instances.items()
+                             if name not in cached)
+        return instances
+
+    def _get_inst_stat_by_name(self, meter, inst_name):
+        if self.demand is not None:
+            self.demand.record(meter, inst_name)
         self._check_expiration_and_update_cache(meter)
 
         inst_stat = self.cache.get(meter, inst_name)
 
         if inst_stat is None:
-            userid = (self.instances.get(inst_name) or
-                        zvmutils.get_userid(inst_name))
-            self._update_cache(meter, {inst_name: userid})
-            inst_stat = self.cache.get(meter, inst_name)
+            userid = self._get_userid(inst_name)
+            if userid is not None:
+                self._update_cache(meter,
+                                   self._missing(meter, inst_name, userid))
+                inst_stat = self.cache.get(meter, inst_name)
 
         if inst_stat is None:
             msg = _("Can not get vm info for %s") % inst_name
@@ -176,6 +815,22 @@ class ZVMInspector(virt_inspector.Inspector):
         inst_stat = self._get_inst_stat('cpumem', instance)
         return virt_inspector.MemoryUsageStats(usage=inst_stat['used_memory'])
 
+    def inspect_memory_resident(self, instance, duration=None):
+        inst_stat = self._get_inst_stat('cpumem', instance)
+        # Used memory of a z/VM guest is its resident real memory
+        return virt_inspector.MemoryResidentStats(
+                                        resident=inst_stat['used_memory'])
+
+    def inspect_memory_allocated(self, instance):
+        """Returns the maximum memory of the guest in MB."""
+        inst_stat = self._get_inst_stat('cpumem', instance)
+        max_memory = inst_stat.get('extra', {}).get('max_memory')
+        if max_memory is None:
+            msg = _("Can not get allocated memory of %s, max_memory is not "
+                    "in ipq_extra_fields") % inst_stat['nodename']
+            raise virt_inspector.InstanceNoDataException(msg)
+        return MemoryAllocatedStats(allocated=max_memory // units.Ki)
+
     def inspect_vnics(self, instance):
         inst_stat = self._get_inst_stat('vnics', instance)
         for nic in inst_stat['nics']:
@@ -194,3 +849,19 @@ class ZVMInspector(virt_inspector.Inspector):
                 rx_errors=nic['nic_fr_rx_err'],
                 tx_errors=nic['nic_fr_tx_err'])
             yield (interface, stats)
+
+    def inspect_disk_iops(self, instance):
+        """Returns the I/Os per second started by the guest since the last
+        refresh.
+
+        z/VM counts the I/Os of a guest over all its devices without telling
+        reads from writes, so inspect_disks is not implemented and the rate
+        is reported for a single 'all' device.
+        """
+        inst_stat = self._get_inst_stat('disks', instance)
+        if inst_stat['iops'] is None:
+            msg = _("Can not get the I/O rate of %s before its second "
+                    "refresh") % inst_stat['nodename']
+            raise virt_inspector.InstanceNoDataException(msg)
+        yield (virt_inspector.Disk(device='all'),
+               virt_inspector.DiskIOPSStats(iops_count=inst_stat['iops']))
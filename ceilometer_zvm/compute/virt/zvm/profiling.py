@@ -0,0 +1,152 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""On demand profiling of the cache refreshes of the z/VM inspector.
+
+Sending profile_signal to the process profiles the next profile_cycles
+refreshes with cProfile, and tracemalloc when available. For each refresh
+the raw profile and a text report with the top functions and allocation
+sites are written to profile_dir. Capture stops by itself after those
+refreshes. Unless armed, nothing is traced and a refresh only checks a
+counter.
+"""
+
+import contextlib
+import cProfile
+import os
+import pstats
+import signal
+import time
+
+from ceilometer.i18n import _LI
+from ceilometer.i18n import _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+profiling_opts = [
+    cfg.StrOpt('profile_signal',
+               default=None,
+               help="Name of the signal, e.g. SIGUSR1, that profiles the "
+                    "next refreshes of the cached data. Not set disables "
+                    "profiling"),
+    cfg.IntOpt('profile_cycles',
+               default=3,
+               help="Number of refreshes profiled per signal"),
+    cfg.StrOpt('profile_dir',
+               default='/var/log/ceilometer/zvm-profiles',
+               help="Directory the profiles are written to"),
+    cfg.BoolOpt('profile_memory',
+                default=True,
+                help="Also trace memory allocations while profiling"),
+]
+
+
+CONF = cfg.CONF
+CONF.register_opts(profiling_opts, group='zvm')
+LOG = logging.getLogger(__name__)
+
+# Number of entries in the text reports.
+REPORT_LIMIT = 40
+
+
+class Profiler(object):
+    """Profile a given number of refreshes once armed."""
+
+    def __init__(self):
+        self.remaining = 0
+        self.active = False
+        self.installed = False
+
+    def arm(self, cycles=None):
+        """Profile the next cycles refreshes, profile_cycles by default."""
+        self.remaining = CONF.zvm.profile_cycles if cycles is None else cycles
+
+    def _handle_signal(self, signum, frame):
+        # Nothing is logged here, a signal handler must not take locks
+        self.arm()
+
+    def install_signal_handler(self):
+        if self.installed or not CONF.zvm.profile_signal:
+            return
+        try:
+            signum = getattr(signal, CONF.zvm.profile_signal.upper())
+            signal.signal(signum, self._handle_signal)
+        except (AttributeError, TypeError, ValueError) as err:
+            LOG.warning(_LW("Can not install the profiling signal "
+                            "handler for %(sig)s: %(err)s"),
+                        {'sig': CONF.zvm.profile_signal, 'err': err})
+            return
+        self.installed = True
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        """Profile the enclosed code when armed.
+
+        @name:         part of the names of the files written.
+        """
+        if self.remaining <= 0 or self.active:
+            yield
+            return
+
+        self.remaining -= 1
+        self.active = True
+        LOG.info(_LI("Profiling %(name)s, %(left)d more to profile"),
+                 {'name': name, 'left': self.remaining})
+        trace_memory = (CONF.zvm.profile_memory and
+                        tracemalloc is not None and
+                        not tracemalloc.is_tracing())
+        if trace_memory:
+            tracemalloc.start()
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            snapshot = None
+            if trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            self.active = False
+            self._write(name, prof, snapshot)
+
+    def _write(self, name, prof, snapshot):
+        base = os.path.join(CONF.zvm.profile_dir, '%s-%s-%d' % (
+                                name, time.strftime('%Y%m%d%H%M%S'),
+                                os.getpid()))
+        try:
+            if not os.path.isdir(CONF.zvm.profile_dir):
+                os.makedirs(CONF.zvm.profile_dir)
+            prof.dump_stats(base + '.prof')
+            with open(base + '.txt', 'w') as report:
+                stats = pstats.Stats(prof, stream=report)
+                stats.sort_stats('cumulative').print_stats(REPORT_LIMIT)
+                if snapshot is not None:
+                    report.write('Top allocation sites:\n')
+                    for stat in snapshot.statistics('lineno')[:REPORT_LIMIT]:
+                        report.write('%s\n' % stat)
+        except (IOError, OSError) as err:
+            LOG.warning(_LW("Failed to write the profile %(base)s: "
+                            "%(err)s"), {'base': base, 'err': err})
+            return
+        LOG.info(_LI("Wrote profile %s"), base)
+
+
+PROFILER = Profiler()
@@ -0,0 +1,225 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import collections
+import time
+import zlib
+
+
+class RefreshScheduler(object):
+    """Decide when the inspector cache expires.
+
+    With adaptive scheduling the scheduler watches when the inspector is
+    read. Reads separated by more than a gap belong to different polling
+    cycles. Once the cycle period is known, the cache expires halfway
+    between the last read of the current cycle and the expected start of
+    the next one, so every cycle is served from one refresh made at its
+    start. The next refresh is never scheduled sooner than min_interval,
+    or latency_factor times the observed refresh duration, after the last
+    one.
+    """
+
+    # Number of cycles the period and span estimates are based on.
+    HISTORY = 8
+    # Reads closer than this many seconds belong to the same cycle.
+    MAX_CYCLE_GAP = 30.0
+    LATENCY_FACTOR = 10
+    # Weight of the newest sample in the refresh duration average.
+    LATENCY_ALPHA = 0.3
+
+    def __init__(self, interval, adaptive=False, min_interval=0):
+        self.default_interval = interval
+        self.adaptive = adaptive
+        self.min_interval = min_interval
+        self.cycle_starts = collections.deque(maxlen=self.HISTORY)
+        self.cycle_spans = collections.deque(maxlen=self.HISTORY)
+        self.last_read = None
+        self.latency = None
+
+    def _cycle_gap(self):
+        period = self.period()
+        if period is None:
+            return self.MAX_CYCLE_GAP
+        return min(self.MAX_CYCLE_GAP, period / 2.0)
+
+    def record_read(self, now=None):
+        """Record a read of the inspector cache."""
+        now = time.time() if now is None else now
+        if self.last_read is None or now - self.last_read > self._cycle_gap():
+            if self.cycle_starts:
+                self.cycle_spans.append(self.last_read -
+                                        self.cycle_starts[-1])
+            self.cycle_starts.append(now)
+        self.last_read = now
+
+    def period(self):
+        """Returns the median polling period, None until it is known."""
+        if len(self.cycle_starts) < 2:
+            return None
+        starts = list(self.cycle_starts)
+        gaps = sorted(b - a for a, b in zip(starts, starts[1:]))
+        return gaps[len(gaps) // 2]
+
+    def record_refresh(self, duration):
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency = (self.LATENCY_ALPHA * duration +
+                            (1 - self.LATENCY_ALPHA) * self.latency)
+
+    def next_expiration(self, now, duration):
+        """Returns when the cache refreshed at now expires.
+
+        @now:          time the refresh started.
+        @duration:     seconds the refresh took.
+        """
+        self.record_refresh(duration)
+        period = self.period() if self.adaptive else None
+        if period is None:
+            return now + self.default_interval
+
+        span = max(self.cycle_spans) if self.cycle_spans else 0
+        expiration = self.cycle_starts[-1] + (span + period) / 2.0
+        spacing = max(self.min_interval, self.latency * self.LATENCY_FACTOR)
+        return max(expiration, now + spacing)
+
+
+class TieredSelector(object):
+    """Pick the guests whose cpu and memory stats are refreshed in a cycle.
+
+    A guest whose cpu usage or NIC traffic was above the thresholds in one
+    of its recent samples is hot and refreshed every cycle. Quiet guests are
+    split in max_age groups that are refreshed in turn, so the stats of a
+    guest are never more than max_age cycles old.
+    """
+
+    # Number of cycles a guest stays hot after a busy sample.
+    HOT_CYCLES = 3
+
+    def __init__(self, max_age, cpu_threshold, nic_threshold):
+        """
+        @max_age:          cycles after which a guest is refreshed at the
+                           latest.
+        @cpu_threshold:    cpu usage in percent of one cpu.
+        @nic_threshold:    NIC traffic in bytes per second.
+        """
+        self.max_age = max(1, max_age)
+        self.cpu_threshold = cpu_threshold
+        self.nic_threshold = nic_threshold
+        self.cycle = 0
+        # (counter, userid) -> (time, value) of the last sample.
+        self.samples = {}
+        self.hot_until = {}
+        self.refreshed = {}
+
+    def _rate(self, counter, userid, value, now):
+        last = self.samples.get((counter, userid))
+        self.samples[(counter, userid)] = (now, value)
+        if last is None or now <= last[0] or value < last[1]:
+            # First sample or counter reset
+            return None
+        return (value - last[1]) / float(now - last[0])
+
+    def _mark_hot(self, userid):
+        self.hot_until[userid] = self.cycle + self.HOT_CYCLES
+
+    def record_cpu(self, userid, used_cpu_time, now=None):
+        """Record the used cpu time in uS of a refreshed guest."""
+        now = time.time() if now is None else now
+        self.refreshed[userid] = self.cycle
+        rate = self._rate('cpu', userid, used_cpu_time, now)
+        # uS per second to percent of one cpu
+        if rate is not None and rate / 10000.0 >= self.cpu_threshold:
+            self._mark_hot(userid)
+
+    def record_nic(self, userid, nic_bytes, now=None):
+        """Record the sum of the rx and tx bytes of the NICs of a guest."""
+        now = time.time() if now is None else now
+        rate = self._rate('nic', userid, nic_bytes, now)
+        if rate is not None and rate >= self.nic_threshold:
+            self._mark_hot(userid)
+
+    def is_hot(self, userid):
+        return self.hot_until.get(userid, -1) >= self.cycle
+
+    def _turn(self, userid):
+        return zlib.crc32(userid.encode('utf-8')) % self.max_age
+
+    def select(self, userids):
+        """Start a cycle, returns the set of userids to refresh in it."""
+        self.cycle += 1
+        userids = set(userids)
+        for state in (self.hot_until, self.refreshed):
+            for userid in [u for u in state if u not in userids]:
+                del state[userid]
+        for key in [k for k in self.samples if k[1] not in userids]:
+            del self.samples[key]
+
+        turn = self.cycle % self.max_age
+        selected = set()
+        for userid in userids:
+            last = self.refreshed.get(userid)
+            if (last is None or self.cycle - last >= self.max_age or
+                    self.is_hot(userid) or self._turn(userid) == turn):
+                selected.add(userid)
+        return selected
+
+
+class DemandTracker(object):
+    """Track which meters and guests are read.
+
+    A meter, or a guest of a meter, is in demand when it was read within
+    the last window seconds. Refreshes leave the others out, a guest read
+    for the first time is collected on that read. Until a meter has been
+    read for a whole window, all its guests are in demand.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # meter -> {instance name: time of the last read}
+        self.reads = {}
+        # meter -> time of its first read
+        self.since = {}
+
+    def record(self, meter, inst_name, now=None):
+        now = time.time() if now is None else now
+        self.reads.setdefault(meter, {})[inst_name] = now
+        self.since.setdefault(meter, now)
+
+    def meters(self, now=None):
+        """Returns the set of meters in demand."""
+        now = time.time() if now is None else now
+        return set(meter for meter, reads in self.reads.items()
+                   if any(now - t <= self.window for t in reads.values()))
+
+    def instances(self, meter, instances, now=None):
+        """Returns the part of instances in demand for meter."""
+        now = time.time() if now is None else now
+        if now - self.since.get(meter, now) < self.window:
+            # Not every reader had its turn yet.
+            return instances
+        reads = self.reads.get(meter, {})
+        for inst_name in [n for n, t in reads.items()
+                          if now - t > self.window]:
+            del reads[inst_name]
+        return dict((inst_name, userid)
+                    for inst_name, userid in instances.items()
+                    if inst_name in reads)
+
+    def retain(self, instances):
+        """Forget the guests that are not in instances any more."""
+        for reads in self.reads.values():
+            for inst_name in [n for n in reads if n not in instances]:
+                del reads[inst_name]
@@ -0,0 +1,158 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Stats cache shared by the z/VM inspectors of several nodes.
+
+With the memory backend, the default, every inspector keeps its own cache
+and refreshes it from xCAT. With the memcache backend, the inspectors
+polling the same z/VM host take a lease on each refresh. The holder of the
+lease refreshes from xCAT and publishes the stats. The other inspectors
+load the published stats instead of querying xCAT.
+
+A published snapshot is a head key holding its version and number of
+chunks, written after the chunks, so a reader never sees a partial
+snapshot.
+"""
+
+import os
+import socket
+import time
+
+from ceilometer.i18n import _LW
+import eventlet
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+
+sharedcache_opts = [
+    cfg.StrOpt('cache_backend',
+               default='memory',
+               choices=['memory', 'memcache'],
+               help="Where the stats are cached. memory keeps them in the "
+                    "process, memcache shares them between the nodes "
+                    "polling the same z/VM host"),
+    cfg.ListOpt('cache_backend_servers',
+                default=['127.0.0.1:11211'],
+                help="Servers of the memcache cache backend"),
+    cfg.StrOpt('cache_backend_prefix',
+               default='ceilometer-zvm',
+               help="Prefix of the keys of the shared cache"),
+    cfg.IntOpt('cache_lease_wait',
+               default=30,
+               help="Seconds a node without the refresh lease waits for "
+                    "the stats of the lease holder before refreshing them "
+                    "itself"),
+]
+
+
+CONF = cfg.CONF
+CONF.register_opts(sharedcache_opts, group='zvm')
+LOG = logging.getLogger(__name__)
+
+# Cached entries per chunk, keeps each value under the item size limit.
+CHUNK_ENTRIES = 1000
+# Seconds between checks whether the lease holder published its stats.
+POLL_INTERVAL = 1.0
+
+
+class SharedCache(object):
+    """Leases and published snapshots in a memcache like key-value store.
+
+    @client:       object with the get, set, add and delete methods of a
+                   memcache client.
+    @prefix:       prefix of the keys, sets the inspectors sharing them.
+    """
+
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        # name -> version of the last snapshot published or loaded
+        self.versions = {}
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def acquire(self, name, ttl):
+        """Take or renew the lease of a refresh, returns whether held."""
+        key = self._key(name, 'lease')
+        if self.client.add(key, self.owner, time=max(1, int(ttl))):
+            return True
+        if self.client.get(key) == self.owner:
+            self.client.set(key, self.owner, time=max(1, int(ttl)))
+            return True
+        return False
+
+    def publish(self, name, entries, ttl):
+        """Publish a dict as a new version of the snapshot name."""
+        version = '%.6f' % time.time()
+        items = sorted(entries.items())
+        chunks = [dict(items[i:i + CHUNK_ENTRIES])
+                  for i in range(0, len(items), CHUNK_ENTRIES)]
+        ttl = max(1, int(ttl))
+        for i, chunk in enumerate(chunks):
+            self.client.set(self._key(name, version, str(i)),
+                            jsonutils.dumps(chunk), time=ttl)
+        self.client.set(self._key(name),
+                        jsonutils.dumps({'v': version, 'n': len(chunks)}),
+                        time=ttl)
+        self.versions[name] = version
+
+    def fetch(self, name):
+        """Returns the snapshot name if newer than the last one seen.
+
+        None when there is no newer snapshot, or its chunks were evicted.
+        """
+        head = self.client.get(self._key(name))
+        if head is None:
+            return None
+        head = jsonutils.loads(head)
+        if head['v'] <= self.versions.get(name, ''):
+            return None
+        entries = {}
+        for i in range(head['n']):
+            chunk = self.client.get(self._key(name, head['v'], str(i)))
+            if chunk is None:
+                return None
+            entries.update(jsonutils.loads(chunk))
+        self.versions[name] = head['v']
+        return entries
+
+    def wait(self, name, timeout):
+        """Returns the next snapshot name, None if none came in time."""
+        until = time.time() + timeout
+        while True:
+            entries = self.fetch(name)
+            if entries is not None or time.time() >= until:
+                return entries
+            eventlet.sleep(POLL_INTERVAL)
+
+
+def get_shared_cache():
+    """Returns the SharedCache of the configured backend, None for memory."""
+    if CONF.zvm.cache_backend != 'memcache':
+        return None
+    if memcache is None:
+        LOG.warning(_LW("The memcache cache backend needs the "
+                        "python-memcached library, caching in memory"))
+        return None
+    client = memcache.Client(CONF.zvm.cache_backend_servers)
+    return SharedCache(client, '%s:%s' % (CONF.zvm.cache_backend_prefix,
+                                          CONF.zvm.zvm_host))
@@ -0,0 +1,160 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Timeline tracing of the z/VM collection path.
+
+When trace_file is set, the inventory listing, the xCAT requests and their
+phases, the smcli parsers and the cache updates are written as spans to a
+rotating file in the Chrome trace event format. A file can be loaded as is
+in chrome://tracing or Perfetto to see one refresh as a timeline, with one
+row per green thread. Unless trace_file is set a span only checks an
+option.
+"""
+
+import itertools
+import json
+import logging as std_logging
+from logging import handlers as log_handlers
+import os
+import threading
+import time
+
+from eventlet import corolocal
+from oslo_config import cfg
+
+
+tracing_opts = [
+    cfg.StrOpt('trace_file',
+               default=None,
+               help="File the spans of the collection path are written to "
+                    "in the Chrome trace event format. Not set disables "
+                    "tracing"),
+    cfg.IntOpt('trace_max_bytes',
+               default=20 * 1024 * 1024,
+               help="Size in bytes at which the trace file is rotated"),
+    cfg.IntOpt('trace_backup_count',
+               default=3,
+               help="Number of rotated trace files kept"),
+]
+
+
+CONF = cfg.CONF
+CONF.register_opts(tracing_opts, group='zvm')
+
+_trace_logger = None
+_lock = threading.Lock()
+# Small ids of the green threads, that are the rows of the timeline.
+_thread_ids = itertools.count(1)
+_thread_context = corolocal.local()
+
+
+class TraceFileHandler(log_handlers.RotatingFileHandler):
+    """Rotating file handler starting each file as a JSON array.
+
+    The trace event format allows the closing bracket and a trailing comma
+    to be missing, so every file can be loaded while it is written.
+    """
+
+    def _open(self):
+        stream = log_handlers.RotatingFileHandler._open(self)
+        if stream.tell() == 0:
+            stream.write('[\n')
+        return stream
+
+
+def _get_trace_logger():
+    """Returns the logger writing the spans, None if tracing is disabled."""
+    global _trace_logger
+    if CONF.zvm.trace_file is None:
+        return None
+    if _trace_logger is None:
+        with _lock:
+            if _trace_logger is None:
+                handler = TraceFileHandler(
+                                CONF.zvm.trace_file,
+                                maxBytes=CONF.zvm.trace_max_bytes,
+                                backupCount=CONF.zvm.trace_backup_count)
+                handler.setFormatter(std_logging.Formatter('%(message)s,'))
+                trace_logger = std_logging.getLogger(__name__ + '.trace')
+                trace_logger.propagate = False
+                trace_logger.setLevel(std_logging.INFO)
+                trace_logger.addHandler(handler)
+                _trace_logger = trace_logger
+    return _trace_logger
+
+
+def _thread_id():
+    tid = getattr(_thread_context, 'tid', None)
+    if tid is None:
+        tid = _thread_context.tid = next(_thread_ids)
+    return tid
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    """A complete event, written when the span ends."""
+
+    def __init__(self, logger, name, cat, args):
+        self.logger = logger
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        ended = time.time()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.logger.info(json.dumps({
+            'name': self.name, 'cat': self.cat, 'ph': 'X',
+            'ts': int(self.started * 1000000),
+            'dur': int((ended - self.started) * 1000000),
+            'pid': os.getpid(), 'tid': _thread_id(),
+            'args': self.args}, separators=(',', ':'), default=str))
+        return False
+
+    def set(self, **args):
+        """Add attributes, like guest counts or byte sizes, to the span."""
+        self.args.update(args)
+
+
+def span(name, cat='zvm', **args):
+    """Returns a context manager tracing the enclosed code as a span.
+
+    @name:         name shown on the timeline.
+    @cat:          category of the span, e.g. xcat, parse or cache.
+    @args:         attributes of the span, more can be added with set().
+    """
+    logger = _get_trace_logger()
+    if logger is None:
+        return _NULL_SPAN
+    return Span(logger, name, cat, args)
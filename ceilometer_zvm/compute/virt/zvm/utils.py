@@ -13,38 +13,180 @@
 #    under the License.
 
 
+import base64
+import codecs
+import collections
 import contextlib
 import functools
+import greenlet
+import hashlib
+import logging as std_logging
+from logging import handlers as log_handlers
 import os
+import re
+from six.moves import cPickle as pickle
 from six.moves import http_client as httplib
 import socket
 import ssl
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
 
 from ceilometer.compute.virt import inspector
 from ceilometer.i18n import _
 from ceilometer.i18n import _LW
+import eventlet
+from eventlet import corolocal
+from eventlet import greenio
+from eventlet import queue as green_queue
+from eventlet.green import socket as green_socket
+from eventlet.green import ssl as green_ssl
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+import six
+
+from ceilometer_zvm.compute.virt.zvm import tracing
 
 
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
+INVALID_RESP_DATA_ERRORS = (ValueError, TypeError, IndexError, AttributeError,
+                            KeyError)
+
+# Response bodies are read in chunks of this size into a per-thread buffer
+# that is kept for the next request. Green threads reading concurrently,
+# like hedged requests, each need their own buffer.
+READ_CHUNK_SIZE = 65536
+# A buffer grown above this size by a large response is not kept.
+READ_BUFFER_KEEP = 1024 * 1024
+_read_buffers = corolocal.local()
+
+ACCEPT_ENCODING = 'gzip, deflate'
+# Content-Encoding -> zlib wbits of the decompressor
+_DECODERS = {'gzip': 16 + zlib.MAX_WBITS,
+             'x-gzip': 16 + zlib.MAX_WBITS,
+             'deflate': zlib.MAX_WBITS}
+
+_WARNING_PTN = re.compile('warn', re.IGNORECASE)
+
+_capture_logger = None
+
+# Command of a parse worker process, see _ParsePool.
+PARSE_WORKER_CMD = [sys.executable, '-c',
+                    'from ceilometer_zvm.compute.virt.zvm import utils; '
+                    'utils._parse_worker_main()']
+# Length prefix of the pickled jobs and results sent to parse workers.
+_FRAME_HEADER = struct.Struct('!Q')
+_parse_pool = None
+
+# Priorities of xCAT calls waiting on a rate limiter, lower goes first.
+PRIORITY_BULK = 0
+PRIORITY_ADHOC = 1
+# Seconds between checks whether a rate limited call may proceed.
+RATE_LIMIT_POLL_INTERVAL = 0.01
+_rate_limiters = {}
+_request_context = corolocal.local()
+# (endpoint options, XCATEndpoints) of the configured xCAT endpoints.
+_endpoints = (None, None)
+
+ZHCP_HELPER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'zhcp_helper.py')
+
 
 class ZVMException(inspector.InspectorException):
     pass
 
 
-class CacheData(object):
-    """Virtual machine stat cache."""
-    _CTYPES = ('cpumem', 'vnics')
+class ZVMDeadlineExceeded(ZVMException):
+    """The deadline of the current collection passed."""
+    pass
+
+
+class Metrics(object):
+    """Counters describing the cost and health of the collection path."""
 
     def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def get(self, name):
+        if name in self.gauges:
+            return self.gauges[name]
+        return self.counters.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def gauge_snapshot(self):
+        return dict(self.gauges)
+
+    def clear(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+
+
+METRICS = Metrics()
+
+
+class CacheData(object):
+    """Virtual machine stat cache.
+
+    Entries of each cache type are kept in least recently used order. An
+    entry older than ttl seconds, or set more than max_cycles refresh
+    cycles of its type ago, is not returned anymore, and the least
+    recently used entry is evicted when a type holds more than max_entries.
+    """
+    _CTYPES = ('cpumem', 'vnics', 'disks')
+
+    def __init__(self, max_entries=0, ttl=0, max_cycles=0):
+        """
+        @max_entries:  entries kept per cache type, 0 means no limit.
+        @ttl:          seconds an entry is valid, 0 means until replaced.
+        @max_cycles:   refresh cycles an entry is valid, 0 means no limit.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_cycles = max_cycles
+        # Refresh cycles started per cache type, see start_cycle.
+        self.cycles = dict((tp, 0) for tp in self._CTYPES)
         self._reset()
 
     def _reset(self):
-        self.cache = dict((tp, {}) for tp in self._CTYPES)
+        self.cache = dict((tp, collections.OrderedDict())
+                          for tp in self._CTYPES)
+        self.stamps = dict((tp, {}) for tp in self._CTYPES)
+        for tp in self._CTYPES:
+            self._update_occupancy(tp)
+
+    def _update_occupancy(self, ctype):
+        METRICS.set_gauge('cache.entries.%s' % ctype, len(self.cache[ctype]))
+
+    def _expired(self, ctype, inst_name, now):
+        stamp, cycle = self.stamps[ctype][inst_name]
+        return bool((self.ttl and now - stamp >= self.ttl) or
+                    (self.max_cycles and
+                     self.cycles[ctype] - cycle >= self.max_cycles))
+
+    def start_cycle(self, ctype):
+        """Count a refresh cycle of a type, ages its entries by one."""
+        self.cycles[ctype] += 1
 
     def set(self, ctype, inst_stat):
         """Set or update cache content.
@@ -52,20 +194,322 @@ class CacheData(object):
         @ctype:        cache type.
         @inst_stat:    cache data.
         """
-        self.cache[ctype][inst_stat['nodename']] = inst_stat
+        entries = self.cache[ctype]
+        inst_name = inst_stat['nodename']
+        entries.pop(inst_name, None)
+        entries[inst_name] = inst_stat
+        self.stamps[ctype][inst_name] = (timeutils.utcnow_ts(),
+                                         self.cycles[ctype])
+        while self.max_entries and len(entries) > self.max_entries:
+            evicted, _stat = entries.popitem(last=False)
+            del self.stamps[ctype][evicted]
+            METRICS.incr('cache.evicted.%s' % ctype)
+        self._update_occupancy(ctype)
 
     def get(self, ctype, inst_name):
-        return self.cache[ctype].get(inst_name, None)
+        entries = self.cache[ctype]
+        if inst_name not in entries:
+            return None
+        if self._expired(ctype, inst_name, timeutils.utcnow_ts()):
+            self.delete(ctype, inst_name)
+            METRICS.incr('cache.expired.%s' % ctype)
+            return None
+        # Most recently used entries are at the end
+        inst_stat = entries.pop(inst_name)
+        entries[inst_name] = inst_stat
+        return inst_stat
+
+    def snapshot(self, ctype):
+        """Returns the valid entries of a type, keyed by instance name."""
+        now = timeutils.utcnow_ts()
+        return dict((inst_name, inst_stat)
+                    for inst_name, inst_stat in self.cache[ctype].items()
+                    if not self._expired(ctype, inst_name, now))
 
     def delete(self, ctype, inst_name):
         if inst_name in self.cache[ctype]:
             del self.cache[ctype][inst_name]
+            del self.stamps[ctype][inst_name]
+            self._update_occupancy(ctype)
+
+    def retain(self, instances):
+        """Drop the entries of guests missing from the inventory.
+
+        @instances:    instance name to userid map of the inventory.
+        """
+        for ctype in self._CTYPES:
+            departed = [inst_name for inst_name, inst_stat
+                        in self.cache[ctype].items()
+                        if (instances.get(inst_name) or '').upper() !=
+                        (inst_stat.get('userid') or '').upper()]
+            for inst_name in departed:
+                self.delete(ctype, inst_name)
+            if departed:
+                METRICS.incr('cache.departed.%s' % ctype, len(departed))
 
     def clear(self, ctype='all'):
         if ctype == 'all':
             self._reset()
         else:
-            self.cache[ctype] = {}
+            self.cache[ctype] = collections.OrderedDict()
+            self.stamps[ctype] = {}
+            self._update_occupancy(ctype)
+
+
+class RateLimiter(object):
+    """Token bucket and concurrency cap of one type of xCAT call.
+
+    Callers wait by polling with eventlet.sleep, so green threads and native
+    threads can share a limiter. While callers of a higher priority wait,
+    callers of a lower priority are held back.
+    """
+
+    def __init__(self, rate=0, burst=1, concurrency=0):
+        """
+        @rate:          calls per second, 0 means no limit.
+        @burst:         calls that can be made at once after an idle time.
+        @concurrency:   calls in progress at a time, 0 means no limit.
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.concurrency = concurrency
+        self.tokens = float(self.burst)
+        self.active = 0
+        self.waiting = dict((p, 0) for p in (PRIORITY_BULK, PRIORITY_ADHOC))
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def _take(self, priority, now):
+        """Take a slot, returns None or the seconds to wait before retry."""
+        if self.rate > 0:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+        if any(n for p, n in self.waiting.items() if p < priority):
+            return RATE_LIMIT_POLL_INTERVAL
+        if self.concurrency > 0 and self.active >= self.concurrency:
+            return RATE_LIMIT_POLL_INTERVAL
+        if self.rate > 0:
+            if self.tokens < 1:
+                return max(RATE_LIMIT_POLL_INTERVAL,
+                           (1 - self.tokens) / self.rate)
+            self.tokens -= 1
+        self.active += 1
+        return None
+
+    def acquire(self, priority=PRIORITY_ADHOC):
+        """Wait until a call may be made, returns the seconds waited."""
+        started = time.time()
+        with self._lock:
+            wait = self._take(priority, started)
+            if wait is None:
+                return 0
+            self.waiting[priority] += 1
+        try:
+            while wait is not None:
+                eventlet.sleep(wait)
+                with self._lock:
+                    wait = self._take(priority, time.time())
+        finally:
+            with self._lock:
+                self.waiting[priority] -= 1
+        return time.time() - started
+
+    def try_acquire(self, priority=PRIORITY_ADHOC):
+        """Take a slot if one is free at once, returns whether taken."""
+        with self._lock:
+            return self._take(priority, time.time()) is None
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+
+class XCATEndpoint(object):
+    """Latency and error statistics of one xCAT endpoint.
+
+    An endpoint that failed is left aside for a backoff time doubling with
+    each consecutive failure.
+    """
+
+    # Number of latency samples the p95 is based on.
+    HISTORY = 64
+    # Samples needed before the p95 is trusted.
+    MIN_SAMPLES = 5
+    # Weight of the newest sample in the latency and error averages.
+    ALPHA = 0.2
+    # The score of an endpoint failing all calls is multiplied by this.
+    ERROR_PENALTY = 10
+    BACKOFF = 1.0
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.latencies = collections.deque(maxlen=self.HISTORY)
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.retry_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def record_latency(self, duration):
+        with self._lock:
+            self.latencies.append(duration)
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency = (self.ALPHA * duration +
+                                (1 - self.ALPHA) * self.latency)
+            self.error_rate *= 1 - self.ALPHA
+            self.failures = 0
+            self.retry_at = 0
+        METRICS.set_gauge('xcat_endpoint_latency_ms.%s' % self.name,
+                          int(self.latency * 1000))
+
+    def record_error(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self.error_rate = (self.ALPHA +
+                               (1 - self.ALPHA) * self.error_rate)
+            self.failures += 1
+            self.retry_at = now + min(self.MAX_BACKOFF,
+                                      self.BACKOFF * 2 ** (self.failures - 1))
+        METRICS.incr('xcat_endpoint_errors.%s' % self.name)
+
+    def p95(self):
+        """Returns the 95th percentile latency, None until it is known."""
+        with self._lock:
+            if len(self.latencies) < self.MIN_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * 0.95))]
+
+    def score(self):
+        # An endpoint without samples scores best so that it is tried
+        return (self.latency or 0) * (1 + self.ERROR_PENALTY * self.error_rate)
+
+
+def _parse_endpoint(endpoint, default_port):
+    """Split host[:port] or [ipv6]:port."""
+    host, sep, port = endpoint.strip().rpartition(':')
+    if not sep or not port.isdigit() or (':' in host and
+                                         not host.endswith(']')):
+        return endpoint.strip().strip('[]'), default_port
+    return host.strip('[]'), int(port)
+
+
+def get_endpoints():
+    """Returns the XCATEndpoints, the healthiest and fastest first.
+
+    Endpoints in backoff after a failure come last, soonest retry first.
+    """
+    global _endpoints
+    key = (CONF.zvm.zvm_xcat_server, CONF.zvm.zvm_xcat_port,
+           tuple(CONF.zvm.zvm_xcat_servers))
+    if _endpoints[0] != key:
+        endpoints = [XCATEndpoint(CONF.zvm.zvm_xcat_server,
+                                  CONF.zvm.zvm_xcat_port)]
+        for server in CONF.zvm.zvm_xcat_servers:
+            host, port = _parse_endpoint(server, CONF.zvm.zvm_xcat_port)
+            if all((host, port) != (e.host, e.port) for e in endpoints):
+                endpoints.append(XCATEndpoint(host, port))
+        _endpoints = (key, endpoints)
+    now = time.time()
+    endpoints = _endpoints[1]
+    available = sorted((e for e in endpoints if e.retry_at <= now),
+                       key=lambda e: e.score())
+    backing_off = sorted((e for e in endpoints if e.retry_at > now),
+                         key=lambda e: e.retry_at)
+    return available + backing_off
+
+
+class LogPayload(object):
+    """Log argument that formats and truncates a payload on demand.
+
+    Nothing is formatted unless the record is actually emitted, and at most
+    xcat_log_payload_limit characters of the payload are written.
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        limit = CONF.zvm.xcat_log_payload_limit
+        payload = self.payload
+        if not isinstance(payload, six.string_types):
+            payload = str(payload)
+        if limit and len(payload) > limit:
+            return '%s...(%d more characters)' % (payload[:limit],
+                                                  len(payload) - limit)
+        return payload
+
+
+def _hide_password(url):
+    return url.replace(''.join(('&password=', CONF.zvm.zvm_xcat_password)),
+                       '')
+
+
+def _get_capture_logger():
+    """Returns the logger writing full xCAT payloads, None if disabled."""
+    global _capture_logger
+    if CONF.zvm.xcat_capture_file is None:
+        return None
+    if _capture_logger is None:
+        handler = log_handlers.RotatingFileHandler(
+                        CONF.zvm.xcat_capture_file,
+                        maxBytes=CONF.zvm.xcat_capture_max_bytes,
+                        backupCount=CONF.zvm.xcat_capture_backup_count)
+        handler.setFormatter(std_logging.Formatter('%(asctime)s %(message)s'))
+        capture_logger = std_logging.getLogger(__name__ + '.capture')
+        capture_logger.propagate = False
+        capture_logger.setLevel(std_logging.INFO)
+        capture_logger.addHandler(handler)
+        _capture_logger = capture_logger
+    return _capture_logger
+
+
+class UseridCache(object):
+    """Memoized node name to z/VM userid map.
+
+    Every entry lives for ttl seconds. Nodes that could not be resolved are
+    remembered as None, so an unknown node does not trigger a lookup on
+    each poll.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.userids = {}
+
+    def __contains__(self, node_name):
+        entry = self.userids.get(node_name)
+        return entry is not None and timeutils.utcnow_ts() < entry[1]
+
+    def get(self, node_name):
+        if node_name in self:
+            return self.userids[node_name][0]
+        return None
+
+    def update(self, userids, missing=()):
+        """Memoize a node to userid map.
+
+        @userids:      node to userid map.
+        @missing:      node names that have no userid.
+        """
+        expiration = timeutils.utcnow_ts() + self.ttl
+        for node_name in missing:
+            if node_name not in userids:
+                self.userids[node_name] = (None, expiration)
+        for node_name, userid in userids.items():
+            self.userids[node_name] = (userid, expiration)
+
+    def clear(self):
+        self.userids = {}
 
 
 class XCATUrl(object):
@@ -125,7 +569,11 @@ class HTTPSClientAuthConnection(httplib.HTTPSConnection):
             self.use_ca = False
 
     def connect(self):
-        sock = socket.create_connection((self.host, self.port), self.timeout)
+        # Green sockets let other green threads of the agent run while a
+        # request waits for the xCAT MN, whether or not the agent process
+        # monkey patched the socket and ssl modules.
+        sock = green_socket.create_connection((self.host, self.port),
+                                              self.timeout)
         if self._tunnel_host:
             self.sock = sock
             self._tunnel()
@@ -137,24 +585,38 @@ class HTTPSClientAuthConnection(httplib.HTTPSConnection):
             self.use_ca = False
 
         if not self.use_ca:
-            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file,
-                                        cert_reqs=ssl.CERT_NONE)
+            self.sock = green_ssl.wrap_socket(sock, self.key_file,
+                                              self.cert_file,
+                                              cert_reqs=ssl.CERT_NONE)
         else:
-            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file,
-                                        ca_certs=self.ca_file,
-                                        cert_reqs=ssl.CERT_REQUIRED)
+            self.sock = green_ssl.wrap_socket(sock, self.key_file,
+                                              self.cert_file,
+                                              ca_certs=self.ca_file,
+                                              cert_reqs=ssl.CERT_REQUIRED)
 
 
 class XCATConnection(object):
     """Https requests to xCAT web service."""
 
-    def __init__(self):
-        """Initialize https connection to xCAT service."""
-        self.host = CONF.zvm.zvm_xcat_server
-        self.port = 443
+    def __init__(self, endpoint=None):
+        """Initialize https connection to xCAT service.
+
+        @endpoint:     XCATEndpoint to connect to, zvm_xcat_server by
+                       default.
+        """
+        if endpoint is None:
+            self.host = CONF.zvm.zvm_xcat_server
+            self.port = CONF.zvm.zvm_xcat_port
+        else:
+            self.host = endpoint.host
+            self.port = endpoint.port
+        timeout = CONF.zvm.zvm_xcat_connection_timeout
+        remaining = remaining_time()
+        if remaining is not None:
+            # Leave the call no more time than the collection has left
+            timeout = max(0.1, min(timeout, remaining))
         self.conn = HTTPSClientAuthConnection(self.host, self.port,
-                        CONF.zvm.zvm_xcat_ca_file,
-                        timeout=CONF.zvm.zvm_xcat_connection_timeout)
+                        CONF.zvm.zvm_xcat_ca_file, timeout=timeout)
 
     def request(self, method, url, body=None, headers={}):
         """Send https request to xCAT server.
@@ -169,21 +631,26 @@ class XCATConnection(object):
             body = jsonutils.dumps(body)
             headers = {'content-type': 'text/plain',
                        'content-length': len(body)}
-
-        _rep_ptn = ''.join(('&password=', CONF.zvm.zvm_xcat_password))
-        LOG.debug("Sending request to xCAT. xCAT-Server:%(xcat_server)s "
-                  "Request-method:%(method)s "
-                  "URL:%(url)s "
-                  "Headers:%(headers)s "
-                  "Body:%(body)s" %
-                  {'xcat_server': CONF.zvm.zvm_xcat_server,
-                   'method': method,
-                   'url': url.replace(_rep_ptn, ''),  # hide password in log
-                   'headers': str(headers),
-                   'body': body})
+        if CONF.zvm.xcat_compression:
+            headers = dict(headers)
+            headers['accept-encoding'] = ACCEPT_ENCODING
+
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        if debug:
+            LOG.debug("Sending request to xCAT. xCAT-Server:%(xcat_server)s "
+                      "Request-method:%(method)s "
+                      "URL:%(url)s "
+                      "Headers:%(headers)s "
+                      "Body:%(body)s",
+                      {'xcat_server': self.host,
+                       'method': method,
+                       'url': _hide_password(url),
+                       'headers': headers,
+                       'body': LogPayload(body)})
 
         try:
-            self.conn.request(method, url, body, headers)
+            with tracing.span('xcat.send', cat='xcat', host=self.host):
+                self.conn.request(method, url, body, headers)
         except socket.gaierror as err:
             msg = (_("Failed to connect xCAT server %(srv)s: %(err)s") %
                    {'srv': self.host, 'err': err})
@@ -194,19 +661,38 @@ class XCATConnection(object):
             raise ZVMException(msg)
 
         try:
-            res = self.conn.getresponse()
+            with tracing.span('xcat.wait', cat='xcat'):
+                res = self.conn.getresponse()
         except Exception as err:
             msg = (_("Failed to get response from xCAT server %(srv)s: "
                      "%(err)s") % {'srv': self.host, 'err': err})
             raise ZVMException(msg)
 
-        msg = res.read()
+        try:
+            with tracing.span('xcat.read', cat='xcat') as span:
+                msg = _read_body(res)
+                span.set(chars=len(msg))
+        except (socket.error, socket.timeout, zlib.error) as err:
+            msg = (_("Failed to read response from xCAT server %(srv)s: "
+                     "%(err)s") % {'srv': self.host, 'err': err})
+            raise ZVMException(msg)
         resp = {
             'status': res.status,
             'reason': res.reason,
             'message': msg}
 
-        LOG.debug("xCAT response: %s" % str(resp))
+        if debug:
+            LOG.debug("xCAT response: status:%(status)s reason:%(reason)s "
+                      "message:%(message)s",
+                      {'status': res.status, 'reason': res.reason,
+                       'message': LogPayload(msg)})
+        capture = _get_capture_logger()
+        if capture is not None:
+            capture.info("%(method)s %(url)s %(body)s\n%(status)s "
+                         "%(reason)s %(message)s",
+                         {'method': method, 'url': _hide_password(url),
+                          'body': body, 'status': res.status,
+                          'reason': res.reason, 'message': msg})
 
         # Only "200" or "201" returned from xCAT can be considered
         # as good status
@@ -226,10 +712,276 @@ class XCATConnection(object):
         return resp
 
 
-def xcat_request(method, url, body=None, headers={}):
-    conn = XCATConnection()
-    resp = conn.request(method, url, body, headers)
-    return load_xcat_resp(resp['message'])
+def _content_encoding(res):
+    getheader = getattr(res, 'getheader', None)
+    if getheader is None:
+        return None
+    encoding = getheader('content-encoding')
+    if not isinstance(encoding, six.string_types):
+        return None
+    encoding = encoding.strip().lower()
+    return encoding if encoding in _DECODERS else None
+
+
+def _readinto(res, view):
+    if hasattr(res, 'readinto'):
+        return res.readinto(view)
+    chunk = res.read(len(view))
+    view[:len(chunk)] = chunk
+    return len(chunk)
+
+
+def _read_body(res):
+    """Read a response body into the reusable buffer of this thread.
+
+    The body is read into the buffer, growing it one chunk at a time, and
+    decoded once. A gzip or deflate body is decompressed chunk by chunk as
+    it is read. The buffer is only kept for the next request when it is
+    at most READ_BUFFER_KEEP bytes.
+    """
+    buf = getattr(_read_buffers, 'buf', None)
+    if buf is None:
+        buf = _read_buffers.buf = bytearray(READ_CHUNK_SIZE)
+
+    try:
+        encoding = _content_encoding(res)
+        if encoding is not None:
+            size = _read_compressed(res, buf, encoding)
+            return codecs.utf_8_decode(memoryview(buf)[:size])[0]
+
+        size = 0
+        chunk = None
+        while True:
+            if size < len(buf):
+                view = memoryview(buf)[size:]
+                count = _readinto(res, view)
+                del view
+            else:
+                if chunk is None:
+                    chunk = bytearray(READ_CHUNK_SIZE)
+                view = memoryview(chunk)
+                count = _readinto(res, view)
+                buf += view[:count]
+                del view
+            if not count:
+                break
+            size += count
+            # yield to other green threads between chunks of a long body
+            eventlet.sleep(0)
+
+        METRICS.incr('xcat_bytes.identity', size)
+        return codecs.utf_8_decode(memoryview(buf)[:size])[0]
+    finally:
+        if len(buf) > READ_BUFFER_KEEP:
+            _read_buffers.buf = None
+
+
+def _read_compressed(res, buf, encoding):
+    """Decompress a response body into buf, returns the decoded size."""
+    decomp = zlib.decompressobj(_DECODERS[encoding])
+    size = received = 0
+    while True:
+        chunk = res.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        try:
+            data = decomp.decompress(chunk)
+        except zlib.error:
+            # Some servers send a raw deflate stream without the zlib
+            # header, which is only known from its first bytes.
+            if encoding != 'deflate' or received:
+                raise
+            decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = decomp.decompress(chunk)
+        received += len(chunk)
+        buf[size:size + len(data)] = data
+        size += len(data)
+        eventlet.sleep(0)
+    data = decomp.flush()
+    buf[size:size + len(data)] = data
+    size += len(data)
+
+    METRICS.incr('xcat_bytes.compressed', received)
+    METRICS.incr('xcat_bytes.uncompressed', size)
+    return size
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """Set the priority of the xCAT calls made by the current thread."""
+    previous = current_request_priority()
+    _request_context.priority = priority
+    try:
+        yield
+    finally:
+        _request_context.priority = previous
+
+
+def current_request_priority():
+    return getattr(_request_context, 'priority', PRIORITY_ADHOC)
+
+
+@contextlib.contextmanager
+def request_deadline(deadline):
+    """Set the time by which the xCAT calls of the current thread must end.
+
+    @deadline:     absolute time, None keeps the current deadline. A
+                   deadline later than the current one is ignored.
+    """
+    previous = current_request_deadline()
+    if deadline is not None and previous is not None:
+        deadline = min(deadline, previous)
+    _request_context.deadline = deadline if deadline is not None else previous
+    try:
+        yield
+    finally:
+        _request_context.deadline = previous
+
+
+def current_request_deadline():
+    return getattr(_request_context, 'deadline', None)
+
+
+def remaining_time():
+    """Seconds left before the current deadline, None without deadline."""
+    deadline = current_request_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def _check_deadline(url):
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        msg = (_("Deadline of the collection passed before xCAT request "
+                 "%s") % _hide_password(url))
+        raise ZVMDeadlineExceeded(msg)
+
+
+def _get_rate_limiter(call_type):
+    limiter = _rate_limiters.get(call_type)
+    if limiter is None:
+        limiter = RateLimiter(
+                    getattr(CONF.zvm, 'xcat_%s_rate' % call_type),
+                    getattr(CONF.zvm, 'xcat_%s_burst' % call_type),
+                    getattr(CONF.zvm, 'xcat_%s_concurrency' % call_type))
+        _rate_limiters[call_type] = limiter
+    return limiter
+
+
+def xcat_request(method, url, body=None, headers={}, call_type='read'):
+    """Send a request to xCAT within the budget of its call type.
+
+    @call_type:    'xdsh' for commands run on a node, 'read' for table and
+                   node reads.
+    """
+    _check_deadline(url)
+    with tracing.span('xcat_request', cat='xcat', call_type=call_type,
+                      method=method, url=url.partition('?')[0]):
+        limiter = _get_rate_limiter(call_type)
+        with tracing.span('xcat.queue', cat='xcat'):
+            delay = limiter.acquire(current_request_priority())
+        METRICS.incr('xcat_requests.%s' % call_type)
+        if delay:
+            METRICS.incr('xcat_queued.%s' % call_type)
+            METRICS.incr('xcat_queue_delay_ms.%s' % call_type,
+                         int(delay * 1000))
+        try:
+            _check_deadline(url)
+            endpoints = get_endpoints()
+            if (CONF.zvm.xcat_hedge_reads and call_type == 'read' and
+                    method == 'GET' and len(endpoints) > 1):
+                resp = _hedged_request(endpoints[:2], method, url, body,
+                                       headers, limiter)
+            else:
+                resp = _endpoint_request(endpoints[0], method, url, body,
+                                         headers)
+        except ZVMException as err:
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                raise ZVMDeadlineExceeded(six.text_type(err))
+            raise
+        finally:
+            limiter.release()
+        with tracing.span('xcat.load', cat='xcat',
+                          chars=len(resp['message'])):
+            return load_xcat_resp(resp['message'])
+
+
+def _endpoint_request(endpoint, method, url, body, headers):
+    started = time.time()
+    try:
+        resp = XCATConnection(endpoint).request(method, url, body, headers)
+    except ZVMException:
+        endpoint.record_error()
+        raise
+    except greenlet.GreenletExit:
+        # Cancelled by a faster hedged request, it took at least that long
+        endpoint.record_latency(time.time() - started)
+        raise
+    endpoint.record_latency(time.time() - started)
+    return resp
+
+
+def _hedged_request(endpoints, method, url, body, headers, limiter):
+    """Send an idempotent request to the first endpoint, and to the second
+    one as well when the first fails or is slower than its p95 latency.
+
+    The caller holds a slot of limiter for the first request. The hedged
+    second request takes another one, and is not sent when none is free.
+    Returns the first successful response, the other request is cancelled.
+    """
+    primary, secondary = endpoints
+    priority = current_request_priority()
+    deadline = current_request_deadline()
+    results = green_queue.LightQueue()
+    hedge_slot = False
+
+    def _send(endpoint):
+        with request_priority(priority), request_deadline(deadline):
+            try:
+                resp = _endpoint_request(endpoint, method, url, body,
+                                         headers)
+            except ZVMException as err:
+                results.put((endpoint, None, err))
+            else:
+                results.put((endpoint, resp, None))
+
+    threads = [eventlet.spawn(_send, primary)]
+    try:
+        try:
+            first = results.get(timeout=primary.p95())
+        except green_queue.Empty:
+            first = None
+        if first is not None and first[2] is None:
+            return first[1]
+        if first is None:
+            hedge_slot = limiter.try_acquire(priority)
+            if not hedge_slot:
+                METRICS.incr('xcat_hedge_skipped')
+                endpoint, resp, err = results.get()
+                if err is None:
+                    return resp
+                first = (endpoint, resp, err)
+
+        METRICS.incr('xcat_hedged' if first is None else 'xcat_failover')
+        threads.append(eventlet.spawn(_send, secondary))
+        pending = 2 if first is None else 1
+        error = None if first is None else first[2]
+        while pending:
+            endpoint, resp, err = results.get()
+            pending -= 1
+            if err is None:
+                if endpoint is secondary:
+                    METRICS.incr('xcat_hedge_wins')
+                return resp
+            error = err
+        raise error
+    finally:
+        for thread in threads:
+            thread.kill()
+        if hedge_slot:
+            limiter.release()
 
 
 def jsonloads(jsonstr):
@@ -246,12 +998,36 @@ def expect_invalid_xcat_resp_data():
     """Catch exceptions when using xCAT response data."""
     try:
         yield
-    except (ValueError, TypeError, IndexError, AttributeError,
-            KeyError) as err:
+    except INVALID_RESP_DATA_ERRORS as err:
         msg = _("Invalid xCAT response data: %s") % str(err)
         raise ZVMException(msg)
 
 
+def skip_invalid_record(rtype, record_id, err=None):
+    """Log and count a malformed record dropped from a batch response."""
+    METRICS.incr('invalid_records.%s' % rtype)
+    LOG.warning(_LW("Skipped invalid %(rtype)s record of %(id)s in xCAT "
+                    "response: %(err)s"),
+                {'rtype': rtype, 'id': record_id, 'err': err})
+
+
+def parse_extra_fields(record_id, items):
+    """Parse ipq_extra_fields (field, value) pairs into integers.
+
+    A malformed value only drops its own field, so the record keeps its
+    base stats and the other extra fields.
+    """
+    extra = {}
+    for key, value in items:
+        try:
+            extra[key] = int(value.strip(' "').partition(' ')[0])
+        except INVALID_RESP_DATA_ERRORS as err:
+            METRICS.incr('invalid_fields.%s' % key)
+            LOG.debug("Skipped invalid %(key)s field of %(id)s: %(err)s",
+                      {'key': key, 'id': record_id, 'err': err})
+    return extra
+
+
 def wrap_invalid_xcat_resp_data_error(function):
     """Catch exceptions when using xCAT response data."""
 
@@ -259,8 +1035,7 @@ def wrap_invalid_xcat_resp_data_error(function):
     def decorated_function(*arg, **kwargs):
         try:
             return function(*arg, **kwargs)
-        except (ValueError, TypeError, IndexError, AttributeError,
-                KeyError) as err:
+        except INVALID_RESP_DATA_ERRORS as err:
             msg = _("Invalid xCAT response data: %s") % str(err)
             raise ZVMException(msg)
 
@@ -296,8 +1071,11 @@ def load_xcat_resp(message):
 
     for d in resp_list:
         for k in keys:
-            if d.get(k) is not None:
-                resp[k].append(d.get(k))
+            v = d.get(k)
+            if v is not None:
+                resp[k].append(v)
+                if k in ('info', 'node', 'data'):
+                    _log_warnings(v)
 
     err = resp.get('error')
     if err != []:
@@ -308,16 +1086,20 @@ def load_xcat_resp(message):
             else:
                 raise ZVMException(message)
 
-    _log_warnings(resp)
-
     return resp
 
 
-def _log_warnings(resp):
-    for msg in (resp['info'], resp['node'], resp['data']):
-        msgstr = str(msg)
-        if 'warn' in msgstr.lower():
-            LOG.warning(_("Warning from xCAT: %s") % msgstr)
+def _log_warnings(msg):
+    """Log the lines of an xCAT message that carry a warning."""
+    if isinstance(msg, six.string_types):
+        for m in _WARNING_PTN.finditer(msg):
+            start = msg.rfind('\n', 0, m.start()) + 1
+            end = msg.find('\n', m.end())
+            LOG.warning(_("Warning from xCAT: %s") %
+                        msg[start:end if end != -1 else len(msg)])
+    elif isinstance(msg, (list, tuple)):
+        for m in msg:
+            _log_warnings(m)
 
 
 def _is_warning(err_str):
@@ -345,9 +1127,36 @@ def get_userid(node_name):
                 return s.strip().rpartition('=')[2]
 
 
-def xdsh(node, commands):
-    """"Run command on xCAT node."""
-    LOG.debug('Run command %(cmd)s on xCAT node %(node)s' %
+def get_userids(node_names=None):
+    """Returns a node to z/VM userid map for a list of xCAT nodes.
+
+    All nodes are resolved from a single dump of the xCAT zvm table, if
+    node_names is None every node in the table is returned.
+    """
+    url = XCATUrl().tabdump("/zvm")
+    res_dict = xcat_request("GET", url)
+
+    if node_names is not None:
+        node_names = set(node_names)
+
+    userids = {}
+    for node, hcp, userid in _parse_zvm_table(res_dict):
+        if userid and (node_names is None or node in node_names):
+            userids[node] = userid.upper()
+
+    return userids
+
+
+def xdsh(node, commands, long_running=False):
+    """"Run command on xCAT node.
+
+    @long_running: the command may run for minutes, it is run in the
+                   background when xdsh_async is set.
+    """
+    if long_running and CONF.zvm.xdsh_async:
+        return xdsh_async(node, commands)
+
+    LOG.debug('Run command %(cmd)s on xCAT node %(node)s',
               {'cmd': commands, 'node': node})
 
     def xdsh_execute(node, commands):
@@ -357,13 +1166,122 @@ def xdsh(node, commands):
         opt = 'options=-q'
         body = [xdsh_commands, opt]
         url = XCATUrl().xdsh('/' + node)
-        return xcat_request("PUT", url, body)
+        return xcat_request("PUT", url, body, call_type='xdsh')
 
     res_dict = xdsh_execute(node, commands)
 
     return res_dict
 
 
+XDSH_JOB_PREFIX = 'zvmjob-'
+XDSH_JOB_RC = 'ZVMJOB-RC='
+XDSH_JOB_PENDING = 'ZVMJOB-PENDING'
+XDSH_JOB_LOST = 'ZVMJOB-LOST'
+# Minutes after which the files of an abandoned job are removed.
+XDSH_JOB_MAX_AGE = 60
+
+
+def xdsh_async(node, commands):
+    """Run command on xCAT node in the background and poll for its output.
+
+    The command writes its output to a spool file on the node. Each poll is
+    a short xdsh call that returns the output and removes the files once
+    the command ended, so no xCAT request is held open while it runs. A
+    failed poll is retried until the job times out.
+    Returns the same response as xdsh.
+    """
+    job = '%s%d-%s' % (XDSH_JOB_PREFIX, os.getpid(), uuid.uuid4().hex[:12])
+    path = '%s/%s' % (CONF.zvm.xdsh_spool_dir, job)
+    LOG.debug('Submit command %(cmd)s as job %(job)s on xCAT node %(node)s',
+              {'cmd': commands, 'job': job, 'node': node})
+    script = base64.b64encode(commands.encode('utf-8')).decode('ascii')
+    xdsh(node, 'mkdir -p %(dir)s && '
+               '(find %(dir)s -name "%(prefix)s*" -mmin +%(age)d '
+               '-exec rm -f {} + ; '
+               'echo %(script)s | base64 -d > %(path)s.sh || exit 1; '
+               'nohup sh -c "sh %(path)s.sh > %(path)s.out 2>&1; '
+               'echo \\$? > %(path)s.tmp; mv %(path)s.tmp %(path)s.rc" '
+               '> /dev/null 2>&1 < /dev/null & echo $! > %(path)s.pid)' %
+               {'dir': CONF.zvm.xdsh_spool_dir, 'prefix': XDSH_JOB_PREFIX,
+                'age': XDSH_JOB_MAX_AGE, 'script': script, 'path': path})
+    METRICS.incr('xdsh_jobs')
+
+    # A job whose files are all gone was collected by a poll whose
+    # response got lost, it is reported as lost rather than pending.
+    poll = ('if test -f %(path)s.rc; then echo "%(rc)s$(cat %(path)s.rc)"; '
+            'cat %(path)s.out; rm -f %(path)s.*; '
+            'elif test -f %(path)s.pid; then echo %(pending)s; '
+            'else echo %(lost)s; fi' %
+            {'path': path, 'rc': XDSH_JOB_RC, 'pending': XDSH_JOB_PENDING,
+             'lost': XDSH_JOB_LOST})
+    timeout = time.time() + CONF.zvm.xdsh_job_timeout
+    try:
+        while True:
+            eventlet.sleep(CONF.zvm.xdsh_poll_interval)
+            try:
+                resp = xdsh(node, poll)
+            except ZVMDeadlineExceeded:
+                raise
+            except ZVMException as err:
+                if time.time() > timeout:
+                    raise
+                METRICS.incr('xdsh_job_poll_errors')
+                LOG.warning(_LW("Failed to poll job %(job)s on xCAT node "
+                                "%(node)s, retrying: %(err)s"),
+                            {'job': job, 'node': node, 'err': err})
+                continue
+            METRICS.incr('xdsh_job_polls')
+            with expect_invalid_xcat_resp_data():
+                rc = _pop_job_status(resp['data'][0])
+            if rc is not None:
+                break
+            if time.time() > timeout:
+                msg = (_("Job %(job)s did not end within %(timeout)s "
+                         "seconds on xCAT node %(node)s") %
+                       {'job': job, 'timeout': CONF.zvm.xdsh_job_timeout,
+                        'node': node})
+                raise ZVMException(msg)
+    except ZVMException:
+        _kill_job(node, path)
+        raise
+
+    if rc != 0:
+        msg = (_("Job %(job)s on xCAT node %(node)s ended with rc %(rc)s: "
+                 "%(out)s") % {'job': job, 'node': node, 'rc': rc,
+                               'out': LogPayload(resp['data'][0])})
+        raise ZVMException(msg)
+    return resp
+
+
+def _pop_job_status(chunks):
+    """Remove the status line of a job poll, returns the job rc or None."""
+    line, sep, rest = chunks[0].partition('\n')
+    status = line.partition(': ')[2].strip()
+    if status == XDSH_JOB_PENDING:
+        return None
+    if not status.startswith(XDSH_JOB_RC):
+        raise ValueError('Unexpected job status %r' % line)
+    if rest:
+        chunks[0] = rest
+    else:
+        del chunks[0]
+    return int(status[len(XDSH_JOB_RC):])
+
+
+def _kill_job(node, path):
+    # Nothing can be done on failure, the leftover files are removed by
+    # the next submit once they are old enough
+    if remaining_time() is not None and remaining_time() <= 0:
+        return
+    try:
+        xdsh(node, 'test -f %(path)s.pid && pkill -P $(cat %(path)s.pid); '
+                   'test -f %(path)s.pid && kill $(cat %(path)s.pid); '
+                   'rm -f %(path)s.*' % {'path': path})
+    except ZVMException as err:
+        LOG.warning(_LW("Failed to kill the xdsh job %(path)s: %(err)s"),
+                    {'path': path, 'err': err})
+
+
 def get_node_hostname(node_name):
     addp = '&col=node&value=%s&attribute=hostnames' % node_name
     url = XCATUrl().gettab("/hosts", addp)
@@ -374,55 +1292,404 @@ def get_node_hostname(node_name):
 def list_instances(hcp_info):
     zvm_host = CONF.zvm.zvm_host
 
-    url = XCATUrl().tabdump("/zvm")
-    res_dict = xcat_request("GET", url)
+    with tracing.span('list_instances', cat='inventory') as span:
+        url = XCATUrl().tabdump("/zvm")
+        res_dict = xcat_request("GET", url)
 
-    instances = {}
-
-    with expect_invalid_xcat_resp_data():
-        data_entries = res_dict['data'][0][1:]
-        for data in data_entries:
-            l = data.split(",")
-            node = l[0].strip("\"")
-            hcp = l[1].strip("\"")
-            userid = l[2].strip("\"")
+        instances = {}
 
+        for node, hcp, userid in _parse_zvm_table(res_dict):
             # zvm host and zhcp are not included in the list
             if (hcp.upper() == hcp_info['hostname'].upper() and
                     node.upper() not in (zvm_host.upper(),
                     hcp_info['nodename'].upper(),
                     CONF.zvm.zvm_xcat_master.upper())):
                 instances[node] = userid.upper()
+        span.set(guests=len(instances))
 
     return instances
 
 
+def _parse_zvm_table(res_dict):
+    """Returns (node, hcp, userid) of each row of a zvm table dump."""
+    rows = []
+    with expect_invalid_xcat_resp_data():
+        data_entries = res_dict['data'][0][1:]
+        for data in data_entries:
+            l = data.split(",")
+            rows.append((l[0].strip("\""), l[1].strip("\""),
+                         l[2].strip("\"")))
+
+    return rows
+
+
 def image_performance_query(zhcp_node, inst_list):
     cmd = ('smcli Image_Performance_Query -T "%(inst_list)s" -c %(num)s' %
            {'inst_list': " ".join(inst_list), 'num': len(inst_list)})
 
+    extra_fields = tuple(f for f in CONF.zvm.ipq_extra_fields
+                         if f in IPQ_EXTRA_KWS)
+    parser = functools.partial(_parse_image_performance_query,
+                               extra_fields=extra_fields)
     with expect_invalid_xcat_resp_data():
-        resp = xdsh(zhcp_node, cmd)
-        raw_data = resp["data"][0][0]
-
-    ipq_kws = {
-        'userid': "Guest name:",
-        'guest_cpus': "Guest CPUs:",
-        'used_cpu_time': "Used CPU time:",
-        'used_memory': "Used memory:",
-    }
-
+        resp = xdsh(zhcp_node, cmd, long_running=True)
+        raw_data = resp["data"][0]
+        return parse_xdsh_output(parser, raw_data)
+
+
+IPQ_KWS = {
+    'userid': "Guest name:",
+    'guest_cpus': "Guest CPUs:",
+    'used_cpu_time': "Used CPU time:",
+    'used_memory': "Used memory:",
+}
+
+# Other fields of the Image_Performance_Query output that can be kept with
+# the ipq_extra_fields option.
+IPQ_EXTRA_KWS = {
+    'elapsed_time': "Elapsed time:",
+    'min_memory': "Minimum memory:",
+    'max_memory': "Max memory:",
+    'shared_memory': "Shared memory:",
+    'active_cpus': "Active CPUs in CEC:",
+    'logical_cpus': "Logical CPUs in VM:",
+    'min_cpu_count': "Minimum CPU count:",
+    'max_cpu_limit': "Max CPU limit:",
+    'processor_share': "Processor share:",
+    'samples_cpu_in_use': "Samples CPU in use:",
+    'samples_cpu_delay': "Samples CPU delay:",
+    'samples_page_wait': "Samples page wait:",
+    'samples_idle': "Samples idle:",
+    'samples_other': "Samples other:",
+    'total_samples': "Total samples:",
+}
+
+
+def _parse_image_performance_query(lines, extra_fields=()):
+    """Parse Image_Performance_Query output into a userid to record map.
+
+    Each record starts at its "Guest name:" line, so a truncated or garbled
+    record is dropped without losing the records around it. The
+    extra_fields are kept when present, they are not required.
+    """
     pi_dict = {}
-    with expect_invalid_xcat_resp_data():
-        rpi_list = raw_data.split("".join((zhcp_node, ": \n")))
-        for rpi in rpi_list:
-            pi = translate_xcat_resp(rpi, ipq_kws)
-            if pi.get('userid') is not None:
-                pi_dict[pi['userid']] = pi
+    kws = list(IPQ_KWS.items()) + [(f, IPQ_EXTRA_KWS[f])
+                                   for f in extra_fields]
+
+    def _finish(pi):
+        if pi is None:
+            return
+        missing = set(IPQ_KWS) - set(pi)
+        if missing:
+            skip_invalid_record('cpumem', pi.get('userid'),
+                                'missing %s' % ', '.join(sorted(missing)))
+        else:
+            pi_dict[pi['userid']] = pi
+
+    pi = None
+    for ls in lines:
+        for k, kw in kws:
+            idx = ls.find(kw)
+            if idx == -1:
+                continue
+            if k == 'userid':
+                _finish(pi)
+                pi = {}
+            if pi is not None:
+                pi[k] = ls[idx + len(kw):].strip(' "')
+            break
+    _finish(pi)
 
     return pi_dict
 
 
+def _write_frame(pipe, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    pipe.write(_FRAME_HEADER.pack(len(data)))
+    pipe.write(data)
+    pipe.flush()
+
+
+def _read_exactly(pipe, size):
+    chunks = []
+    while size:
+        chunk = pipe.read(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _read_frame(pipe):
+    """Returns the next object sent over pipe, None at end of file."""
+    header = _read_exactly(pipe, _FRAME_HEADER.size)
+    if header is None:
+        return None
+    data = _read_exactly(pipe, _FRAME_HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+class _ParseWorker(object):
+    """A parse worker process and the green pipes to talk to it."""
+
+    def __init__(self):
+        child_in, job_out = os.pipe()
+        result_in, child_out = os.pipe()
+        # The directory holding ceilometer_zvm, the workers import it.
+        pkg_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                               *[os.pardir] * 4))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+                    p for p in (pkg_dir, env.get('PYTHONPATH')) if p)
+        try:
+            self.proc = subprocess.Popen(PARSE_WORKER_CMD, stdin=child_in,
+                                         stdout=child_out, close_fds=True,
+                                         env=env)
+        except Exception:
+            os.close(job_out)
+            os.close(result_in)
+            raise
+        finally:
+            os.close(child_in)
+            os.close(child_out)
+        self.jobs = greenio.GreenPipe(job_out, 'wb')
+        self.results = greenio.GreenPipe(result_in, 'rb')
+
+    def call(self, func, *args):
+        """Returns (True, result) of func(*args), or (False, exception)."""
+        _write_frame(self.jobs, (func, args))
+        reply = _read_frame(self.results)
+        if reply is None:
+            raise ZVMException(_("Parse worker %d exited") % self.proc.pid)
+        return reply
+
+    def stop(self):
+        for pipe in (self.jobs, self.results):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+
+class _ParsePool(object):
+    """Worker processes that parse large smcli outputs.
+
+    The workers are fresh python interpreters rather than forks of the
+    agent, so they inherit neither the eventlet hub nor monkey patched
+    modules. Jobs and results are pickled over pipes that the calling green
+    thread reads as green pipes, no helper thread is involved. Workers are
+    started on first use, one that fails or is interrupted mid job is
+    replaced.
+    """
+
+    def __init__(self, size):
+        self.workers = []
+        self.idle = green_queue.LightQueue()
+        for i in range(size):
+            self.idle.put(None)
+
+    def apply(self, func, *args):
+        worker = self.idle.get()
+        done = False
+        try:
+            if worker is None:
+                worker = _ParseWorker()
+                self.workers.append(worker)
+            ok, result = worker.call(func, *args)
+            done = True
+        finally:
+            if not done and worker is not None:
+                self.workers.remove(worker)
+                worker.stop()
+                worker = None
+            self.idle.put(worker)
+        if not ok:
+            raise result
+        return result
+
+    def stop(self):
+        while self.workers:
+            self.workers.pop().stop()
+
+
+def _parse_worker_main():
+    """Serve the jobs of a _ParsePool read from stdin until end of file."""
+    jobs = os.fdopen(os.dup(0), 'rb')
+    results = os.fdopen(os.dup(1), 'wb')
+    # stray prints must not mix with the results
+    os.dup2(2, 1)
+    while True:
+        job = _read_frame(jobs)
+        if job is None:
+            return
+        func, args = job
+        try:
+            reply = (True, func(*args))
+        except Exception as err:
+            reply = (False, err)
+        try:
+            _write_frame(results, reply)
+        except (pickle.PicklingError, TypeError, AttributeError) as err:
+            msg = str(err) if reply[0] else str(reply[1])
+            _write_frame(results, (False, ZVMException(msg)))
+
+
+def _get_parse_pool():
+    global _parse_pool
+    if _parse_pool is None and CONF.zvm.parse_workers > 0:
+        _parse_pool = _ParsePool(CONF.zvm.parse_workers)
+    return _parse_pool
+
+
+def stop_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.stop()
+        _parse_pool = None
+
+
+def _parse_in_worker(parser, raw_data):
+    METRICS.clear()
+    return parser(iter_lines(raw_data)), METRICS.snapshot()
+
+
+def parse_xdsh_output(parser, raw_data):
+    """Run an smcli output parser over the data of an xdsh response.
+
+    Outputs of parse_offload_threshold characters or more are parsed in the
+    worker process pool when parse_workers is set. The calling green thread
+    waits on a green pipe while the job runs, so other green threads keep
+    being served.
+    """
+    if isinstance(raw_data, six.string_types):
+        size = len(raw_data)
+    else:
+        size = sum(len(chunk) for chunk in raw_data if chunk)
+    name = getattr(parser, 'func', parser).__name__.lstrip('_')
+    with tracing.span(name, cat='parse', chars=size) as span:
+        pool = _get_parse_pool()
+        if pool is not None and size >= CONF.zvm.parse_offload_threshold:
+            span.set(offloaded=True)
+            result, counters = pool.apply(_parse_in_worker, parser, raw_data)
+            for name, value in counters.items():
+                METRICS.incr(name, value)
+        else:
+            result = parser(iter_lines(raw_data))
+    return result
+
+
+def iter_lines(data):
+    """Iterate over the lines of xdsh output.
+
+    data is one output string or a list of them, as returned in the data
+    element of an xdsh response. Each string ends a line and None entries
+    are skipped. The output is never joined or split as a whole.
+    """
+    if isinstance(data, six.string_types):
+        data = [data]
+    for chunk in data:
+        if chunk is None:
+            continue
+        start = 0
+        end = chunk.find('\n')
+        while end != -1:
+            yield chunk[start:end]
+            start = end + 1
+            end = chunk.find('\n', start)
+        if start < len(chunk):
+            yield chunk[start:]
+
+
+def _zhcp_helper_source():
+    """Returns the helper source and its versioned path on the zHCP."""
+    with open(ZHCP_HELPER_FILE, 'rb') as f:
+        source = f.read()
+    digest = hashlib.sha1(source).hexdigest()[:12]
+    path = os.path.join(CONF.zvm.zhcp_helper_dir,
+                        'ceilometer_zvm_helper_%s.py' % digest)
+    return source, path
+
+
+def deploy_zhcp_helper(zhcp_node):
+    """Copy the stats aggregation helper to the zHCP if it is missing.
+
+    The file name carries a digest of the helper source, so an upgraded
+    plugin deploys its own version next to the old one.
+    """
+    source, path = _zhcp_helper_source()
+    cmd = ('test -f %(path)s || (mkdir -p %(dir)s && '
+           'echo %(src)s | base64 -d > %(path)s.tmp && '
+           'mv %(path)s.tmp %(path)s)' %
+           {'path': path, 'dir': CONF.zvm.zhcp_helper_dir,
+            'src': base64.b64encode(source).decode('ascii')})
+    xdsh(zhcp_node, cmd)
+    return path
+
+
+def zhcp_helper_query(zhcp_node, helper_path, meter, userids,
+                      vswitches=()):
+    """Collect stats of a meter for a list of userids with the helper.
+
+    Returns {'cpumem': {userid: (guest_cpus, used_cpu_time_us,
+    used_memory_kb, extra)}, 'vnics': {userid: [nic_entry, ...]}}, extra
+    holding the ipq_extra_fields found.
+    """
+    args = ['--meter', meter, '--target', zhcp_node]
+    for vsw in vswitches:
+        args.extend(['--vswitch', vsw])
+    for field in CONF.zvm.ipq_extra_fields:
+        if field in IPQ_EXTRA_KWS:
+            args.extend(['--extra', field])
+    cmd = '%s %s %s %s' % (CONF.zvm.zhcp_helper_python, helper_path,
+                           ' '.join(args), ' '.join(userids))
+
+    with expect_invalid_xcat_resp_data():
+        resp = xdsh(zhcp_node, cmd, long_running=True)
+        raw_data = resp["data"][0]
+        return _parse_zhcp_helper_output(iter_lines(raw_data))
+
+
+def _parse_zhcp_helper_output(lines):
+    stats = {'cpumem': {}, 'vnics': {}}
+    for line in lines:
+        # strip the node name that xdsh puts in front of each line
+        record = line.partition(': ')[2].strip()
+        if not record:
+            continue
+        fields = record.split(',')
+        if fields[0] == 'error':
+            raise ZVMException(_("zHCP helper failed to query %(meter)s: "
+                                 "%(err)s") %
+                               {'meter': fields[1],
+                                'err': ','.join(fields[2:])})
+        try:
+            if fields[0] == 'cpumem':
+                guest_cpus, used_cpu_time, used_memory = (
+                    int(fields[2]), int(fields[3]), int(fields[4]))
+                extra = parse_extra_fields(
+                    fields[1], (f.partition('=')[::2] for f in fields[5:]))
+                stats['cpumem'][fields[1]] = (guest_cpus, used_cpu_time,
+                                              used_memory, extra)
+            elif fields[0] == 'vnics':
+                nic_entry = {'vswitch_name': fields[2],
+                             'nic_vdev': fields[3]}
+                nic_entry.update(zip(VSW_NIC_KWS,
+                                     [int(v) for v in fields[4:12]]))
+                if len(nic_entry) != len(VSW_NIC_KWS) + 2:
+                    raise ValueError('missing nic counters')
+                stats['vnics'].setdefault(fields[1], []).append(nic_entry)
+        except INVALID_RESP_DATA_ERRORS as err:
+            skip_invalid_record(fields[0], fields[1:2], err)
+
+    return stats
+
+
 def get_inst_name(instance):
     return getattr(instance, 'OS-EXT-SRV-ATTR:instance_name', None)
 
@@ -431,79 +1698,114 @@ def get_inst_power_state(instance):
     return getattr(instance, 'OS-EXT-STS:power_state', None)
 
 
-def virutal_network_vswitch_query_iuo_stats(zhcp_node):
-    cmd = ('smcli Virtual_Network_Vswitch_Query_IUO_Stats -T "%s" '
-           '-k "switch_name=*"' % zhcp_node)
+def indicate_user_io(zhcp_node, userids):
+    """Returns the number of I/Os started by each of the userids.
+
+    The counts come from CP INDICATE USER EXP, run for all the userids in a
+    single xdsh call. Userids that are not logged on are left out.
+    """
+    # vmcp fails for the userids that are not logged on, the loop ends
+    # with true so that its rc is not the one of the last userid.
+    cmd = ('for u in %s; do echo "Userid: $u"; '
+           'vmcp indicate user $u exp 2>&1; done; true' % ' '.join(userids))
 
     with expect_invalid_xcat_resp_data():
-        resp = xdsh(zhcp_node, cmd)
-        raw_data_list = resp["data"][0]
+        resp = xdsh(zhcp_node, cmd, long_running=True)
+        raw_data = resp["data"][0]
+        return parse_xdsh_output(_parse_indicate_user_io, raw_data)
 
-    while raw_data_list.__contains__(None):
-        raw_data_list.remove(None)
 
-    raw_data = '\n'.join(raw_data_list)
-    rd_list = raw_data.split('\n')
+_IO_COUNT_PTN = re.compile(r'\bIO=(\d+)')
 
-    def _parse_value(data_list, idx, keyword, offset):
-        return idx + offset, data_list[idx].rpartition(keyword)[2].strip()
 
-    vsw_dict = {}
-    with expect_invalid_xcat_resp_data():
-        # vswitch count
-        idx = 0
-        idx, vsw_count = _parse_value(rd_list, idx, 'vswitch count:', 2)
-        vsw_dict['vswitch_count'] = int(vsw_count)
-
-        # deal with each vswitch data
-        vsw_dict['vswitches'] = []
-        for i in range(vsw_dict['vswitch_count']):
-            vsw_data = {}
-            # skip vswitch number
-            idx += 1
-            # vswitch name
-            idx, vsw_name = _parse_value(rd_list, idx, 'vswitch name:', 1)
-            vsw_data['vswitch_name'] = vsw_name
-            # uplink count
-            idx, up_count = _parse_value(rd_list, idx, 'uplink count:', 1)
-            # skip uplink data
-            idx += int(up_count) * 9
-            # skip bridge data
-            idx += 8
-            # nic count
-            vsw_data['nics'] = []
-            idx, nic_count = _parse_value(rd_list, idx, 'nic count:', 1)
-            nic_count = int(nic_count)
-            for j in range(nic_count):
-                nic_data = {}
-                idx, nic_id = _parse_value(rd_list, idx, 'nic_id:', 1)
-                userid, toss, vdev = nic_id.partition(' ')
-                nic_data['userid'] = userid
-                nic_data['vdev'] = vdev
-                idx, nic_data['nic_fr_rx'] = _parse_value(rd_list, idx,
-                                                          'nic_fr_rx:', 1)
-                idx, nic_data['nic_fr_rx_dsc'] = _parse_value(rd_list, idx,
-                                                        'nic_fr_rx_dsc:', 1)
-                idx, nic_data['nic_fr_rx_err'] = _parse_value(rd_list, idx,
-                                                        'nic_fr_rx_err:', 1)
-                idx, nic_data['nic_fr_tx'] = _parse_value(rd_list, idx,
-                                                          'nic_fr_tx:', 1)
-                idx, nic_data['nic_fr_tx_dsc'] = _parse_value(rd_list, idx,
-                                                        'nic_fr_tx_dsc:', 1)
-                idx, nic_data['nic_fr_tx_err'] = _parse_value(rd_list, idx,
-                                                        'nic_fr_tx_err:', 1)
-                idx, nic_data['nic_rx'] = _parse_value(rd_list, idx,
-                                                       'nic_rx:', 1)
-                idx, nic_data['nic_tx'] = _parse_value(rd_list, idx,
-                                                       'nic_tx:', 1)
-                vsw_data['nics'].append(nic_data)
-            # vlan count
-            idx, vlan_count = _parse_value(rd_list, idx, 'vlan count:', 1)
-            # skip vlan data
-            idx += int(vlan_count) * 3
-            # skip the blank line
-            idx += 1
+def _parse_indicate_user_io(lines):
+    """Sum the IO= counters of the virtual cpus of each userid."""
+    io_counts = {}
+    userid = None
+    for line in lines:
+        head, sep, value = line.partition('Userid: ')
+        if sep:
+            userid = value.strip().upper()
+            continue
+        if userid is None:
+            continue
+        for count in _IO_COUNT_PTN.findall(line):
+            io_counts[userid] = io_counts.get(userid, 0) + int(count)
+    return io_counts
 
+
+def virutal_network_vswitch_query_iuo_stats(zhcp_node, switch_name='*'):
+    cmd = ('smcli Virtual_Network_Vswitch_Query_IUO_Stats -T "%s" '
+           '-k "switch_name=%s"' % (zhcp_node, switch_name))
+
+    with expect_invalid_xcat_resp_data():
+        resp = xdsh(zhcp_node, cmd, long_running=True)
+        raw_data = resp["data"][0]
+        return parse_xdsh_output(_parse_vswitch_iuo_stats, raw_data)
+
+
+VSW_NIC_KWS = ('nic_fr_rx', 'nic_fr_rx_dsc', 'nic_fr_rx_err', 'nic_fr_tx',
+               'nic_fr_tx_dsc', 'nic_fr_tx_err', 'nic_rx', 'nic_tx')
+
+
+def _parse_smcli_line(line):
+    """Returns (keyword, value) of a 'node: keyword: value' output line."""
+    head, sep, value = line.rpartition(':')
+    if not sep:
+        return None, None
+    return head.rpartition(': ')[2].strip(), value.strip()
+
+
+def _parse_vswitch_iuo_stats(lines):
+    """Parse Virtual_Network_Vswitch_Query_IUO_Stats output.
+
+    The parser keys on the "vswitch name:" and "nic_id:" markers instead of
+    fixed line offsets, a NIC record with missing counters is dropped and
+    parsing resumes at the next marker.
+    """
+    vsw_dict = {'vswitches': []}
+    vsw_data = None
+    nic_data = None
+
+    def _finish(nic_data):
+        if nic_data is None:
+            return
+        if len(nic_data) != len(VSW_NIC_KWS) + 2:
+            skip_invalid_record('vnics', nic_data.get('userid'),
+                                'missing %s' % ', '.join(
+                                    sorted(set(VSW_NIC_KWS) -
+                                           set(nic_data))))
+        else:
+            vsw_data['nics'].append(nic_data)
+
+    for line in lines:
+        keyword, value = _parse_smcli_line(line)
+        if keyword == 'vswitch count':
+            try:
+                vsw_dict['vswitch_count'] = int(value)
+            except ValueError as err:
+                skip_invalid_record('vswitch', None, err)
+        elif keyword == 'vswitch name':
+            _finish(nic_data)
+            nic_data = None
+            vsw_data = {'vswitch_name': value, 'nics': []}
             vsw_dict['vswitches'].append(vsw_data)
+        elif keyword == 'nic_id':
+            _finish(nic_data)
+            nic_data = None
+            if vsw_data is None:
+                skip_invalid_record('vnics', value, 'no vswitch name')
+                continue
+            userid, toss, vdev = value.partition(' ')
+            nic_data = {'userid': userid, 'vdev': vdev}
+        elif keyword in VSW_NIC_KWS:
+            if nic_data is not None:
+                nic_data[keyword] = value
+        elif keyword == 'vlan count':
+            _finish(nic_data)
+            nic_data = None
+    _finish(nic_data)
+
+    vsw_dict.setdefault('vswitch_count', len(vsw_dict['vswitches']))
 
     return vsw_dict
@@ -0,0 +1,180 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Stats aggregation helper executed on the zHCP.
+
+This file is copied to the zHCP by the z/VM inspector and run through xdsh.
+It must only depend on the python standard library. It runs the smcli
+queries locally and prints one CSV line per record, keeping only the fields
+the inspector uses:
+
+    cpumem,<userid>,<guest cpus>,<used cpu time uS>,<used memory KB>[,
+        <extra field>=<value>...]
+    vnics,<userid>,<vswitch>,<vdev>,<nic_fr_rx>,<nic_fr_rx_dsc>,
+        <nic_fr_rx_err>,<nic_fr_tx>,<nic_fr_tx_dsc>,<nic_fr_tx_err>,
+        <nic_rx>,<nic_tx>
+    error,<meter>,<message>
+"""
+
+import optparse
+import subprocess
+import sys
+
+
+IPQ_KWS = (
+    ('userid', 'Guest name:'),
+    ('guest_cpus', 'Guest CPUs:'),
+    ('used_cpu_time', 'Used CPU time:'),
+    ('used_memory', 'Used memory:'),
+)
+
+# Fields that can be asked for with --extra, as in IPQ_EXTRA_KWS of the
+# inspector.
+IPQ_EXTRA_KWS = (
+    ('elapsed_time', 'Elapsed time:'),
+    ('min_memory', 'Minimum memory:'),
+    ('max_memory', 'Max memory:'),
+    ('shared_memory', 'Shared memory:'),
+    ('active_cpus', 'Active CPUs in CEC:'),
+    ('logical_cpus', 'Logical CPUs in VM:'),
+    ('min_cpu_count', 'Minimum CPU count:'),
+    ('max_cpu_limit', 'Max CPU limit:'),
+    ('processor_share', 'Processor share:'),
+    ('samples_cpu_in_use', 'Samples CPU in use:'),
+    ('samples_cpu_delay', 'Samples CPU delay:'),
+    ('samples_page_wait', 'Samples page wait:'),
+    ('samples_idle', 'Samples idle:'),
+    ('samples_other', 'Samples other:'),
+    ('total_samples', 'Total samples:'),
+)
+
+NIC_KWS = ('nic_fr_rx', 'nic_fr_rx_dsc', 'nic_fr_rx_err', 'nic_fr_tx',
+           'nic_fr_tx_dsc', 'nic_fr_tx_err', 'nic_rx', 'nic_tx')
+
+
+def smcli(args):
+    proc = subprocess.Popen(['smcli'] + args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError(' '.join(out.split()))
+    return out.splitlines()
+
+
+def _int(value):
+    return int(value.strip(' "').partition(' ')[0])
+
+
+def ipq(userids, write, extra_fields=()):
+    lines = smcli(['Image_Performance_Query', '-T', ' '.join(userids),
+                   '-c', str(len(userids))])
+    wanted = set(userids)
+    kws = IPQ_KWS + tuple((key, kw) for key, kw in IPQ_EXTRA_KWS
+                          if key in extra_fields)
+
+    def _finish(pi):
+        if pi is None or pi.get('userid') not in wanted:
+            return
+        if all(key in pi for key, kw in IPQ_KWS):
+            record = 'cpumem,%s,%d,%d,%d' % (
+                pi['userid'], _int(pi['guest_cpus']),
+                _int(pi['used_cpu_time']), _int(pi['used_memory']))
+            for key, kw in kws[len(IPQ_KWS):]:
+                # a malformed extra field is left out, not the record
+                try:
+                    record += ',%s=%d' % (key, _int(pi[key]))
+                except (KeyError, ValueError):
+                    pass
+            write(record)
+
+    pi = None
+    for line in lines:
+        for key, kw in kws:
+            idx = line.find(kw)
+            if idx == -1:
+                continue
+            if key == 'userid':
+                _finish(pi)
+                pi = {}
+            if pi is not None:
+                pi[key] = line[idx + len(kw):].strip(' "')
+            break
+    _finish(pi)
+
+
+def vswitch(target, switch_name, userids, write):
+    lines = smcli(['Virtual_Network_Vswitch_Query_IUO_Stats', '-T', target,
+                   '-k', 'switch_name=%s' % switch_name])
+    wanted = set(userids)
+    vsw_name = None
+    nic = None
+
+    def _finish(nic):
+        if nic is not None and len(nic) == len(NIC_KWS) + 2:
+            if nic['userid'] in wanted:
+                write(','.join(['vnics', nic['userid'], vsw_name,
+                                nic['vdev']] +
+                               [str(_int(nic[k])) for k in NIC_KWS]))
+
+    for line in lines:
+        head, sep, value = line.rpartition(':')
+        keyword = head.rpartition(': ')[2].strip()
+        value = value.strip()
+        if keyword == 'vswitch name':
+            _finish(nic)
+            nic = None
+            vsw_name = value
+        elif keyword == 'nic_id':
+            _finish(nic)
+            userid, toss, vdev = value.partition(' ')
+            nic = {'userid': userid.upper(), 'vdev': vdev}
+        elif keyword in NIC_KWS and nic is not None:
+            nic[keyword] = value
+        elif keyword == 'vlan count':
+            _finish(nic)
+            nic = None
+    _finish(nic)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] USERID...')
+    parser.add_option('--meter', action='append', default=[],
+                      help='cpumem or vnics, may be repeated')
+    parser.add_option('--target', default='',
+                      help='smcli target of the vswitch query')
+    parser.add_option('--vswitch', action='append', default=[],
+                      help='vswitch to query, may be repeated')
+    parser.add_option('--extra', action='append', default=[],
+                      help='extra Image_Performance_Query field, may be '
+                           'repeated')
+    opts, userids = parser.parse_args(argv)
+    userids = [u.upper() for u in userids]
+
+    out = []
+    write = out.append
+    for meter in opts.meter:
+        try:
+            if meter == 'cpumem':
+                ipq(userids, write, opts.extra)
+            elif meter == 'vnics':
+                for switch_name in opts.vswitch or ['*']:
+                    vswitch(opts.target, switch_name, userids, write)
+        except Exception as err:
+            write('error,%s,%s' % (meter, str(err).replace(',', ' ')))
+    sys.stdout.write('\n'.join(out) + '\n')
+
+
+if __name__ == '__main__':
+    main()
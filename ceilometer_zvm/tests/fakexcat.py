@@ -0,0 +1,485 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Local stand-in for the xCAT REST API used by the z/VM inspector.
+
+Only the calls issued by ceilometer_zvm are implemented:
+
+* ``GET  /xcatws/nodes/<noderange>``      lsdef of one or more nodes
+* ``GET  /xcatws/tables/hosts``           gettab of the node hostname
+* ``GET  /xcatws/tables/zvm``             tabdump of the zvm table
+* ``PUT  /xcatws/nodes/<node>/dsh``       xdsh of the smcli commands
+
+The server can run inside unit tests or as a standalone process that a load
+generator points a set of ``ZVMInspector`` instances at::
+
+    python -m ceilometer_zvm.tests.fakexcat --port 8443 --guests 2000
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import ssl
+import threading
+import time
+import zlib
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
+
+
+VAR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'var')
+CERT_FILE = os.path.join(VAR_DIR, 'fakexcat.crt')
+KEY_FILE = os.path.join(VAR_DIR, 'fakexcat.key')
+
+
+class FakeZVMHost(object):
+    """Canned inventory and smcli output of one z/VM host."""
+
+    def __init__(self, zhcp_node='zhcp', zhcp_hostname='zhcp.example.com',
+                 zvm_host='zvmhost1', xcat_master='xcat', guests=10,
+                 vswitches=2, uplinks=1, vlans=0):
+        self.zhcp_node = zhcp_node
+        self.zhcp_hostname = zhcp_hostname
+        self.zvm_host = zvm_host
+        self.xcat_master = xcat_master
+        self.vswitches = ['XCATVSW%d' % (i + 1) for i in range(vswitches)]
+        self.uplinks = uplinks
+        self.vlans = vlans
+        self.nodes = {}
+        # spool path -> [polls answered pending, output, rc] of background
+        # jobs
+        self.jobs = {}
+        self.job_pending_polls = 1
+        for i in range(guests):
+            node = 'node%05d' % i
+            self.nodes[node] = node.upper()
+
+    def userid(self, node):
+        if node == self.zhcp_node:
+            return self.zhcp_node.upper()
+        return self.nodes.get(node)
+
+    def lsdef(self, noderange):
+        info = []
+        for node in noderange.split(','):
+            userid = self.userid(node)
+            if userid is None:
+                continue
+            info.extend(['Object name: %s' % node,
+                         '    hcp=%s' % self.zhcp_hostname,
+                         '    userid=%s' % userid])
+        return [{'info': info}]
+
+    def gettab_hostname(self, node):
+        if node == self.zhcp_node:
+            return [{'data': [self.zhcp_hostname]}]
+        return [{'data': ['%s.example.com' % node]}]
+
+    def tabdump_zvm(self):
+        rows = ['#node,hcp,userid,nodetype,parent,comments,disable']
+        rows.append('"%s","%s","",,,,' % (self.zvm_host, self.zhcp_hostname))
+        rows.append('"%s","%s","%s",,,,' % (self.xcat_master,
+                                            self.zhcp_hostname,
+                                            self.xcat_master.upper()))
+        rows.append('"%s","%s","%s",,,,' % (self.zhcp_node,
+                                            self.zhcp_hostname,
+                                            self.zhcp_node.upper()))
+        for node in sorted(self.nodes):
+            rows.append('"%s","%s","%s",,,,' % (node, self.zhcp_hostname,
+                                                self.nodes[node]))
+        return [{'data': rows}]
+
+    def _guest_stat(self, userid):
+        seed = sum(ord(c) for c in userid)
+        now = int(time.time())
+        return {
+            'cpus': 1 + seed % 4,
+            'cpu_time': (now % 100000) * 1000 + seed,
+            'elapsed': now * 1000,
+            'memory': 1048576 + seed * 64,
+        }
+
+    def image_performance_query(self, userids):
+        known = set(self.nodes.values())
+        userids = [u for u in userids if u.upper() in known]
+        p = '%s: ' % self.zhcp_node
+        out = [p + 'Number of virtual server IDs: %d \n' % len(userids)]
+        for userid in userids:
+            st = self._guest_stat(userid)
+            out.extend([
+                p + 'Guest name: %s\n' % userid,
+                p + 'Record version: "1"\n',
+                p + 'Guest flags: "0"\n',
+                p + 'Used CPU time: "%d uS"\n' % st['cpu_time'],
+                p + 'Elapsed time: "%d uS"\n' % st['elapsed'],
+                p + 'Minimum memory: "0 KB"\n',
+                p + 'Max memory: "%d KB"\n' % (st['memory'] * 2),
+                p + 'Shared memory: "0 KB"\n',
+                p + 'Used memory: "%d KB"\n' % st['memory'],
+                p + 'Active CPUs in CEC: "4"\n',
+                p + 'Logical CPUs in VM: "4"\n',
+                p + 'Guest CPUs: "%d"\n' % st['cpus'],
+                p + 'Minimum CPU count: "1"\n',
+                p + 'Max CPU limit: "10000"\n',
+                p + 'Processor share: "100"\n',
+                p + 'Samples CPU in use: "10"\n',
+                p + 'Samples CPU delay: "0"\n',
+                p + 'Samples page wait: "0"\n',
+                p + 'Samples idle: "90"\n',
+                p + 'Samples other: "0"\n',
+                p + 'Total samples: "100"\n',
+                p + 'Guest state: "0"\n',
+                p + '\n',
+            ])
+        return [{'data': [''.join(out)]}]
+
+    def vswitch_query(self, switch_name='*'):
+        if switch_name == '*':
+            switches = self.vswitches
+        else:
+            switches = [s for s in self.vswitches
+                        if s.upper() == switch_name.upper()]
+        p = '%s: ' % self.zhcp_node
+        userids = sorted(self.nodes.values())
+        out = [p + 'vswitch count: %d\n' % len(switches), p + '\n']
+        for num, vsw in enumerate(switches):
+            out.extend([p + 'vswitch number: %d\n' % (num + 1),
+                        p + 'vswitch name: %s\n' % vsw,
+                        p + 'uplink count: %d\n' % self.uplinks])
+            for i in range(self.uplinks):
+                out.append(p + 'uplink_conn: %04X\n' % (0x6200 + i))
+                for k in ('fr_rx', 'fr_rx_dsc', 'fr_rx_err', 'fr_tx',
+                          'fr_tx_dsc', 'fr_tx_err', 'rx', 'tx'):
+                    out.append(p + 'uplink_%s: %d\n' % (k, 1000 + i))
+            for k in ('fr_rx', 'fr_rx_dsc', 'fr_rx_err', 'fr_tx',
+                      'fr_tx_dsc', 'fr_tx_err', 'rx', 'tx'):
+                out.append(p + 'bridge_%s: 0\n' % k)
+            out.append(p + 'nic count: %d\n' % len(userids))
+            vdev = '%04X' % (0x600 + num * 0x100)
+            for userid in userids:
+                seed = sum(ord(c) for c in userid) + num
+                out.append(p + 'nic_id: %s %s\n' % (userid, vdev))
+                for k, v in (('fr_rx', seed * 10), ('fr_rx_dsc', 0),
+                             ('fr_rx_err', 0), ('fr_tx', seed * 9),
+                             ('fr_tx_dsc', 0), ('fr_tx_err', 0),
+                             ('rx', seed * 1500), ('tx', seed * 1400)):
+                    out.append(p + 'nic_%s: %d\n' % (k, v))
+            out.append(p + 'vlan count: %d\n' % self.vlans)
+            for i in range(self.vlans):
+                out.extend([p + 'vlan_id: %d\n' % (i + 1),
+                            p + 'vlan_rx: 0\n', p + 'vlan_tx: 0\n'])
+            out.append(p + '\n')
+        return [{'data': [''.join(out)]}]
+
+    def indicate_user(self, userids):
+        known = set(self.nodes.values())
+        p = '%s: ' % self.zhcp_node
+        out = []
+        for userid in userids:
+            out.append(p + 'Userid: %s\n' % userid)
+            if userid.upper() not in known:
+                out.append(p + 'HCPCQU045E %s not logged on\n' % userid)
+                continue
+            st = self._guest_stat(userid)
+            out.append(p + 'USERID=%s MACH=ESA STOR=%dM VIRT=V XSTORE=NONE\n'
+                       % (userid, st['memory'] // 1024))
+            for cpu in range(st['cpus']):
+                out.extend([
+                    p + 'CPU %02d: CTIME=01:23 VTIME=00:45 TTIME=01:10 '
+                    'IO=%06d\n' % (cpu, st['cpu_time'] // 1000 % 1000000),
+                    p + '        RDR=000000 PRT=000000 PCH=000000\n'])
+        return [{'data': [''.join(out)]}]
+
+    def job_rc(self, command):
+        """Exit status of command, the one of its last vmcp or 0."""
+        m = re.search(r'for u in ([^;]*); do .*indicate user.* done$',
+                      command)
+        if m is not None and m.group(1).split():
+            last = m.group(1).split()[-1].upper()
+            if last not in self.nodes.values():
+                return 1
+        return 0
+
+    def submit_job(self, node, path, script):
+        command = base64.b64decode(script).decode('utf-8')
+        self.jobs[path] = [self.job_pending_polls, self.xdsh(node, command),
+                           self.job_rc(command)]
+        return [{'data': ['']}]
+
+    def poll_job(self, node, path):
+        p = '%s: ' % node
+        job = self.jobs.get(path)
+        if job is not None and job[0] > 0:
+            job[0] -= 1
+            return [{'data': [p + 'ZVMJOB-PENDING\n']}]
+        if job is None:
+            return [{'data': [p + 'ZVMJOB-LOST\n']}]
+        del self.jobs[path]
+        out = ''.join(chunk for d in job[1] for chunk in d.get('data', []))
+        return [{'data': [p + 'ZVMJOB-RC=%d\n' % job[2] + out]}]
+
+    def xdsh(self, node, command):
+        m = re.search(r'echo (\S+) \| base64 -d > (\S*/zvmjob-[^/\s]+)\.sh',
+                      command)
+        if m is not None:
+            return self.submit_job(node, m.group(2), m.group(1))
+        m = re.search(r'if test -f (\S*/zvmjob-[^/\s]+)\.rc', command)
+        if m is not None:
+            return self.poll_job(node, m.group(1))
+        m = re.search(r'for u in ([^;]*); do', command)
+        if m is not None and 'indicate user' in command:
+            return self.indicate_user(m.group(1).split())
+        m = re.search(r'Image_Performance_Query -T "([^"]*)"', command)
+        if m is not None:
+            return self.image_performance_query(m.group(1).split())
+        m = re.search(r'Virtual_Network_Vswitch_Query_IUO_Stats .*'
+                      r'-k "switch_name=([^"]*)"', command)
+        if m is not None:
+            return self.vswitch_query(m.group(1))
+        return [{'data': ['%s: ' % node]}]
+
+
+class FakeXCATHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    timeout = 30
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stats_incr('connections')
+
+    def _compress(self, payload):
+        """Returns the encoding and the payload sent for this request."""
+        encoding = self.server.compression
+        accepted = [e.split(';')[0].strip() for e in
+                    (self.headers.get('accept-encoding') or '').split(',')]
+        if encoding is None or encoding.split('-')[-1] not in accepted:
+            return None, payload
+        if encoding == 'gzip':
+            comp = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == 'raw-deflate':
+            # a raw deflate stream, as sent by some servers for deflate
+            comp = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            comp = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+        return (encoding.split('-')[-1],
+                comp.compress(payload) + comp.flush())
+
+    def _send(self, status, body):
+        encoding, payload = self._compress(json.dumps(body).encode('utf-8'))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.stats_incr('bytes_sent', len(payload))
+
+    def _read_body(self):
+        length = int(self.headers.get('content-length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _handle(self, method):
+        server = self.server
+        body = self._read_body()
+        if not server.enter():
+            server.stats_incr('rejected')
+            self._send(503, {'error': 'too many connections'})
+            return
+        try:
+            server.stats_incr('requests')
+            if server.latency:
+                time.sleep(server.latency)
+            if server.should_fail():
+                server.stats_incr('errors')
+                self._send(500, {'error': 'injected error'})
+                return
+            status, resp = self._dispatch(method, body)
+            self._send(status, resp)
+        finally:
+            server.leave()
+
+    def _dispatch(self, method, body):
+        host = self.server.host
+        url = urlparse.urlparse(self.path)
+        query = dict((k, v[0]) for k, v in
+                     urlparse.parse_qs(url.query).items())
+        parts = [p for p in url.path.split('/') if p]
+        if len(parts) < 3 or parts[0] != 'xcatws':
+            return 404, {'error': 'unknown resource %s' % url.path}
+
+        if parts[1] == 'nodes' and len(parts) == 4 and parts[3] == 'dsh':
+            if method != 'PUT':
+                return 405, {'error': 'dsh requires PUT'}
+            command = ''
+            for arg in body or []:
+                if arg.startswith('command='):
+                    command = arg[len('command='):]
+            return 200, {'data': host.xdsh(parts[2], command)}
+        if parts[1] == 'nodes' and len(parts) == 3 and method == 'GET':
+            return 200, {'data': host.lsdef(parts[2])}
+        if parts[1] == 'tables' and method == 'GET':
+            if parts[2] == 'zvm':
+                return 200, {'data': host.tabdump_zvm()}
+            if parts[2] == 'hosts':
+                return 200, {'data': host.gettab_hostname(
+                                            query.get('value', ''))}
+        return 404, {'error': 'unknown resource %s' % url.path}
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class FakeXCATServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTPS server answering the xCAT REST calls of the inspector.
+
+    @host:            FakeZVMHost providing the canned responses.
+    @latency:         seconds slept before answering each request.
+    @error_rate:      probability in [0, 1] of answering with HTTP 500.
+    @max_connections: number of requests served concurrently, requests
+                      above the limit are answered with HTTP 503.
+    @compression:     gzip, deflate or raw-deflate to compress the responses
+                      of clients accepting it, None to never compress.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), host=None, latency=0,
+                 error_rate=0, max_connections=None, compression=None,
+                 certfile=CERT_FILE, keyfile=KEY_FILE):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeXCATHandler)
+        self.host = host or FakeZVMHost()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_connections = max_connections
+        self.compression = compression
+        self.stats = {}
+        self._forced_errors = 0
+        self._active = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(certfile, keyfile)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stats_incr(self, key, value=1):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    def inject_errors(self, count):
+        """Answer the next count requests with HTTP 500."""
+        with self._lock:
+            self._forced_errors += count
+
+    def should_fail(self):
+        with self._lock:
+            if self._forced_errors > 0:
+                self._forced_errors -= 1
+                return True
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def enter(self):
+        with self._lock:
+            if (self.max_connections is not None and
+                    self._active >= self.max_connections):
+                return False
+            self._active += 1
+            peak = self.stats.get('max_concurrent', 0)
+            self.stats['max_concurrent'] = max(peak, self._active)
+            return True
+
+    def leave(self):
+        with self._lock:
+            self._active -= 1
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--guests', type=int, default=100,
+                        help='number of guests managed by the zHCP')
+    parser.add_argument('--vswitches', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each response')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests failed with HTTP 500')
+    parser.add_argument('--max-connections', type=int, default=None,
+                        help='concurrent requests served before HTTP 503')
+    parser.add_argument('--compression', default=None,
+                        choices=['gzip', 'deflate', 'raw-deflate'],
+                        help='encoding of the responses of clients '
+                             'accepting it')
+    parser.add_argument('--zhcp-node', default='zhcp')
+    parser.add_argument('--zhcp-hostname', default='zhcp.example.com')
+    parser.add_argument('--zvm-host', default='zvmhost1')
+    args = parser.parse_args(argv)
+
+    host = FakeZVMHost(zhcp_node=args.zhcp_node,
+                       zhcp_hostname=args.zhcp_hostname,
+                       zvm_host=args.zvm_host, guests=args.guests,
+                       vswitches=args.vswitches)
+    server = FakeXCATServer((args.bind, args.port), host=host,
+                            latency=args.latency,
+                            error_rate=args.error_rate,
+                            max_connections=args.max_connections,
+                            compression=args.compression)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
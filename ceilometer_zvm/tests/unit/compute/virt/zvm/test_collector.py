@@ -0,0 +1,139 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from ceilometer.compute.virt import inspector as virt_inspector
+import eventlet
+import mock
+from oslo_config import fixture as fixture_config
+from oslotest import base
+
+from ceilometer_zvm.compute.virt.zvm import collector
+
+
+class FakeInstance(object):
+
+    def __init__(self, name, power_state=0x01):
+        setattr(self, 'OS-EXT-SRV-ATTR:instance_name', name)
+        setattr(self, 'OS-EXT-STS:power_state', power_state)
+
+
+class TestCollector(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestCollector, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'collector.sock')
+        self.CONF = self.useFixture(
+                            fixture_config.Config(collector.CONF)).conf
+        self.CONF.set_override('collector_socket', path, 'zvm')
+        self.CONF.set_override('collector_timeout', 10, 'zvm')
+
+        self.stats = {'cpumem': {'inst1': {'nodename': 'inst1',
+                                           'userid': 'INST1',
+                                           'guest_cpus': 2,
+                                           'used_cpu_time': 1000,
+                                           'used_memory': 512}},
+                      'vnics': {}}
+        self.backend = mock.Mock()
+        self.backend._get_inst_stat_by_name.side_effect = self._get_stat
+        self.server = collector.CollectorServer(self.backend, path).listen()
+        self.addCleanup(self.server.close)
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+        self.inspector = collector.ZVMCollectorInspector()
+        self.addCleanup(self.inspector._close)
+
+    def _serve(self):
+        try:
+            self.server.serve_forever()
+        except Exception:
+            pass
+
+    def _get_stat(self, meter, inst_name):
+        if inst_name == 'slow':
+            time.sleep(0.3)
+            inst_name = 'inst1'
+        if inst_name == 'broken':
+            raise ValueError('xCAT is down')
+        stat = self.stats[meter].get(inst_name)
+        if stat is None:
+            raise virt_inspector.InstanceNotFoundException(inst_name)
+        return stat
+
+    def test_inspect_cpus_and_memory(self):
+        inst = FakeInstance('inst1')
+        cpu = self.inspector.inspect_cpus(inst)
+        self.assertEqual(2, cpu.number)
+        self.assertEqual(1000, cpu.time)
+        self.assertEqual(512, self.inspector.inspect_memory_usage(inst).usage)
+        # both reads went through one connection
+        self.assertEqual(2, self.backend._get_inst_stat_by_name.call_count)
+
+    def test_not_found(self):
+        self.assertRaises(virt_inspector.InstanceNotFoundException,
+                          self.inspector.inspect_cpus,
+                          FakeInstance('inst2'))
+
+    def test_shutoff_checked_locally(self):
+        self.assertRaises(virt_inspector.InstanceShutOffException,
+                          self.inspector.inspect_cpus,
+                          FakeInstance('inst1', 0x04))
+        self.backend._get_inst_stat_by_name.assert_not_called()
+
+    def test_collector_failure(self):
+        self.assertRaises(virt_inspector.InspectorException,
+                          self.inspector.inspect_cpus,
+                          FakeInstance('broken'))
+
+    def test_reconnect_after_collector_restart(self):
+        inst = FakeInstance('inst1')
+        self.inspector.inspect_cpus(inst)
+        self.inspector._sock.shutdown(2)
+        self.assertEqual(2, self.inspector.inspect_cpus(inst).number)
+
+    def test_read_yields_to_other_green_threads(self):
+        ticks = []
+
+        def _ticker():
+            while True:
+                ticks.append(1)
+                eventlet.sleep(0.01)
+        ticker = eventlet.spawn(_ticker)
+        self.addCleanup(ticker.kill)
+        self.assertEqual(2, self.inspector.inspect_cpus(
+                                        FakeInstance('slow')).number)
+        self.assertGreater(len(ticks), 5)
+
+    def test_timeout_follows_refresh_budget(self):
+        self.assertEqual(10, self.inspector._timeout())
+        self.CONF.set_override('collector_timeout', None, 'zvm')
+        self.assertEqual(600, self.inspector._timeout())
+        self.CONF.set_override('refresh_budget', 60, 'zvm')
+        self.assertEqual(120, self.inspector._timeout())
+
+    def test_collector_not_running(self):
+        self.CONF.set_override('collector_socket', '/nonexistent/sock',
+                               'zvm')
+        inspector = collector.ZVMCollectorInspector()
+        self.assertRaises(virt_inspector.InspectorException,
+                          inspector.inspect_cpus, FakeInstance('inst1'))
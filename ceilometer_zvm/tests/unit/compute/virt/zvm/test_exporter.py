@@ -0,0 +1,108 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import mock
+from oslotest import base
+
+from ceilometer_zvm.compute.virt.zvm import exporter
+from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
+
+
+class TestExporter(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestExporter, self).setUp()
+        self.inspector = mock.Mock()
+        self.inspector.cache = zvmutils.CacheData()
+        self.inspector.instances = {'inst1': 'INST1'}
+        self.inspector._update_cache.side_effect = self._update_cache
+        self.exporter = exporter.Exporter(self.inspector)
+        zvmutils.METRICS.clear()
+        self.addCleanup(zvmutils.METRICS.clear)
+
+    def _update_cache(self, meter, instances={}):
+        if meter == 'cpumem':
+            self.inspector.cache.clear()
+            self.inspector.cache.set('cpumem', {'nodename': 'inst1',
+                                                'userid': 'INST1',
+                                                'guest_cpus': 2,
+                                                'used_cpu_time': 5000,
+                                                'used_memory': 512,
+                                                'extra': {'max_memory': 2048}})
+        elif meter == 'disks':
+            self.inspector.cache.set('disks', {'nodename': 'inst1',
+                                               'userid': 'INST1',
+                                               'io_count': 150,
+                                               'iops': None})
+        else:
+            self.inspector.cache.set('vnics', {
+                'nodename': 'inst1', 'userid': 'INST1',
+                'nics': [{'vswitch_name': 'XCATVSW2', 'nic_vdev': '0600',
+                          'nic_rx': 10, 'nic_tx': 20, 'nic_fr_rx': 1,
+                          'nic_fr_tx': 2, 'nic_fr_rx_dsc': 0,
+                          'nic_fr_tx_dsc': 0, 'nic_fr_rx_err': 0,
+                          'nic_fr_tx_err': 0}]})
+
+    def _scrape(self, path='/metrics'):
+        start_response = mock.Mock()
+        body = b''.join(self.exporter({'PATH_INFO': path}, start_response))
+        return start_response.call_args[0][0], body.decode('utf-8')
+
+    def test_refresh(self):
+        self.assertTrue(self.exporter.refresh())
+        self.inspector._update_cache.assert_has_calls(
+            [mock.call('cpumem'), mock.call('vnics', {'inst1': 'INST1'}),
+             mock.call('disks', {'inst1': 'INST1'})])
+        self.assertEqual(1, len(self.exporter.snapshot['cpumem']))
+        self.assertEqual(1, len(self.exporter.snapshot['vnics']))
+        self.assertEqual(1, len(self.exporter.snapshot['disks']))
+
+    def test_refresh_failure_keeps_snapshot(self):
+        self.exporter.refresh()
+        self.inspector._update_cache.side_effect = zvmutils.ZVMException(
+                                                                'down')
+        self.assertFalse(self.exporter.refresh())
+        self.assertEqual(1, self.exporter.refresh_errors)
+        self.assertEqual(1, len(self.exporter.snapshot['cpumem']))
+
+    def test_scrape(self):
+        self.exporter.refresh()
+        zvmutils.METRICS.incr('invalid_records.cpumem')
+        calls = self.inspector._update_cache.call_count
+        status, body = self._scrape()
+        self.assertEqual('200 OK', status)
+        self.assertIn('zvm_guest_cpus{instance="inst1",userid="INST1"} 2\n',
+                      body)
+        self.assertIn('zvm_guest_cpu_time_nanoseconds_total{instance="inst1"'
+                      ',userid="INST1"} 5000\n', body)
+        self.assertIn('zvm_guest_nic_receive_bytes_total{instance="inst1",'
+                      'userid="INST1",vdev="0600",vswitch="XCATVSW2"} 10\n',
+                      body)
+        self.assertIn('zvm_guest_ipq_max_memory{instance="inst1",'
+                      'userid="INST1"} 2048\n', body)
+        self.assertIn('zvm_guest_disk_io_total{instance="inst1",'
+                      'userid="INST1"} 150\n', body)
+        self.assertIn('zvm_exporter_refresh_errors_total 0\n', body)
+        self.assertIn('zvm_collector_events_total{'
+                      'event="invalid_records.cpumem"} 1\n', body)
+        # scrapes are served from memory
+        self.assertEqual(calls, self.inspector._update_cache.call_count)
+
+    def test_scrape_unknown_path(self):
+        status, body = self._scrape('/other')
+        self.assertEqual('404 Not Found', status)
+
+    def test_label_escaping(self):
+        self.assertEqual('a="x\\"y\\\\z\\n"', exporter._labels(a='x"y\\z\n'))
@@ -0,0 +1,174 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import eventlet
+from oslo_config import fixture as fixture_config
+from oslotest import base
+
+from ceilometer_zvm.compute.virt.zvm import inspector as zvm_inspector
+from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
+from ceilometer_zvm.tests import fakexcat
+
+
+class TestFakeXCATServer(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestFakeXCATServer, self).setUp()
+        self.host = fakexcat.FakeZVMHost(guests=3)
+        self.server = fakexcat.FakeXCATServer(host=self.host).start()
+        self.addCleanup(self.server.stop)
+
+        self.CONF = self.useFixture(
+                            fixture_config.Config(zvm_inspector.CONF)).conf
+        self.CONF.set_override('zvm_xcat_server', '127.0.0.1', 'zvm')
+        self.CONF.set_override('zvm_xcat_port', self.server.port, 'zvm')
+        self.CONF.set_override('zvm_xcat_username', 'user', 'zvm')
+        self.CONF.set_override('zvm_xcat_password', 'pwd', 'zvm')
+        self.CONF.set_override('zvm_host', 'zvmhost1', 'zvm')
+
+    def _hcp_info(self):
+        return {'nodename': 'zhcp',
+                'hostname': zvmutils.get_node_hostname('zhcp'),
+                'userid': zvmutils.get_userid('zhcp')}
+
+    def test_lsdef_and_gettab(self):
+        self.assertEqual('NODE00001', zvmutils.get_userid('node00001'))
+        self.assertEqual('zhcp.example.com',
+                         zvmutils.get_node_hostname('zhcp'))
+
+    def test_list_instances(self):
+        exp = {'node00000': 'NODE00000',
+               'node00001': 'NODE00001',
+               'node00002': 'NODE00002'}
+        self.assertEqual(exp, zvmutils.list_instances(self._hcp_info()))
+
+    def test_image_performance_query(self):
+        pi = zvmutils.image_performance_query('zhcp',
+                                              ['NODE00000', 'NODE00002'])
+        self.assertEqual(['NODE00000', 'NODE00002'], sorted(pi.keys()))
+        self.assertTrue(pi['NODE00000']['used_memory'].endswith('KB'))
+
+    def test_vswitch_query(self):
+        vsw = zvmutils.virutal_network_vswitch_query_iuo_stats('zhcp')
+        self.assertEqual(2, vsw['vswitch_count'])
+        self.assertEqual(3, len(vsw['vswitches'][1]['nics']))
+        self.assertEqual('0700', vsw['vswitches'][1]['nics'][0]['vdev'])
+
+    def test_vswitch_query_one_switch(self):
+        vsw = zvmutils.virutal_network_vswitch_query_iuo_stats('zhcp',
+                                                              'XCATVSW2')
+        self.assertEqual(1, vsw['vswitch_count'])
+        self.assertEqual('XCATVSW2', vsw['vswitches'][0]['vswitch_name'])
+
+    def test_indicate_user_io(self):
+        io = zvmutils.indicate_user_io('zhcp', ['NODE00000', 'NOSUCH'])
+        self.assertEqual(['NODE00000'], list(io.keys()))
+
+    def test_xdsh_async(self):
+        self.CONF.set_override('xdsh_async', True, 'zvm')
+        self.CONF.set_override('xdsh_poll_interval', 0, 'zvm')
+        self.host.job_pending_polls = 2
+        zvmutils.METRICS.clear()
+        pi = zvmutils.image_performance_query('zhcp',
+                                              ['NODE00000', 'NODE00002'])
+        self.assertEqual(['NODE00000', 'NODE00002'], sorted(pi.keys()))
+        self.assertEqual(1, zvmutils.METRICS.get('xdsh_jobs'))
+        self.assertEqual(3, zvmutils.METRICS.get('xdsh_job_polls'))
+        self.assertEqual({}, self.host.jobs)
+
+    def test_xdsh_async_rc(self):
+        self.CONF.set_override('xdsh_async', True, 'zvm')
+        self.CONF.set_override('xdsh_poll_interval', 0, 'zvm')
+        self.assertRaises(zvmutils.ZVMException, zvmutils.xdsh, 'zhcp',
+                          'for u in NODE00000 NOSUCH; do '
+                          'vmcp indicate user $u exp 2>&1; done',
+                          long_running=True)
+        # a guest logged off last does not fail the whole batch
+        io = zvmutils.indicate_user_io('zhcp', ['NODE00000', 'NOSUCH'])
+        self.assertEqual(['NODE00000'], list(io.keys()))
+
+    def test_xdsh_async_poll_retried(self):
+        self.CONF.set_override('xdsh_async', True, 'zvm')
+        self.CONF.set_override('xdsh_poll_interval', 0, 'zvm')
+        submit_job = self.host.submit_job
+
+        def _submit_job(*args):
+            # the first poll fails
+            self.server.inject_errors(1)
+            return submit_job(*args)
+        self.host.submit_job = _submit_job
+        zvmutils.METRICS.clear()
+        pi = zvmutils.image_performance_query('zhcp', ['NODE00000'])
+        self.assertEqual(['NODE00000'], list(pi.keys()))
+        self.assertEqual(1, zvmutils.METRICS.get('xdsh_job_poll_errors'))
+        self.assertEqual(1, self.server.stats['errors'])
+
+    def _assert_compressed(self, compression):
+        self.server.compression = compression
+        zvmutils.METRICS.clear()
+        pi = zvmutils.image_performance_query('zhcp', ['NODE00001'])
+        self.assertEqual(['NODE00001'], list(pi.keys()))
+        counters = zvmutils.METRICS.snapshot()
+        self.assertGreater(counters['xcat_bytes.uncompressed'],
+                           counters['xcat_bytes.compressed'])
+        self.assertNotIn('xcat_bytes.identity', counters)
+
+    def test_gzip_response(self):
+        self._assert_compressed('gzip')
+
+    def test_deflate_response(self):
+        self._assert_compressed('deflate')
+
+    def test_raw_deflate_response(self):
+        self._assert_compressed('raw-deflate')
+
+    def test_compression_disabled(self):
+        self.server.compression = 'gzip'
+        self.CONF.set_override('xcat_compression', False, 'zvm')
+        zvmutils.METRICS.clear()
+        self.assertEqual('NODE00000', zvmutils.get_userid('node00000'))
+        counters = zvmutils.METRICS.snapshot()
+        self.assertIn('xcat_bytes.identity', counters)
+        self.assertNotIn('xcat_bytes.compressed', counters)
+
+    def test_error_injection(self):
+        self.server.inject_errors(1)
+        self.assertRaises(zvmutils.ZVMException, zvmutils.get_userid,
+                          'node00000')
+        self.assertEqual('NODE00000', zvmutils.get_userid('node00000'))
+        self.assertEqual(1, self.server.stats['errors'])
+
+    def test_connection_limit(self):
+        self.server.max_connections = 0
+        self.assertRaises(zvmutils.ZVMException, zvmutils.get_userid,
+                          'node00000')
+        self.assertEqual(1, self.server.stats['rejected'])
+
+    def test_request_yields_to_other_green_threads(self):
+        self.server.latency = 0.5
+        ticks = []
+
+        def _ticker():
+            while True:
+                ticks.append(1)
+                eventlet.sleep(0.01)
+
+        ticker = eventlet.spawn(_ticker)
+        self.addCleanup(ticker.kill)
+        eventlet.sleep(0)
+
+        self.assertEqual('NODE00000', zvmutils.get_userid('node00000'))
+        # the ticker kept running while the request waited for the server
+        self.assertGreater(len(ticks), 10)
@@ -13,6 +13,8 @@
 #    under the License.
 
 
+import time
+
 import mock
 
 from ceilometer.compute.virt import inspector as virt_inspertor
@@ -21,6 +23,7 @@ from oslo_utils import timeutils
 from oslotest import base
 
 from ceilometer_zvm.compute.virt.zvm import inspector as zvm_inspector
+from ceilometer_zvm.compute.virt.zvm import scheduler
 from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
 
 
@@ -42,6 +45,9 @@ class TestZVMInspector(base.BaseTestCase):
         self.assertEqual('zhcp', self.inspector.zhcp_info['nodename'])
         self.assertEqual('zhcp.com', self.inspector.zhcp_info['hostname'])
         self.assertEqual('zhcp', self.inspector.zhcp_info['userid'])
+        self.assertEqual(0, self.inspector.cache.ttl)
+        self.assertEqual(2, self.inspector.cache.max_cycles)
+        self.assertEqual(20000, self.inspector.cache.max_entries)
 
     @mock.patch.object(zvmutils, 'image_performance_query')
     def test_update_inst_cpu_mem_stat(self, ipq):
@@ -66,11 +72,50 @@ class TestZVMInspector(base.BaseTestCase):
             self.inspector.cache.get('cpumem', 'inst2')['guest_cpus'])
 
     @mock.patch.object(zvmutils, 'image_performance_query')
-    def test_update_inst_cpu_mem_stat_invalid_data(self, ipq):
-        ipq.return_value = {'INST1': {'userid': 'INST1', 'guest_cpus': 's'}}
-        self.assertRaises(zvmutils.ZVMException,
-                          self.inspector._update_inst_cpu_mem_stat,
-                          {'inst1': 'INST1'})
+    def test_update_inst_cpu_mem_stat_extra_fields(self, ipq):
+        ipq.return_value = {'INST1': {'userid': 'INST1',
+                                      'guest_cpus': '2',
+                                      'used_cpu_time': '1710205201 uS',
+                                      'used_memory': '4189268 KB',
+                                      'max_memory': '8388608 KB'}}
+        self.inspector._update_inst_cpu_mem_stat({'inst1': 'INST1'})
+        self.assertEqual({'max_memory': 8388608},
+            self.inspector.cache.get('cpumem', 'inst1')['extra'])
+
+    @mock.patch.object(zvmutils, 'skip_invalid_record')
+    @mock.patch.object(zvmutils, 'image_performance_query')
+    def test_update_inst_cpu_mem_stat_invalid_extra_field(self, ipq, skip):
+        self.CONF.set_override('ipq_extra_fields',
+                               ['max_memory', 'processor_share'], 'zvm')
+        ipq.return_value = {'INST1': {'userid': 'INST1',
+                                      'guest_cpus': '2',
+                                      'used_cpu_time': '1710205201 uS',
+                                      'used_memory': '4189268 KB',
+                                      'max_memory': '8388608 KB',
+                                      'processor_share': 'LIMITED'}}
+        zvmutils.METRICS.clear()
+        self.inspector._update_inst_cpu_mem_stat({'inst1': 'INST1'})
+        inst_stat = self.inspector.cache.get('cpumem', 'inst1')
+        self.assertEqual(2, inst_stat['guest_cpus'])
+        self.assertEqual({'max_memory': 8388608}, inst_stat['extra'])
+        self.assertFalse(skip.called)
+        self.assertEqual(1,
+            zvmutils.METRICS.get('invalid_fields.processor_share'))
+
+    @mock.patch.object(zvmutils, 'skip_invalid_record')
+    @mock.patch.object(zvmutils, 'image_performance_query')
+    def test_update_inst_cpu_mem_stat_invalid_data(self, ipq, skip):
+        ipq.return_value = {'INST1': {'userid': 'INST1', 'guest_cpus': 's'},
+                            'INST2': {'userid': 'INST2',
+                                      'guest_cpus': '4',
+                                      'used_cpu_time': '1710205201 uS',
+                                      'used_memory': '4189268 KB'}}
+        self.inspector._update_inst_cpu_mem_stat({'inst1': 'INST1',
+                                                  'inst2': 'INST2'})
+        self.assertIsNone(self.inspector.cache.get('cpumem', 'inst1'))
+        self.assertEqual(4,
+            self.inspector.cache.get('cpumem', 'inst2')['guest_cpus'])
+        self.assertEqual(1, skip.call_count)
 
     @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
                 "_update_inst_cpu_mem_stat")
@@ -82,6 +127,157 @@ class TestZVMInspector(base.BaseTestCase):
         list_inst.assert_called_with(self.inspector.zhcp_info)
         upd.assert_called_with(inst_list)
 
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_update_inst_nic_stat")
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_update_inst_cpu_mem_stat")
+    @mock.patch.object(zvmutils, 'list_instances')
+    def test_update_cache_tiered(self, list_inst, upd, upd_nic):
+        self.inspector.tiers = mock.Mock()
+        self.inspector.tiers.select.return_value = set(['INST1'])
+        self.inspector.instances = {'inst1': 'INST1', 'inst2': 'INST2',
+                                    'inst3': 'INST3'}
+        for inst_name, userid in self.inspector.instances.items():
+            self.inspector.cache.set('cpumem', {'nodename': inst_name,
+                                                'userid': userid})
+        list_inst.return_value = {'inst1': 'INST1', 'inst2': 'INST2'}
+
+        self.inspector._update_cache('vnics', {})
+        upd.assert_called_once_with({'inst1': 'INST1'})
+        upd_nic.assert_called_once_with({'inst1': 'INST1', 'inst2': 'INST2'})
+        # the quiet guest keeps its stats, the departed one is dropped
+        self.assertIsNotNone(self.inspector.cache.get('cpumem', 'inst2'))
+        self.assertIsNone(self.inspector.cache.get('cpumem', 'inst3'))
+
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_update_inst_nic_stat")
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_update_inst_cpu_mem_stat")
+    @mock.patch.object(zvmutils, 'list_instances')
+    def test_update_cache_demand(self, list_inst, upd, upd_nic):
+        self.inspector.demand = scheduler.DemandTracker(600)
+        instances = {'inst1': 'INST1', 'inst2': 'INST2', 'inst3': 'INST3'}
+        list_inst.return_value = instances
+        now = time.time()
+        self.inspector.demand.record('cpumem', 'inst1', now)
+        # until the meter was read for a window, every guest is refreshed
+        self.inspector._update_cache('cpumem')
+        upd.assert_called_once_with(instances)
+
+        self.inspector.demand.since['cpumem'] = now - 900
+        self.inspector.demand.record('cpumem', 'inst2', now)
+        # nobody reads the NICs, the vswitches are never queried
+        upd.reset_mock()
+        self.inspector._update_cache('cpumem')
+        upd.assert_called_once_with({'inst1': 'INST1', 'inst2': 'INST2'})
+        upd_nic.assert_not_called()
+
+        # once read, the NICs are refreshed along with the cpu stats
+        self.inspector.demand.record('vnics', 'inst3', now - 900)
+        self.inspector.demand.record('vnics', 'inst3', now)
+        upd.reset_mock()
+        self.inspector._update_cache('cpumem')
+        upd.assert_called_once_with({'inst1': 'INST1', 'inst2': 'INST2'})
+        upd_nic.assert_called_once_with({'inst3': 'INST3'})
+
+    @mock.patch.object(zvmutils, 'image_performance_query')
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_check_expiration_and_update_cache")
+    def test_cache_misses_batched(self, check_update, ipq):
+        self.inspector.instances = {'inst%d' % i: 'INST%d' % i
+                                    for i in range(5)}
+        ipq.side_effect = lambda node, userids: dict(
+            (u, {'guest_cpus': '1', 'used_cpu_time': '100 uS',
+                 'used_memory': '1024 KB'}) for u in userids)
+        for inst_name in sorted(self.inspector.instances):
+            self.inspector._get_inst_stat_by_name('cpumem', inst_name)
+        ipq.assert_called_once_with('zhcp', mock.ANY)
+        self.assertEqual(sorted(self.inspector.instances.values()),
+                         sorted(ipq.call_args[0][1]))
+
+    def test_plan_degradation(self):
+        self.inspector.instances = {'inst1': 'INST1'}
+        self.inspector.phase_durations = {'inventory': 20, 'vnics': 30,
+                                          'cpumem': 10}
+        zvmutils.METRICS.clear()
+        self.addCleanup(zvmutils.METRICS.clear)
+
+        self.assertEqual(set(), self.inspector._plan_degradation('vnics'))
+        now = time.time()
+        with zvmutils.request_deadline(now + 60):
+            self.assertEqual(set(),
+                             self.inspector._plan_degradation('vnics'))
+        with zvmutils.request_deadline(now + 40):
+            self.assertEqual(set(['skip_vswitch']),
+                             self.inspector._plan_degradation('vnics'))
+        with zvmutils.request_deadline(now + 15):
+            self.assertEqual(set(['skip_vswitch', 'reuse_inventory']),
+                             self.inspector._plan_degradation('vnics'))
+            self.assertEqual(set(['reuse_inventory']),
+                             self.inspector._plan_degradation('cpumem'))
+        self.assertEqual(2, zvmutils.METRICS.get('degraded.skip_vswitch'))
+        self.assertEqual(2, zvmutils.METRICS.get('degraded.reuse_inventory'))
+
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_update_inst_nic_stat")
+    @mock.patch.object(zvmutils, 'list_instances')
+    def test_update_cache_skip_vswitch(self, list_inst, upd_nic):
+        self.inspector.instances = {'inst1': 'INST1'}
+        list_inst.return_value = {'inst1': 'INST1'}
+        self.inspector.cache.set('vnics', {'nodename': 'inst1',
+                                           'userid': 'INST1', 'nics': []})
+        with mock.patch.object(self.inspector, '_plan_degradation',
+                               return_value=set(['skip_vswitch'])):
+            self.inspector._update_cache('vnics')
+        upd_nic.assert_not_called()
+        self.assertIsNotNone(self.inspector.cache.get('vnics', 'inst1'))
+
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_update_inst_cpu_mem_stat")
+    @mock.patch.object(zvmutils, 'list_instances')
+    def test_update_cache_budget_exhausted(self, list_inst, upd):
+        self.inspector.instances = {'inst1': 'INST1'}
+        list_inst.return_value = {'inst1': 'INST1'}
+        stat = {'nodename': 'inst1', 'userid': 'INST1', 'guest_cpus': 2}
+        self.inspector.cache.set('cpumem', stat)
+        upd.side_effect = zvmutils.ZVMDeadlineExceeded('late')
+        zvmutils.METRICS.clear()
+        self.addCleanup(zvmutils.METRICS.clear)
+
+        self.inspector._update_cache('cpumem')
+        self.assertEqual(stat, self.inspector.cache.get('cpumem', 'inst1'))
+        self.assertEqual(1, zvmutils.METRICS.get('degraded.stale'))
+
+    @mock.patch.object(zvmutils, 'zhcp_helper_query')
+    @mock.patch.object(zvmutils, 'deploy_zhcp_helper')
+    def test_update_cache_zhcp_helper(self, deploy, query):
+        self.CONF.set_override('zhcp_helper', True, 'zvm')
+        deploy.return_value = '/opt/h.py'
+        query.return_value = {'cpumem': {'INST1': (2, 1000, 4096,
+                                                   {'max_memory': 8192})},
+                              'vnics': {}}
+        self.inspector._update_cache('cpumem', {'inst1': 'INST1'})
+        self.inspector._update_cache('cpumem', {'inst1': 'INST1'})
+
+        deploy.assert_called_once_with('zhcp')
+        query.assert_called_with('zhcp', '/opt/h.py', 'cpumem',
+                                 mock.ANY, [])
+        self.assertEqual({'nodename': 'inst1', 'userid': 'INST1',
+                          'guest_cpus': 2, 'used_cpu_time': 1000000,
+                          'used_memory': 4, 'extra': {'max_memory': 8192}},
+                         self.inspector.cache.get('cpumem', 'inst1'))
+
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_update_inst_cpu_mem_stat")
+    @mock.patch.object(zvmutils, 'zhcp_helper_query')
+    @mock.patch.object(zvmutils, 'deploy_zhcp_helper')
+    def test_update_cache_zhcp_helper_fallback(self, deploy, query, upd):
+        self.CONF.set_override('zhcp_helper', True, 'zvm')
+        query.side_effect = zvmutils.ZVMException('no python')
+        self.inspector._update_cache('cpumem', {'inst1': 'INST1'})
+        upd.assert_called_once_with({'inst1': 'INST1'})
+        self.assertIsNone(self.inspector.zhcp_helper_path)
+
     @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
                 "_update_inst_cpu_mem_stat")
     def test_update_cache_one_inst(self, upd):
@@ -102,6 +298,16 @@ class TestZVMInspector(base.BaseTestCase):
         self.inspector._check_expiration_and_update_cache('cpus')
         udc.assert_not_called()
 
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_update_cache")
+    def test_check_expiration_and_update_cache_scheduled(self, udc):
+        self.inspector.scheduler = mock.Mock()
+        self.inspector.scheduler.next_expiration.return_value = 12345
+        self.inspector._check_expiration_and_update_cache('cpus')
+        udc.assert_called_once_with('cpus')
+        self.inspector.scheduler.record_read.assert_called_once_with()
+        self.assertEqual(12345, self.inspector.cache_expiration)
+
     @mock.patch.object(zvmutils, 'get_inst_name')
     @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
                 "_check_expiration_and_update_cache")
@@ -116,14 +322,14 @@ class TestZVMInspector(base.BaseTestCase):
 
     @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
                 "_update_cache")
-    @mock.patch.object(zvmutils, 'get_userid')
+    @mock.patch.object(zvmutils, 'get_userids')
     @mock.patch.object(zvmutils, 'get_inst_name')
     @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
                 "_check_expiration_and_update_cache")
     def test_get_inst_stat_not_found(self, check_update, get_name,
-                                     get_uid, update):
+                                     get_uids, update):
         get_name.return_value = 'inst1'
-        get_uid.return_value = 'INST1'
+        get_uids.return_value = {'inst1': 'INST1'}
 
         self.assertRaises(virt_inspertor.InstanceNotFoundException,
                           self.inspector._get_inst_stat, 'cpumem',
@@ -131,6 +337,25 @@ class TestZVMInspector(base.BaseTestCase):
         check_update.assert_called_once_with('cpumem')
         update.assert_called_once_with('cpumem', {'inst1': 'INST1'})
 
+    @mock.patch.object(zvmutils, 'get_userids')
+    def test_get_userid_bulk_resolved_once(self, get_uids):
+        get_uids.return_value = {'inst1': 'INST1', 'inst2': 'INST2'}
+        self.assertEqual('INST1', self.inspector._get_userid('inst1'))
+        self.assertEqual('INST2', self.inspector._get_userid('inst2'))
+        self.assertIsNone(self.inspector._get_userid('inst3'))
+        self.assertIsNone(self.inspector._get_userid('inst3'))
+        self.assertEqual(2, get_uids.call_count)
+
+    @mock.patch.object(zvmutils, 'list_instances')
+    def test_update_cache_inventory_change_invalidates_userids(self,
+                                                                list_inst):
+        self.inspector.userids.update({'inst9': 'INST9'})
+        list_inst.return_value = {'inst1': 'INST1'}
+        with mock.patch.object(self.inspector, '_update_inst_cpu_mem_stat'):
+            self.inspector._update_cache('cpumem')
+        self.assertNotIn('inst9', self.inspector.userids)
+        self.assertEqual('INST1', self.inspector.userids.get('inst1'))
+
     @mock.patch.object(zvmutils, 'get_inst_power_state')
     @mock.patch.object(zvmutils, 'get_inst_name')
     def test_get_inst_stat_shutoff(self, get_name, get_power_stat):
@@ -146,16 +371,16 @@ class TestZVMInspector(base.BaseTestCase):
 
     @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
                 "_update_cache")
-    @mock.patch.object(zvmutils, 'get_userid')
+    @mock.patch.object(zvmutils, 'get_userids')
     @mock.patch("ceilometer_zvm.compute.virt.zvm.utils.CacheData.get")
     @mock.patch.object(zvmutils, 'get_inst_name')
     @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
                 "_check_expiration_and_update_cache")
     def test_get_inst_stat_update_cache(self, check_update, get_name,
-                                        cache_get, get_uid, update):
+                                        cache_get, get_uids, update):
         get_name.return_value = 'inst1'
         cache_get.side_effect = [None, {'guest_cpus': 2, 'nodename': 'inst1'}]
-        get_uid.return_value = 'INST1'
+        get_uids.return_value = {'inst1': 'INST1'}
 
         inst_stat = self.inspector._get_inst_stat('cpus', {'inst1': 'INST1'})
         self.assertEqual(2, inst_stat['guest_cpus'])
@@ -205,6 +430,79 @@ class TestZVMInspector(base.BaseTestCase):
         self.assertEqual(1998, mem_usage.usage)
         get_stat.assert_called_once_with('cpumem', None)
 
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_get_inst_stat")
+    def test_inspect_memory_resident(self, get_stat):
+        get_stat.return_value = {'used_memory': 1998}
+        mem = self.inspector.inspect_memory_resident(None)
+        self.assertEqual(1998, mem.resident)
+
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_get_inst_stat")
+    def test_inspect_memory_allocated(self, get_stat):
+        get_stat.return_value = {'nodename': 'inst1', 'used_memory': 1998,
+                                 'extra': {'max_memory': 8388608}}
+        mem = self.inspector.inspect_memory_allocated(None)
+        self.assertEqual(8192, mem.allocated)
+
+        get_stat.return_value = {'nodename': 'inst1', 'used_memory': 1998}
+        self.assertRaises(virt_inspertor.InstanceNoDataException,
+                          self.inspector.inspect_memory_allocated, None)
+
+    @mock.patch.object(zvmutils, 'indicate_user_io')
+    @mock.patch.object(zvmutils, 'list_instances')
+    def test_update_disk_cache(self, list_inst, io):
+        list_inst.return_value = {'inst1': 'INST1', 'inst2': 'INST2'}
+        io.return_value = {'INST1': 150}
+        self.inspector._check_expiration_and_update_cache('disks')
+
+        self.assertEqual({'nodename': 'inst1', 'userid': 'INST1',
+                          'io_count': 150, 'iops': None},
+                         self.inspector.cache.get('disks', 'inst1'))
+        self.assertIsNone(self.inspector.cache.get('disks', 'inst2'))
+        # disks are refreshed in the cycle of the other meters
+        self.assertEqual(1, self.inspector.cache.cycles['disks'])
+        self.assertGreater(self.inspector.cache_expiration, time.time())
+
+        self.inspector._check_expiration_and_update_cache('disks')
+        self.assertEqual(1, io.call_count)
+
+    @mock.patch.object(time, 'time')
+    @mock.patch.object(zvmutils, 'indicate_user_io')
+    def test_update_inst_disk_stat_iops(self, io, now):
+        instances = {'inst1': 'INST1'}
+        io.return_value = {'INST1': 150}
+        now.return_value = 1000.0
+        self.inspector._update_inst_disk_stat(instances)
+        io.return_value = {'INST1': 750}
+        now.return_value = 1060.0
+        self.inspector._update_inst_disk_stat(instances)
+        self.assertEqual(10, self.inspector.cache.get('disks',
+                                                      'inst1')['iops'])
+        # the counter restarts when the guest logs on again
+        io.return_value = {'INST1': 5}
+        now.return_value = 1120.0
+        self.inspector._update_inst_disk_stat(instances)
+        self.assertIsNone(self.inspector.cache.get('disks', 'inst1')['iops'])
+
+    @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
+                "_get_inst_stat")
+    def test_inspect_disk_iops(self, get_stat):
+        get_stat.return_value = {'nodename': 'inst1', 'userid': 'INST1',
+                                 'io_count': 150, 'iops': 2.5}
+        disks = list(self.inspector.inspect_disk_iops(None))
+        self.assertEqual([(virt_inspertor.Disk(device='all'),
+                           virt_inspertor.DiskIOPSStats(iops_count=2.5))],
+                         disks)
+        get_stat.assert_called_once_with('disks', None)
+
+        get_stat.return_value['iops'] = None
+        self.assertRaises(virt_inspertor.InstanceNoDataException,
+                          list, self.inspector.inspect_disk_iops(None))
+        # reads and writes are not told apart
+        self.assertRaises(NotImplementedError, self.inspector.inspect_disks,
+                          None)
+
     @mock.patch.object(zvmutils, 'virutal_network_vswitch_query_iuo_stats')
     def test_update_inst_nic_stat(self, vswq):
         vsw_dist = {'vswitches': [
@@ -283,6 +581,106 @@ class TestZVMInspector(base.BaseTestCase):
                          self.inspector.cache.get('vnics', 'inst1')['nics'])
         vswq.assert_called_once_with('zhcp')
 
+    def _vsw(self, name, userids, nic_rx='1000'):
+        nics = [{'userid': userid, 'vdev': '0600', 'nic_fr_rx': '1',
+                 'nic_fr_rx_dsc': '0', 'nic_fr_rx_err': '0',
+                 'nic_fr_tx': '1', 'nic_fr_tx_dsc': '0',
+                 'nic_fr_tx_err': '0', 'nic_rx': nic_rx, 'nic_tx': '1000'}
+                for userid in userids]
+        return {'vswitch_name': name, 'nics': nics}
+
+    @mock.patch.object(zvmutils, 'virutal_network_vswitch_query_iuo_stats')
+    def test_update_inst_nic_stat_learn_vswitches(self, vswq):
+        self.inspector.instances = {'inst1': 'INST1'}
+        vswq.return_value = {'vswitch_count': 2,
+                             'vswitches': [self._vsw('VSW1', ['INST1']),
+                                           self._vsw('VSW2', ['OTHER'])]}
+        self.inspector._update_inst_nic_stat({'inst1': 'INST1'})
+        self.assertEqual(['VSW1'], self.inspector.metered_vswitches)
+
+        self.inspector.cache.clear()
+        vswq.return_value = {'vswitch_count': 1,
+                             'vswitches': [self._vsw('VSW1', ['INST1'],
+                                                     '2000')]}
+        self.inspector._update_inst_nic_stat({'inst1': 'INST1'})
+        vswq.assert_called_with('zhcp', 'VSW1')
+        self.assertEqual(2000,
+            self.inspector.cache.get('vnics', 'inst1')['nics'][0]['nic_rx'])
+
+    @mock.patch.object(zvmutils, 'virutal_network_vswitch_query_iuo_stats')
+    def test_update_inst_nic_stat_keep_cached_vswitch(self, vswq):
+        self.CONF.set_override('zvm_vswitches', ['VSW1', 'VSW2'], 'zvm')
+        self.inspector.vswitches = {'VSW2': self._vsw('VSW2', ['INST1'])}
+
+        def _query(zhcp, vsw_name):
+            if vsw_name == 'VSW2':
+                raise zvmutils.ZVMException('timeout')
+            return {'vswitch_count': 1,
+                    'vswitches': [self._vsw('VSW1', ['INST1'])]}
+        vswq.side_effect = _query
+
+        self.inspector._update_inst_nic_stat({'inst1': 'INST1'})
+        nics = self.inspector.cache.get('vnics', 'inst1')['nics']
+        self.assertEqual(['VSW1', 'VSW2'],
+                         sorted(nic['vswitch_name'] for nic in nics))
+        self.assertEqual(2, vswq.call_count)
+
+        # stats that could not be refreshed for a while are dropped
+        for i in range(self.inspector.VSWITCH_STALE_CYCLES - 1):
+            self.inspector.cache.clear()
+            self.inspector._update_inst_nic_stat({'inst1': 'INST1'})
+        nics = self.inspector.cache.get('vnics', 'inst1')['nics']
+        self.assertEqual(['VSW1'], [nic['vswitch_name'] for nic in nics])
+
+    @mock.patch.object(zvmutils, 'virutal_network_vswitch_query_iuo_stats')
+    def test_update_inst_nic_stat_no_vswitch_in_use(self, vswq):
+        self.inspector.instances = {'inst1': 'INST1'}
+        vswq.return_value = {'vswitch_count': 1,
+                             'vswitches': [self._vsw('VSW1', ['OTHER'])]}
+        self.inspector._update_inst_nic_stat({'inst1': 'INST1'})
+        self.assertEqual([], self.inspector.metered_vswitches)
+        # nothing to query until the vswitches are learned again
+        self.inspector._update_inst_nic_stat({'inst1': 'INST1'})
+        self.assertEqual(1, vswq.call_count)
+        self.assertIsNone(self.inspector.cache.get('vnics', 'inst1'))
+        with mock.patch.object(zvmutils, 'zhcp_helper_query') as query:
+            self.assertTrue(self.inspector._update_inst_stat_by_zhcp_helper(
+                                        'vnics', {'inst1': 'INST1'}))
+        query.assert_not_called()
+
+    @mock.patch.object(zvmutils, 'virutal_network_vswitch_query_iuo_stats')
+    def test_update_inst_nic_stat_relearn_vswitches(self, vswq):
+        self.inspector.instances = {'inst1': 'INST1'}
+        vswq.return_value = {'vswitch_count': 1,
+                             'vswitches': [self._vsw('VSW1', ['INST1'])]}
+        self.inspector._update_inst_nic_stat({'inst1': 'INST1'})
+        vswq.return_value = {'vswitch_count': 1,
+                             'vswitches': [self._vsw('VSW2', ['INST1'])]}
+        self.inspector.cache.cycles['vnics'] += (
+                                    self.inspector.VSWITCH_RELEARN_CYCLES)
+        self.inspector._update_inst_nic_stat({'inst1': 'INST1'})
+        vswq.assert_called_with('zhcp')
+        self.assertEqual(['VSW2'], self.inspector.metered_vswitches)
+
+    @mock.patch.object(zvmutils, 'skip_invalid_record')
+    @mock.patch.object(zvmutils, 'virutal_network_vswitch_query_iuo_stats')
+    def test_update_inst_nic_stat_invalid_data(self, vswq, skip):
+        nic = {'nic_fr_rx_dsc': '0', 'nic_fr_rx_err': '0',
+               'nic_fr_tx_err': '0', 'nic_rx': '4684435',
+               'nic_fr_rx': '34958', 'nic_fr_tx': '16211',
+               'nic_fr_tx_dsc': '0', 'nic_tx': '3316601'}
+        bad_nic = dict(nic, userid='INST1', vdev='0600', nic_rx='x')
+        good_nic = dict(nic, userid='INST2', vdev='0600')
+        vswq.return_value = {'vswitch_count': 1,
+                             'vswitches': [{'vswitch_name': 'XCATVSW1',
+                                            'nics': [bad_nic, good_nic]}]}
+        self.inspector._update_inst_nic_stat({'inst1': 'INST1',
+                                              'inst2': 'INST2'})
+        self.assertIsNone(self.inspector.cache.get('vnics', 'inst1'))
+        self.assertEqual(4684435,
+            self.inspector.cache.get('vnics', 'inst2')['nics'][0]['nic_rx'])
+        self.assertEqual(1, skip.call_count)
+
     @mock.patch("ceilometer_zvm.compute.virt.zvm.inspector.ZVMInspector."
                 "_get_inst_stat")
     def test_inspect_nics(self, get_stat):
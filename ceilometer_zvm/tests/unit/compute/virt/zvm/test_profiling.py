@@ -0,0 +1,96 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import os
+import shutil
+import signal
+import tempfile
+
+import mock
+from oslo_config import fixture as fixture_config
+from oslotest import base
+
+from ceilometer_zvm.compute.virt.zvm import profiling
+
+
+class TestProfiler(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestProfiler, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.CONF = self.useFixture(
+                            fixture_config.Config(profiling.CONF)).conf
+        self.CONF.set_override('profile_dir',
+                               os.path.join(self.tmpdir, 'profiles'), 'zvm')
+        self.CONF.set_override('profile_cycles', 2, 'zvm')
+        self.profiler = profiling.Profiler()
+
+    def _refresh(self):
+        with self.profiler.profile('refresh-cpumem'):
+            sorted(str(i) for i in range(1000))
+
+    def _files(self):
+        path = self.CONF.zvm.profile_dir
+        return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+    def test_disarmed(self):
+        self._refresh()
+        self.assertEqual([], self._files())
+
+    def test_profiles_armed_cycles_only(self):
+        self.profiler.arm()
+        with mock.patch('time.strftime', side_effect=['1', '2']):
+            for i in range(3):
+                self._refresh()
+        files = self._files()
+        self.assertEqual(4, len(files))
+        self.assertTrue(files[0].startswith('refresh-cpumem-1-'))
+        with open(os.path.join(self.CONF.zvm.profile_dir,
+                               files[1])) as report:
+            content = report.read()
+        self.assertIn('function calls', content)
+        if profiling.tracemalloc is not None:
+            self.assertIn('Top allocation sites:', content)
+        self.assertEqual(0, self.profiler.remaining)
+
+    def test_capture_stops_on_error(self):
+        self.profiler.arm(1)
+
+        def _fail():
+            with self.profiler.profile('refresh-vnics'):
+                raise ValueError()
+        self.assertRaises(ValueError, _fail)
+        self.assertFalse(self.profiler.active)
+        self.assertEqual(2, len(self._files()))
+        if profiling.tracemalloc is not None:
+            self.assertFalse(profiling.tracemalloc.is_tracing())
+
+    @mock.patch.object(signal, 'signal')
+    def test_signal_handler(self, sig):
+        self.profiler.install_signal_handler()
+        sig.assert_not_called()
+
+        self.CONF.set_override('profile_signal', 'SIGUSR1', 'zvm')
+        self.profiler.install_signal_handler()
+        sig.assert_called_once_with(signal.SIGUSR1,
+                                    self.profiler._handle_signal)
+        self.profiler._handle_signal(signal.SIGUSR1, None)
+        self.assertEqual(2, self.profiler.remaining)
+
+    def test_unknown_signal(self):
+        self.CONF.set_override('profile_signal', 'SIGNOPE', 'zvm')
+        self.profiler.install_signal_handler()
+        self.assertFalse(self.profiler.installed)
@@ -0,0 +1,161 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+from oslotest import base
+
+from ceilometer_zvm.compute.virt.zvm import scheduler
+
+
+class TestRefreshScheduler(base.BaseTestCase):
+
+    def _poll(self, sched, start, reads=5, step=1):
+        for i in range(reads):
+            sched.record_read(start + i * step)
+
+    def test_fixed_interval(self):
+        sched = scheduler.RefreshScheduler(600)
+        self._poll(sched, 1000)
+        self._poll(sched, 1300)
+        self.assertEqual(1900, sched.next_expiration(1300, 2))
+
+    def test_adaptive_unknown_period(self):
+        sched = scheduler.RefreshScheduler(600, adaptive=True)
+        self._poll(sched, 1000)
+        self.assertIsNone(sched.period())
+        self.assertEqual(1600, sched.next_expiration(1000, 2))
+
+    def test_adaptive_aligned_to_cycle(self):
+        sched = scheduler.RefreshScheduler(600, adaptive=True,
+                                           min_interval=30)
+        for start in (1000, 1300, 1600):
+            self._poll(sched, start, reads=11)
+        self.assertEqual(300, sched.period())
+        # halfway between the last read of the cycle (+10s) and the next
+        # expected cycle start (+300s)
+        self.assertEqual(1755, sched.next_expiration(1600, 2))
+
+    def test_adaptive_spaced_by_latency(self):
+        sched = scheduler.RefreshScheduler(600, adaptive=True,
+                                           min_interval=30)
+        for start in (1000, 1060, 1120):
+            self._poll(sched, start)
+        self.assertEqual(60, sched.period())
+        # a 20s refresh is not repeated within 10 times its duration
+        self.assertEqual(1320, sched.next_expiration(1120, 20))
+
+    def test_cycle_gap_follows_period(self):
+        sched = scheduler.RefreshScheduler(600, adaptive=True)
+        for start in (1000, 1040, 1080):
+            sched.record_read(start)
+        self.assertEqual(40, sched.period())
+        # closer than MAX_CYCLE_GAP but more than half a period apart
+        sched.record_read(1105)
+        self.assertEqual(4, len(sched.cycle_starts))
+
+
+class TestTieredSelector(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestTieredSelector, self).setUp()
+        self.tiers = scheduler.TieredSelector(4, 5.0, 1000)
+        self.userids = ['GUEST%02d' % i for i in range(20)]
+
+    def _cycle(self, now):
+        selected = self.tiers.select(self.userids)
+        for userid in selected:
+            self.tiers.record_cpu(userid, 0, now)
+        return selected
+
+    def test_first_cycle_refreshes_all(self):
+        self.assertEqual(set(self.userids), self._cycle(0))
+
+    def test_quiet_guests_rotate(self):
+        self._cycle(0)
+        seen = []
+        for i in range(1, 5):
+            selected = self._cycle(i * 60)
+            self.assertLess(len(selected), len(self.userids))
+            seen.extend(selected)
+        # every guest refreshed exactly once within max_age cycles
+        self.assertEqual(sorted(self.userids), sorted(seen))
+
+    def test_busy_guest_refreshed_every_cycle(self):
+        self._cycle(0)
+        # 30 seconds of cpu in 60 seconds, 50% of one cpu
+        self.tiers.record_cpu('GUEST00', 30 * 1000000, 60)
+        for i in range(2, 5):
+            self.assertIn('GUEST00', self._cycle(i * 60))
+        self.assertFalse(self.tiers.is_hot('GUEST01'))
+
+    def test_nic_traffic_makes_guest_hot(self):
+        self.tiers.record_nic('GUEST01', 0, 0)
+        self.tiers.record_nic('GUEST01', 120000, 60)
+        self.assertTrue(self.tiers.is_hot('GUEST01'))
+
+    def test_counter_reset_ignored(self):
+        self.tiers.record_nic('GUEST01', 120000, 0)
+        self.tiers.record_nic('GUEST01', 0, 60)
+        self.assertFalse(self.tiers.is_hot('GUEST01'))
+
+    def test_departed_guests_forgotten(self):
+        self._cycle(0)
+        self.userids = self.userids[:5]
+        self._cycle(60)
+        self.assertEqual(set(self.userids), set(self.tiers.refreshed))
+
+
+class TestDemandTracker(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestDemandTracker, self).setUp()
+        self.demand = scheduler.DemandTracker(300)
+        self.instances = {'inst1': 'INST1', 'inst2': 'INST2'}
+
+    def test_nothing_read(self):
+        self.assertEqual(set(), self.demand.meters(1000))
+        # no history yet, every guest may be read
+        self.assertEqual(self.instances,
+                         self.demand.instances('cpumem', self.instances,
+                                               1000))
+
+    def test_first_window(self):
+        self.demand.record('cpumem', 'inst1', 1000)
+        self.assertEqual(self.instances,
+                         self.demand.instances('cpumem', self.instances,
+                                               1299))
+        self.assertEqual({'inst1': 'INST1'},
+                         self.demand.instances('cpumem', self.instances,
+                                               1300))
+
+    def test_window(self):
+        self.demand.record('cpumem', 'inst1', 700)
+        self.demand.record('vnics', 'inst2', 700)
+        self.demand.record('cpumem', 'inst1', 1000)
+        self.demand.record('vnics', 'inst2', 1000)
+        self.demand.record('cpumem', 'inst2', 1200)
+        self.assertEqual(set(['cpumem', 'vnics']), self.demand.meters(1250))
+        self.assertEqual(self.instances,
+                         self.demand.instances('cpumem', self.instances,
+                                               1250))
+        self.assertEqual(set(['cpumem']), self.demand.meters(1400))
+        self.assertEqual({'inst2': 'INST2'},
+                         self.demand.instances('cpumem', self.instances,
+                                               1400))
+
+    def test_retain(self):
+        self.demand.record('cpumem', 'inst1', 1000)
+        self.demand.record('cpumem', 'inst3', 1000)
+        self.demand.retain(self.instances)
+        self.assertEqual({'inst1': 1000}, self.demand.reads['cpumem'])
@@ -0,0 +1,180 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import time
+
+import fixtures
+import mock
+from oslo_config import fixture as fixture_config
+from oslotest import base
+
+from ceilometer_zvm.compute.virt.zvm import inspector as zvm_inspector
+from ceilometer_zvm.compute.virt.zvm import sharedcache
+from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
+
+
+class FakeMemcacheClient(object):
+    """In-process stand-in of a memcache client."""
+
+    def __init__(self, servers=None):
+        self.items = {}
+
+    def _alive(self, key):
+        item = self.items.get(key)
+        if item is not None and item[1] and item[1] <= time.time():
+            del self.items[key]
+            item = None
+        return item
+
+    def get(self, key):
+        item = self._alive(key)
+        return None if item is None else item[0]
+
+    def set(self, key, value, time=0):
+        self.items[key] = (value, _expiry(time))
+        return True
+
+    def add(self, key, value, time=0):
+        if self._alive(key) is not None:
+            return False
+        return self.set(key, value, time)
+
+    def delete(self, key):
+        self.items.pop(key, None)
+        return True
+
+
+def _expiry(ttl):
+    return time.time() + ttl if ttl else 0
+
+
+class TestSharedCache(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestSharedCache, self).setUp()
+        self.client = FakeMemcacheClient()
+        self.node1 = sharedcache.SharedCache(self.client, 'p:host')
+        self.node2 = sharedcache.SharedCache(self.client, 'p:host')
+        self.node2.owner = 'node2:1'
+
+    def test_lease(self):
+        self.assertTrue(self.node1.acquire('cpumem', 600))
+        self.assertFalse(self.node2.acquire('cpumem', 600))
+        # the holder renews its own lease
+        self.assertTrue(self.node1.acquire('cpumem', 600))
+        self.assertTrue(self.node2.acquire('vnics', 600))
+
+        self.client.delete('p:host:cpumem:lease')
+        self.assertTrue(self.node2.acquire('cpumem', 600))
+        self.assertFalse(self.node1.acquire('cpumem', 600))
+
+    def test_publish_and_fetch(self):
+        self.useFixture(fixtures.MockPatchObject(sharedcache,
+                                                 'CHUNK_ENTRIES', 2))
+        entries = dict(('inst%d' % i, {'nodename': 'inst%d' % i,
+                                       'guest_cpus': i})
+                       for i in range(5))
+        self.assertIsNone(self.node2.fetch('cpumem'))
+        self.node1.publish('cpumem', entries, 600)
+        self.assertEqual(entries, self.node2.fetch('cpumem'))
+        # nothing newer since the last fetch
+        self.assertIsNone(self.node2.fetch('cpumem'))
+
+        self.node1.publish('cpumem', entries, 600)
+        version = self.node1.versions['cpumem']
+        self.client.delete('p:host:cpumem:%s:1' % version)
+        self.assertIsNone(self.node2.fetch('cpumem'))
+
+    @mock.patch.object(sharedcache.eventlet, 'sleep')
+    def test_wait_timeout(self, sleep):
+        self.assertIsNone(self.node2.wait('cpumem', 0))
+        sleep.assert_not_called()
+
+
+class TestSharedRefresh(base.BaseTestCase):
+
+    def setUp(self):
+        self.CONF = self.useFixture(
+                            fixture_config.Config(zvm_inspector.CONF)).conf
+        super(TestSharedRefresh, self).setUp()
+        self.CONF.set_override('cache_lease_wait', 0, 'zvm')
+        self.client = FakeMemcacheClient()
+        self.node1 = self._inspector('node1:1')
+        self.node2 = self._inspector('node2:1')
+
+    def _inspector(self, owner):
+        with mock.patch.multiple(zvmutils, get_node_hostname=mock.Mock(),
+                                 get_userid=mock.Mock()):
+            inspector = zvm_inspector.ZVMInspector()
+        inspector.shared = sharedcache.SharedCache(self.client, 'p:host')
+        inspector.shared.owner = owner
+        return inspector
+
+    @mock.patch.object(zvmutils, 'image_performance_query')
+    @mock.patch.object(zvmutils, 'list_instances')
+    def test_one_node_refreshes(self, list_inst, ipq):
+        list_inst.return_value = {'inst1': 'INST1'}
+        ipq.return_value = {'INST1': {'userid': 'INST1',
+                                      'guest_cpus': '2',
+                                      'used_cpu_time': '1710205201 uS',
+                                      'used_memory': '4189268 KB'}}
+
+        self.node1._check_expiration_and_update_cache('cpumem')
+        self.node2._check_expiration_and_update_cache('cpumem')
+        self.assertEqual(1, list_inst.call_count)
+        self.assertEqual(1, ipq.call_count)
+        self.assertEqual(self.node1.cache.get('cpumem', 'inst1'),
+                         self.node2.cache.get('cpumem', 'inst1'))
+        self.assertEqual({'inst1': 'INST1'}, self.node2.instances)
+
+    @mock.patch.object(zvmutils, 'image_performance_query')
+    @mock.patch.object(zvmutils, 'list_instances')
+    def test_refresh_when_holder_publishes_nothing(self, list_inst, ipq):
+        list_inst.return_value = {'inst1': 'INST1'}
+        ipq.return_value = {}
+        self.node1.shared.acquire('cpumem', 600)
+
+        self.node2._check_expiration_and_update_cache('cpumem')
+        self.assertEqual(1, ipq.call_count)
+
+    @mock.patch.object(zvmutils, 'indicate_user_io')
+    @mock.patch.object(zvmutils, 'list_instances')
+    def test_disks_loaded_with_the_cycle(self, list_inst, user_io):
+        list_inst.return_value = {'inst1': 'INST1'}
+        user_io.return_value = {'INST1': 100}
+        self.node1._check_expiration_and_update_cache('disks')
+        with mock.patch.object(self.node2.shared, 'wait',
+                               wraps=self.node2.shared.wait) as wait:
+            self.node2._check_expiration_and_update_cache('disks')
+            self.node2._check_expiration_and_update_cache('disks')
+            # the cycle that loaded the disks also serves the other meters
+            self.node2._check_expiration_and_update_cache('cpumem')
+        self.assertEqual(1, wait.call_count)
+        self.assertEqual(1, user_io.call_count)
+        self.assertEqual(100, self.node2.cache.get('disks',
+                                                   'inst1')['io_count'])
+
+    def test_memory_backend(self):
+        self.assertIsNone(sharedcache.get_shared_cache())
+
+    def test_memcache_backend(self):
+        self.CONF.set_override('cache_backend', 'memcache', 'zvm')
+        self.CONF.set_override('zvm_host', 'zvmhost1', 'zvm')
+        with mock.patch.object(sharedcache, 'memcache', None):
+            self.assertIsNone(sharedcache.get_shared_cache())
+        fake_memcache = mock.Mock(Client=FakeMemcacheClient)
+        with mock.patch.object(sharedcache, 'memcache', fake_memcache):
+            shared = sharedcache.get_shared_cache()
+        self.assertEqual('ceilometer-zvm:zvmhost1', shared.prefix)
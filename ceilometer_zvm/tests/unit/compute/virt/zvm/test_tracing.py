@@ -0,0 +1,122 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import json
+import os
+import shutil
+import tempfile
+
+import eventlet
+from oslo_config import fixture as fixture_config
+from oslotest import base
+
+from ceilometer_zvm.compute.virt.zvm import inspector as zvm_inspector
+from ceilometer_zvm.compute.virt.zvm import tracing
+from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
+from ceilometer_zvm.tests import fakexcat
+
+
+class TestTracing(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestTracing, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.CONF = self.useFixture(
+                            fixture_config.Config(zvm_inspector.CONF)).conf
+        self.trace_file = os.path.join(self.tmpdir, 'trace.json')
+        self.CONF.set_override('trace_file', self.trace_file, 'zvm')
+        self.addCleanup(self._close)
+
+    def _close(self):
+        logger = tracing._trace_logger
+        if logger is not None:
+            for handler in logger.handlers[:]:
+                handler.close()
+                logger.removeHandler(handler)
+        tracing._trace_logger = None
+
+    def _events(self, path=None):
+        with open(path or self.trace_file) as trace:
+            content = trace.read()
+        # what chrome://tracing makes of a file still being written
+        return json.loads(content.rstrip().rstrip(',') + ']')
+
+    def test_disabled(self):
+        self.CONF.set_override('trace_file', None, 'zvm')
+        with tracing.span('refresh.cpumem') as span:
+            span.set(guests=3)
+        self.assertIsNone(tracing._trace_logger)
+        self.assertFalse(os.path.exists(self.trace_file))
+
+    def test_nested_spans(self):
+        with tracing.span('refresh.cpumem', cat='refresh'):
+            with tracing.span('cache.cpumem', cat='cache', guests=2) as span:
+                span.set(chars=10)
+
+        def _fail():
+            with tracing.span('xcat_request', cat='xcat'):
+                raise zvmutils.ZVMException('down')
+        self.assertRaises(zvmutils.ZVMException, _fail)
+
+        def _read():
+            with tracing.span('xcat.read'):
+                pass
+        eventlet.spawn(_read).wait()
+
+        inner, outer, failed, read = self._events()
+        self.assertEqual(('cache.cpumem', 'X', {'guests': 2, 'chars': 10}),
+                         (inner['name'], inner['ph'], inner['args']))
+        self.assertEqual('refresh.cpumem', outer['name'])
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertGreaterEqual(outer['ts'] + outer['dur'],
+                                inner['ts'] + inner['dur'])
+        self.assertEqual(outer['tid'], inner['tid'])
+        self.assertEqual({'error': 'ZVMException'}, failed['args'])
+        # another green thread is another row of the timeline
+        self.assertNotEqual(outer['tid'], read['tid'])
+
+    def test_rotation(self):
+        self.CONF.set_override('trace_max_bytes', 300, 'zvm')
+        for i in range(10):
+            with tracing.span('xcat_request', url='/xcatws/tables/zvm'):
+                pass
+        rotated = self.trace_file + '.1'
+        self.assertTrue(os.path.exists(rotated))
+        self.assertTrue(self._events(rotated))
+        self.assertTrue(self._events())
+
+    def test_collection_path(self):
+        server = fakexcat.FakeXCATServer(
+                    host=fakexcat.FakeZVMHost(guests=2)).start()
+        self.addCleanup(server.stop)
+        self.CONF.set_override('zvm_xcat_server', '127.0.0.1', 'zvm')
+        self.CONF.set_override('zvm_xcat_port', server.port, 'zvm')
+        self.CONF.set_override('zvm_xcat_username', 'user', 'zvm')
+        self.CONF.set_override('zvm_xcat_password', 'pwd', 'zvm')
+        self.CONF.set_override('zvm_host', 'zvmhost1', 'zvm')
+
+        zvmutils.list_instances({'hostname': 'zhcp.example.com',
+                                 'nodename': 'zhcp'})
+        zvmutils.image_performance_query('zhcp', ['NODE00000'])
+
+        events = dict((e['name'], e) for e in self._events())
+        self.assertEqual(2, events['list_instances']['args']['guests'])
+        self.assertEqual('/xcatws/nodes/zhcp/dsh',
+                         events['xcat_request']['args']['url'])
+        self.assertGreater(events['xcat.read']['args']['chars'], 0)
+        for name in ('xcat.queue', 'xcat.send', 'xcat.wait', 'xcat.load',
+                     'parse_image_performance_query'):
+            self.assertIn(name, events)
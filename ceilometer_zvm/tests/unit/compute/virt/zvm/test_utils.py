@@ -13,6 +13,14 @@
 #    under the License.
 
 
+import io
+import os
+import subprocess
+import sys
+import time
+
+import eventlet
+import fixtures
 import mock
 
 from oslo_config import fixture as fixture_config
@@ -23,6 +31,49 @@ from ceilometer_zvm.compute.virt.zvm import inspector as zvm_inspector
 from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
 
 
+# Parses in the worker pool of a monkey patched process, writing to the file
+# argv[1] how many times a ticker green thread ran meanwhile.
+MONKEY_PATCHED_PARSE = """
+import eventlet
+eventlet.monkey_patch()
+
+import functools
+import signal
+import sys
+
+from ceilometer_zvm.compute.virt.zvm import inspector
+from ceilometer_zvm.compute.virt.zvm import utils
+
+signal.alarm(60)
+inspector.CONF([], project='ceilometer')
+inspector.CONF.set_override('parse_workers', 2, 'zvm')
+inspector.CONF.set_override('parse_offload_threshold', 1, 'zvm')
+ticks = []
+
+
+def ticker():
+    while True:
+        ticks.append(1)
+        eventlet.sleep(0.001)
+
+
+record = ('zhcp: Guest name: INST%d\\nzhcp: Used CPU time: "1 uS"\\n'
+          'zhcp: Used memory: "2 KB"\\nzhcp: Guest CPUs: "2"\\n')
+data = ''.join(record % i for i in range(20000))
+parser = functools.partial(utils._parse_image_performance_query,
+                           extra_fields=())
+eventlet.spawn(ticker)
+eventlet.sleep(0)
+before = len(ticks)
+results = list(eventlet.GreenPool().imap(utils.parse_xdsh_output,
+                                         [parser] * 2, [data] * 2))
+utils.stop_parse_pool()
+assert [20000, 20000] == [len(r) for r in results]
+with open(sys.argv[1], 'w') as out:
+    out.write(str(len(ticks) - before))
+"""
+
+
 class TestXCATUrl(base.BaseTestCase):
 
     def setUp(self):
@@ -70,7 +121,7 @@ class TestXCATConnection(base.BaseTestCase):
             fake_res = mock.Mock()
             fake_res.status = 200
             fake_res.reason = 'OK'
-            fake_res.read.return_value = 'data'
+            fake_res.readinto = io.BytesIO(b'data').readinto
             fake_conn.getresponse.return_value = fake_res
 
             exp_data = {'status': 200,
@@ -84,12 +135,94 @@ class TestXCATConnection(base.BaseTestCase):
             fake_res = mock.Mock()
             fake_res.status = 500
             fake_res.reason = 'INVALID'
-            fake_res.read.return_value = 'err data'
+            fake_res.readinto = io.BytesIO(b'err data').readinto
             fake_conn.getresponse.return_value = fake_res
 
             self.assertRaises(zvmutils.ZVMException,
                               self.conn.request, 'GET', 'url')
 
+    def test_request_large_body(self):
+        body = b'x' * (zvmutils.READ_CHUNK_SIZE * 3 + 5)
+        with mock.patch.object(self.conn, 'conn') as fake_conn:
+            fake_res = mock.Mock(spec=['status', 'reason', 'read'])
+            fake_res.status = 200
+            fake_res.reason = 'OK'
+            fake_res.read = io.BytesIO(body).read
+            fake_conn.getresponse.return_value = fake_res
+
+            res_data = self.conn.request("GET", 'url')
+            self.assertEqual(body.decode('utf-8'), res_data['message'])
+
+    def test_request_large_body_buffer_released(self):
+        self.useFixture(fixtures.MockPatchObject(
+                    zvmutils, '_read_buffers', zvmutils.corolocal.local()))
+        with mock.patch.object(self.conn, 'conn') as fake_conn:
+            fake_conn.getresponse.return_value = self._fake_response(b'data')
+            self.conn.request("GET", 'url')
+            kept = zvmutils._read_buffers.buf
+            self.assertEqual(zvmutils.READ_CHUNK_SIZE, len(kept))
+
+            body = b'x' * (zvmutils.READ_BUFFER_KEEP + 1)
+            fake_conn.getresponse.return_value = self._fake_response(body)
+            res_data = self.conn.request("GET", 'url')
+        self.assertEqual(len(body), len(res_data['message']))
+        self.assertIsNone(zvmutils._read_buffers.buf)
+
+    def _fake_response(self, body):
+        fake_res = mock.Mock()
+        fake_res.status = 200
+        fake_res.reason = 'OK'
+        fake_res.readinto = io.BytesIO(body).readinto
+        return fake_res
+
+    @mock.patch.object(zvmutils.LogPayload, '__str__')
+    def test_request_debug_disabled(self, payload_str):
+        with mock.patch.object(self.conn, 'conn') as fake_conn:
+            fake_conn.getresponse.return_value = self._fake_response(b'data')
+            with mock.patch.object(zvmutils.LOG, 'isEnabledFor',
+                                   return_value=False):
+                self.conn.request("PUT", 'url&password=pwd', ['body'])
+            payload_str.assert_not_called()
+
+    def test_request_capture_file(self):
+        capture_file = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                    'xcat.log')
+        self.CONF.set_override('xcat_capture_file', capture_file, 'zvm')
+        self.addCleanup(setattr, zvmutils, '_capture_logger', None)
+        with mock.patch.object(self.conn, 'conn') as fake_conn:
+            fake_conn.getresponse.return_value = self._fake_response(
+                                                            b'x' * 4096)
+            self.conn.request("GET",
+                              '/xcatws/nodes?userName=user&password=pwd')
+        capture = zvmutils._capture_logger
+        for handler in capture.handlers:
+            handler.close()
+            capture.removeHandler(handler)
+
+        with open(capture_file) as f:
+            content = f.read()
+        self.assertIn('GET /xcatws/nodes?userName=user ', content)
+        self.assertIn('x' * 4096, content)
+
+
+class TestLogPayload(base.BaseTestCase):
+
+    def setUp(self):
+        self.CONF = self.useFixture(
+                            fixture_config.Config(zvm_inspector.CONF)).conf
+        super(TestLogPayload, self).setUp()
+
+    def test_truncate(self):
+        self.CONF.set_override('xcat_log_payload_limit', 4, 'zvm')
+        self.assertEqual('abcd...(2 more characters)',
+                         str(zvmutils.LogPayload('abcdef')))
+        self.assertEqual("[1, ...(2 more characters)",
+                         str(zvmutils.LogPayload([1, 2])))
+
+    def test_no_limit(self):
+        self.CONF.set_override('xcat_log_payload_limit', 0, 'zvm')
+        self.assertEqual('abcdef', str(zvmutils.LogPayload('abcdef')))
+
 
 class TestZVMUtils(base.BaseTestCase):
 
@@ -109,17 +242,200 @@ class TestZVMUtils(base.BaseTestCase):
         self.assertEqual([['data']],
                          zvmutils.xcat_request("GET", 'url')['data'])
 
+    @mock.patch('ceilometer_zvm.compute.virt.zvm.utils.XCATConnection.request')
+    def test_xcat_request_rate_limited(self, xcat_req):
+        xcat_req.return_value = {'message': jsonutils.dumps({'data': []})}
+        limiter = mock.Mock()
+        limiter.acquire.return_value = 0.25
+        self.useFixture(fixtures.MockPatchObject(
+                            zvmutils, '_rate_limiters', {'xdsh': limiter}))
+        zvmutils.METRICS.clear()
+        self.addCleanup(zvmutils.METRICS.clear)
+
+        with zvmutils.request_priority(zvmutils.PRIORITY_BULK):
+            zvmutils.xcat_request("PUT", 'url', [], call_type='xdsh')
+        limiter.acquire.assert_called_once_with(zvmutils.PRIORITY_BULK)
+        limiter.release.assert_called_once_with()
+        self.assertEqual(1, zvmutils.METRICS.get('xcat_queued.xdsh'))
+        self.assertEqual(250,
+                         zvmutils.METRICS.get('xcat_queue_delay_ms.xdsh'))
+
+    @mock.patch('ceilometer_zvm.compute.virt.zvm.utils.XCATConnection.request')
+    def test_xcat_request_deadline_passed(self, xcat_req):
+        with zvmutils.request_deadline(time.time() - 1):
+            self.assertRaises(zvmutils.ZVMDeadlineExceeded,
+                              zvmutils.xcat_request, "GET", 'url')
+        xcat_req.assert_not_called()
+
+    @mock.patch('ceilometer_zvm.compute.virt.zvm.utils.XCATConnection.request')
+    def test_xcat_request_timeout_after_deadline(self, xcat_req):
+        deadline = time.time() + 60
+
+        def _timeout(*args):
+            zvmutils._request_context.deadline = time.time() - 1
+            raise zvmutils.ZVMException('timed out')
+        xcat_req.side_effect = _timeout
+        with zvmutils.request_deadline(deadline):
+            self.assertRaises(zvmutils.ZVMDeadlineExceeded,
+                              zvmutils.xcat_request, "GET", 'url')
+
+    def test_connection_timeout_capped_by_deadline(self):
+        with zvmutils.request_deadline(time.time() + 5):
+            conn = zvmutils.XCATConnection()
+        self.assertLessEqual(conn.conn.timeout, 5)
+        self.assertEqual(600, zvmutils.XCATConnection().conn.timeout)
+
+    def test_request_deadline_nesting(self):
+        self.assertIsNone(zvmutils.remaining_time())
+        with zvmutils.request_deadline(1000):
+            with zvmutils.request_deadline(2000):
+                self.assertEqual(1000, zvmutils.current_request_deadline())
+            with zvmutils.request_deadline(None):
+                self.assertEqual(1000, zvmutils.current_request_deadline())
+        self.assertIsNone(zvmutils.current_request_deadline())
+
+    @mock.patch('ceilometer_zvm.compute.virt.zvm.utils.XCATConnection.request')
+    def test_xcat_request_releases_on_error(self, xcat_req):
+        xcat_req.side_effect = zvmutils.ZVMException('down')
+        limiter = zvmutils.RateLimiter(concurrency=1)
+        self.useFixture(fixtures.MockPatchObject(
+                            zvmutils, '_rate_limiters', {'read': limiter}))
+        self.assertRaises(zvmutils.ZVMException, zvmutils.xcat_request,
+                          "GET", 'url')
+        self.assertEqual(0, limiter.active)
+
+    def _use_endpoints(self, servers):
+        self.CONF.set_override('zvm_xcat_servers', servers, 'zvm')
+        self.useFixture(fixtures.MockPatchObject(zvmutils, '_endpoints',
+                                                 (None, None)))
+        zvmutils.METRICS.clear()
+        self.addCleanup(zvmutils.METRICS.clear)
+        return dict((e.host, e) for e in zvmutils.get_endpoints())
+
+    def test_get_endpoints(self):
+        endpoints = self._use_endpoints(['2.2.2.2:8443', '[fe80::1]:444',
+                                         'fe80::2', '1.1.1.1'])
+        self.assertEqual([('1.1.1.1', 443), ('2.2.2.2', 8443),
+                          ('fe80::1', 444), ('fe80::2', 443)],
+                         [(e.host, e.port)
+                          for e in zvmutils.get_endpoints()])
+
+        endpoints['1.1.1.1'].record_latency(0.5)
+        endpoints['2.2.2.2'].record_latency(0.1)
+        endpoints['fe80::1'].record_latency(0.2)
+        endpoints['fe80::2'].record_error()
+        # fastest first, the endpoint in backoff after a failure last
+        self.assertEqual(['2.2.2.2', 'fe80::1', '1.1.1.1', 'fe80::2'],
+                         [e.host for e in zvmutils.get_endpoints()])
+
+    def _fake_endpoint_request(self, answers):
+        def _request(conn, method, url, body=None, headers={}):
+            answer = answers[conn.host]
+            if isinstance(answer, Exception):
+                raise answer
+            eventlet.sleep(answer)
+            return {'message': jsonutils.dumps(
+                                {'data': [{'data': [conn.host]}]})}
+        return mock.patch.object(zvmutils.XCATConnection, 'request',
+                                 autospec=True, side_effect=_request)
+
+    def test_xcat_request_hedged(self):
+        endpoints = self._use_endpoints(['2.2.2.2'])
+        for i in range(5):
+            endpoints['1.1.1.1'].record_latency(0.01)
+        endpoints['2.2.2.2'].record_latency(0.02)
+
+        with self._fake_endpoint_request({'1.1.1.1': 5, '2.2.2.2': 0}):
+            resp = zvmutils.xcat_request("GET", 'url')
+        self.assertEqual([['2.2.2.2']], resp['data'])
+        self.assertEqual(1, zvmutils.METRICS.get('xcat_hedged'))
+        self.assertEqual(1, zvmutils.METRICS.get('xcat_hedge_wins'))
+        # the cancelled request counts as a slow sample of its endpoint
+        self.assertGreater(endpoints['1.1.1.1'].latency, 0.01)
+
+    def test_xcat_request_hedge_within_concurrency(self):
+        endpoints = self._use_endpoints(['2.2.2.2'])
+        for i in range(5):
+            endpoints['1.1.1.1'].record_latency(0.01)
+        endpoints['2.2.2.2'].record_latency(0.5)
+        limiter = zvmutils.RateLimiter(concurrency=1)
+        self.useFixture(fixtures.MockPatchObject(
+                            zvmutils, '_rate_limiters', {'read': limiter}))
+
+        # no free slot, the slow request is not hedged
+        with self._fake_endpoint_request({'1.1.1.1': 0.1, '2.2.2.2': 0}):
+            resp = zvmutils.xcat_request("GET", 'url')
+        self.assertEqual([['1.1.1.1']], resp['data'])
+        self.assertEqual(1, zvmutils.METRICS.get('xcat_hedge_skipped'))
+        self.assertEqual(0, zvmutils.METRICS.get('xcat_hedged'))
+
+        limiter.concurrency = 2
+        with self._fake_endpoint_request({'1.1.1.1': 5, '2.2.2.2': 0}):
+            resp = zvmutils.xcat_request("GET", 'url')
+        self.assertEqual([['2.2.2.2']], resp['data'])
+        self.assertEqual(1, zvmutils.METRICS.get('xcat_hedged'))
+        self.assertEqual(0, limiter.active)
+
+    def test_xcat_request_failover(self):
+        endpoints = self._use_endpoints(['2.2.2.2'])
+        with self._fake_endpoint_request({
+                '1.1.1.1': zvmutils.ZVMException('down'), '2.2.2.2': 0}):
+            resp = zvmutils.xcat_request("GET", 'url')
+        self.assertEqual([['2.2.2.2']], resp['data'])
+        self.assertEqual(1, zvmutils.METRICS.get('xcat_failover'))
+        self.assertEqual(1, endpoints['1.1.1.1'].failures)
+        # the failed endpoint is left aside for the next requests
+        self.assertEqual('2.2.2.2', zvmutils.get_endpoints()[0].host)
+
+    def test_xcat_request_xdsh_not_hedged(self):
+        self._use_endpoints(['2.2.2.2'])
+        with self._fake_endpoint_request({
+                '1.1.1.1': zvmutils.ZVMException('down'), '2.2.2.2': 0}):
+            self.assertRaises(zvmutils.ZVMException, zvmutils.xcat_request,
+                              "PUT", 'url', [], call_type='xdsh')
+        self.assertEqual(0, zvmutils.METRICS.get('xcat_failover'))
+
+    @mock.patch.object(zvmutils.LOG, 'warning')
+    def test_load_xcat_resp_log_warnings(self, log_warn):
+        message = jsonutils.dumps({'data': [
+            {'info': ['all good']},
+            {'data': ['zhcp: line 1\nzhcp: Warning: disk full\nzhcp: x']}]})
+        resp = zvmutils.load_xcat_resp(message)
+        self.assertEqual([['all good']], resp['info'])
+        log_warn.assert_called_once_with(
+            'Warning from xCAT: zhcp: Warning: disk full')
+
+    def test_iter_lines(self):
+        data = ['a\nb', 'c\n', None, '\nd']
+        self.assertEqual(['a', 'b', 'c', '', 'd'],
+                         list(zvmutils.iter_lines(data)))
+        self.assertEqual(['a', 'b'], list(zvmutils.iter_lines('a\nb\n')))
+
     @mock.patch('ceilometer_zvm.compute.virt.zvm.utils.xcat_request')
     def test_get_userid(self, xcat_req):
         xcat_req.return_value = {'info': [['userid=fakeuser']]}
         self.assertEqual('fakeuser', zvmutils.get_userid('fakenode'))
 
+    @mock.patch.object(zvmutils, 'xcat_request')
+    def test_get_userids(self, xcat_req):
+        xcat_req.return_value = {'data': [[
+            '#node,hcp,userid',
+            '"zvmhost1","zhcp.com",""',
+            '"node1","zhcp.com","node1"',
+            '"node2","zhcp2.com","node2"',
+        ]]}
+        self.assertEqual({'node1': 'NODE1', 'node2': 'NODE2'},
+                         zvmutils.get_userids())
+        self.assertEqual({'node2': 'NODE2'},
+                         zvmutils.get_userids(['node2', 'node3']))
+        self.assertEqual(2, xcat_req.call_count)
+
     @mock.patch('ceilometer_zvm.compute.virt.zvm.utils.xcat_request')
     def test_xdsh(self, xcat_req):
         zvmutils.xdsh('node', 'cmds')
         xcat_req.assert_any_call('PUT',
             '/xcatws/nodes/node/dsh?userName=user&password=pwd&format=json',
-            ['command=cmds', 'options=-q'])
+            ['command=cmds', 'options=-q'], call_type='xdsh')
 
     @mock.patch('ceilometer_zvm.compute.virt.zvm.utils.xcat_request')
     def test_get_node_hostname(self, xcat_req):
@@ -161,6 +477,40 @@ class TestZVMUtils(base.BaseTestCase):
         self.assertRaises(zvmutils.ZVMException, zvmutils.list_instances,
                           hcp_info)
 
+    def test_pop_job_status(self):
+        chunks = ['zhcp: ZVMJOB-RC=0\nzhcp: line 1\n', 'zhcp: line 2\n']
+        self.assertEqual(0, zvmutils._pop_job_status(chunks))
+        self.assertEqual(['zhcp: line 1\n', 'zhcp: line 2\n'], chunks)
+        chunks = ['zhcp: ZVMJOB-RC=4\n', 'zhcp: out\n']
+        self.assertEqual(4, zvmutils._pop_job_status(chunks))
+        self.assertEqual(['zhcp: out\n'], chunks)
+        self.assertIsNone(zvmutils._pop_job_status(['zhcp: ZVMJOB-PENDING']))
+        self.assertRaises(ValueError, zvmutils._pop_job_status,
+                          ['zhcp: garbage'])
+
+    @mock.patch.object(zvmutils.eventlet, 'sleep')
+    @mock.patch.object(zvmutils, 'xcat_request')
+    def test_xdsh_async_failed_job(self, xcat_req, sleep):
+        self.CONF.set_override('xdsh_async', True, 'zvm')
+        xcat_req.side_effect = [
+            {'data': [['']]},
+            {'data': [['zhcp: ZVMJOB-RC=8\nzhcp: smcli failed\n']]}]
+        self.assertRaises(zvmutils.ZVMException, zvmutils.xdsh, 'zhcp',
+                          'smcli x', long_running=True)
+        self.assertEqual(2, xcat_req.call_count)
+
+    @mock.patch.object(zvmutils.eventlet, 'sleep')
+    @mock.patch.object(zvmutils, 'xcat_request')
+    def test_xdsh_async_timeout_kills_job(self, xcat_req, sleep):
+        self.CONF.set_override('xdsh_async', True, 'zvm')
+        self.CONF.set_override('xdsh_job_timeout', -1, 'zvm')
+        xcat_req.return_value = {'data': [['zhcp: ZVMJOB-PENDING\n']]}
+        self.assertRaises(zvmutils.ZVMException, zvmutils.xdsh, 'zhcp',
+                          'smcli x', long_running=True)
+        kill_cmd = xcat_req.call_args_list[-1][0][2][0]
+        self.assertIn('kill', kill_cmd)
+        self.assertIn('rm -f', kill_cmd)
+
     @mock.patch.object(zvmutils, 'xdsh')
     def test_image_performance_query(self, dsh):
         res_data = ["zhcp: Number of virtual server IDs: 2 \n"
@@ -189,6 +539,140 @@ class TestZVMUtils(base.BaseTestCase):
         self.assertEqual(exp_data,
                          zvmutils.image_performance_query('zhcp', inst_list))
 
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_image_performance_query_extra_fields(self, dsh):
+        self.CONF.set_override('ipq_extra_fields',
+                               ['max_memory', 'samples_idle', 'bogus'], 'zvm')
+        res_data = ["zhcp: Guest name: INST1\n"
+                    "zhcp: Used CPU time: \"1710205201 uS\"\n"
+                    "zhcp: Max memory: \"8388608 KB\"\n"
+                    "zhcp: Shared memory: \"0 KB\"\n"
+                    "zhcp: Used memory: \"4189268 KB\"\n"
+                    "zhcp: Guest CPUs: \"2\"\n"
+                    "zhcp: Guest name: INST2\n"
+                    "zhcp: Used CPU time: \"1710205201 uS\"\n"
+                    "zhcp: Used memory: \"4189268 KB\"\n"
+                    "zhcp: Guest CPUs: \"4\"\n"]
+        dsh.return_value = {'data': [res_data]}
+        pi = zvmutils.image_performance_query('zhcp', ['INST1', 'INST2'])
+        self.assertEqual({'userid': 'INST1',
+                          'guest_cpus': '2',
+                          'used_cpu_time': '1710205201 uS',
+                          'max_memory': '8388608 KB',
+                          'used_memory': '4189268 KB'}, pi['INST1'])
+        # extra fields are optional
+        self.assertEqual('4', pi['INST2']['guest_cpus'])
+
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_indicate_user_io(self, dsh):
+        dsh.return_value = {'data': [[
+            "zhcp: Userid: INST1\n"
+            "zhcp: USERID=INST1 MACH=ESA STOR=2G VIRT=V XSTORE=NONE\n"
+            "zhcp: CPU 00: CTIME=01:23 VTIME=00:45 TTIME=01:10 IO=000120\n"
+            "zhcp:         RDR=000000 PRT=000000 PCH=000000\n"
+            "zhcp: CPU 01: CTIME=01:23 VTIME=00:45 TTIME=01:10 IO=000030\n",
+            "zhcp: Userid: INST2\n"
+            "zhcp: HCPCQU045E INST2 not logged on\n"]]}
+        self.assertEqual({'INST1': 150},
+                         zvmutils.indicate_user_io('zhcp', ['INST1', 'INST2']))
+        cmd = dsh.call_args[0][1]
+        self.assertIn('for u in INST1 INST2;', cmd)
+        self.assertIn('vmcp indicate user $u exp', cmd)
+
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_image_performance_query_invalid_record(self, dsh):
+        res_data = ["zhcp: Number of virtual server IDs: 3 \n"
+                    "zhcp: Guest name: INST1\n"
+                    "zhcp: Used CPU time: \"1710205201 uS\"\n"
+                    "zhcp: Guest name: INST2\n"
+                    "zhcp: Used CPU time: \"1710205201 uS\"\n"
+                    "zhcp: Used memory: \"4189268 KB\"\n"
+                    "zhcp: Guest CPUs: \"4\"\n"
+                    "zhcp: \n"
+                    "zhcp: Guest name: INST3\n"
+                    "zhcp: Used CPU time: \"1710205201 uS\"\n"
+                    "zhcp: Used memory: \"4189268 KB\"\n"
+                    "zhcp: Guest CPUs: \"2\"\n"]
+        dsh.return_value = {'data': [res_data]}
+        zvmutils.METRICS.clear()
+
+        pi = zvmutils.image_performance_query('zhcp',
+                                              ['INST1', 'INST2', 'INST3'])
+        self.assertEqual(['INST2', 'INST3'], sorted(pi.keys()))
+        self.assertEqual('4', pi['INST2']['guest_cpus'])
+        self.assertEqual(1, zvmutils.METRICS.get('invalid_records.cpumem'))
+
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_virutal_network_vswitch_query_iuo_stats_invalid_nic(self, dsh):
+        vsw_data = ['zhcp11: vswitch count: 1\n'
+                    'zhcp11: \n'
+                    'zhcp11: vswitch number: 1\n'
+                    'zhcp11: vswitch name: XCATVSW1\n'
+                    'zhcp11: uplink count: 1\n'
+                    'zhcp11: uplink_conn: 6240\n'
+                    'zhcp11: uplink_rx:        498914052\n'
+                    'zhcp11: nic count: 2\n'
+                    'zhcp11: nic_id: INST1 0600\n'
+                    'zhcp11: nic_fr_rx:        573952\n'
+                    'zhcp11: nic_id: INST2 0600\n'
+                    'zhcp11: nic_fr_rx:        17493\n'
+                    'zhcp11: nic_fr_rx_dsc:    0\n'
+                    'zhcp11: nic_fr_rx_err:    0\n'
+                    'zhcp11: nic_fr_tx:        16886\n'
+                    'zhcp11: nic_fr_tx_dsc:    0\n'
+                    'zhcp11: nic_fr_tx_err:    4\n'
+                    'zhcp11: nic_rx:           3111714\n'
+                    'zhcp11: nic_tx:           3172646\n'
+                    'zhcp11: vlan count: 0']
+        dsh.return_value = {'data': [vsw_data]}
+        zvmutils.METRICS.clear()
+
+        vsw_dict = zvmutils.virutal_network_vswitch_query_iuo_stats('zhcp11')
+        nics = vsw_dict['vswitches'][0]['nics']
+        self.assertEqual(1, len(nics))
+        self.assertEqual('INST2', nics[0]['userid'])
+        self.assertEqual('3172646', nics[0]['nic_tx'])
+        self.assertEqual(1, zvmutils.METRICS.get('invalid_records.vnics'))
+
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_image_performance_query_parse_workers(self, dsh):
+        self.CONF.set_override('parse_workers', 1, 'zvm')
+        self.CONF.set_override('parse_offload_threshold', 10, 'zvm')
+        self.addCleanup(zvmutils.stop_parse_pool)
+        dsh.return_value = {'data': [[
+            "zhcp: Guest name: INST1\n"
+            "zhcp: Used CPU time: \"1710205201 uS\"\n"
+            "zhcp: Used memory: \"4189268 KB\"\n"
+            "zhcp: Guest CPUs: \"2\"\n"
+            "zhcp: Guest name: INST2\n"]]}
+        zvmutils.METRICS.clear()
+
+        pi = zvmutils.image_performance_query('zhcp', ['INST1', 'INST2'])
+        self.assertEqual(['INST1'], list(pi.keys()))
+        self.assertEqual('2', pi['INST1']['guest_cpus'])
+        self.assertIsNotNone(zvmutils._parse_pool)
+        self.assertEqual(1, zvmutils.METRICS.get('invalid_records.cpumem'))
+
+    def test_parse_workers_monkey_patched(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            p for p in (os.getcwd(), env.get('PYTHONPATH')) if p)
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'ticks')
+        subprocess.check_call([sys.executable, '-c', MONKEY_PATCHED_PARSE,
+                               path], env=env)
+        # the agent green threads keep running while the workers parse
+        with open(path) as ticks:
+            self.assertGreater(int(ticks.read()), 0)
+
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_image_performance_query_below_threshold(self, dsh):
+        self.CONF.set_override('parse_workers', 1, 'zvm')
+        dsh.return_value = {'data': [["zhcp: Guest name: INST1\n"]]}
+        with mock.patch.object(zvmutils, '_get_parse_pool') as get_pool:
+            zvmutils.image_performance_query('zhcp', ['INST1'])
+            self.assertFalse(get_pool.return_value.apply.called)
+
     @mock.patch.object(zvmutils, 'xdsh')
     def test_virutal_network_vswitch_query_iuo_stats(self, dsh):
         vsw_data = ['zhcp11: vswitch count: 2\n'
@@ -288,6 +772,55 @@ class TestZVMUtils(base.BaseTestCase):
                           zvmutils.virutal_network_vswitch_query_iuo_stats,
                           'zhcp')
 
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_deploy_zhcp_helper(self, dsh):
+        self.CONF.set_override('zhcp_helper_dir', '/opt/helper', 'zvm')
+        path = zvmutils.deploy_zhcp_helper('zhcp')
+        self.assertTrue(path.startswith('/opt/helper/ceilometer_zvm_helper_'))
+        cmd = dsh.call_args[0][1]
+        self.assertTrue(cmd.startswith('test -f %s || ' % path))
+        self.assertIn('base64 -d > %s.tmp' % path, cmd)
+
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_zhcp_helper_query(self, dsh):
+        dsh.return_value = {'data': [[
+            'zhcp: cpumem,INST1,2,1710205201,4189268,max_memory=8388608\n'
+            'zhcp: vnics,INST1,VSW1,0600,1,2,3,4,5,6,7,8\n'
+            'zhcp: vnics,INST1,VSW2,0700,1,2\n'
+            'zhcp: cpumem,INST2,x,1,1']]}
+        stats = zvmutils.zhcp_helper_query('zhcp', '/opt/h.py', 'cpumem',
+                                           ['INST1', 'INST2'], ['VSW1'])
+        dsh.assert_called_once_with('zhcp',
+            'python /opt/h.py --meter cpumem --target zhcp '
+            '--vswitch VSW1 --extra max_memory INST1 INST2',
+            long_running=True)
+        self.assertEqual({'INST1': (2, 1710205201, 4189268,
+                                    {'max_memory': 8388608})},
+                         stats['cpumem'])
+        self.assertEqual(1, len(stats['vnics']['INST1']))
+        self.assertEqual(8, stats['vnics']['INST1'][0]['nic_tx'])
+        self.assertEqual('VSW1', stats['vnics']['INST1'][0]['vswitch_name'])
+
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_zhcp_helper_query_invalid_extra_field(self, dsh):
+        dsh.return_value = {'data': [[
+            'zhcp: cpumem,INST1,2,1710205201,4189268,max_memory=x,'
+            'processor_share=100']]}
+        zvmutils.METRICS.clear()
+        stats = zvmutils.zhcp_helper_query('zhcp', '/opt/h.py', 'cpumem',
+                                           ['INST1'])
+        self.assertEqual({'INST1': (2, 1710205201, 4189268,
+                                    {'processor_share': 100})},
+                         stats['cpumem'])
+        self.assertEqual(1, zvmutils.METRICS.get('invalid_fields.max_memory'))
+        self.assertEqual(0, zvmutils.METRICS.get('invalid_records.cpumem'))
+
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_zhcp_helper_query_error(self, dsh):
+        dsh.return_value = {'data': [['zhcp: error,vnics,smcli failed']]}
+        self.assertRaises(zvmutils.ZVMException, zvmutils.zhcp_helper_query,
+                          'zhcp', '/opt/h.py', 'vnics', ['INST1'])
+
 
 class TestCacheData(base.BaseTestCase):
 
@@ -318,5 +851,144 @@ class TestCacheData(base.BaseTestCase):
         self.cache_data.set('cpumem', {'nodename': 'node1'})
         self.cache_data.set('vnics', {'nodename': 'node2'})
         self.cache_data.clear()
-        self.assertEqual({'cpumem': {}, 'vnics': {}},
+        self.assertEqual({'cpumem': {}, 'vnics': {}, 'disks': {}},
                          self.cache_data.cache)
+
+    def test_lru_eviction(self):
+        zvmutils.METRICS.clear()
+        self.addCleanup(zvmutils.METRICS.clear)
+        cache_data = zvmutils.CacheData(max_entries=2)
+        cache_data.set('cpumem', {'nodename': 'node1'})
+        cache_data.set('cpumem', {'nodename': 'node2'})
+        cache_data.get('cpumem', 'node1')
+        cache_data.set('cpumem', {'nodename': 'node3'})
+        self.assertIsNone(cache_data.get('cpumem', 'node2'))
+        self.assertIsNotNone(cache_data.get('cpumem', 'node1'))
+        self.assertEqual(1, zvmutils.METRICS.get('cache.evicted.cpumem'))
+        self.assertEqual(2, zvmutils.METRICS.get('cache.entries.cpumem'))
+
+    @mock.patch('oslo_utils.timeutils.utcnow_ts')
+    def test_ttl(self, now):
+        zvmutils.METRICS.clear()
+        self.addCleanup(zvmutils.METRICS.clear)
+        cache_data = zvmutils.CacheData(ttl=60)
+        now.return_value = 1000
+        cache_data.set('cpumem', {'nodename': 'node1'})
+        now.return_value = 1030
+        cache_data.set('cpumem', {'nodename': 'node2'})
+        now.return_value = 1060
+        self.assertEqual(['node2'],
+                         list(cache_data.snapshot('cpumem').keys()))
+        self.assertIsNone(cache_data.get('cpumem', 'node1'))
+        self.assertIsNotNone(cache_data.get('cpumem', 'node2'))
+        self.assertEqual(1, zvmutils.METRICS.get('cache.expired.cpumem'))
+        self.assertEqual(1, zvmutils.METRICS.get('cache.entries.cpumem'))
+
+    @mock.patch('oslo_utils.timeutils.utcnow_ts')
+    def test_max_cycles(self, now):
+        now.return_value = 1000
+        cache_data = zvmutils.CacheData(max_cycles=2)
+        cache_data.set('cpumem', {'nodename': 'node1'})
+        cache_data.start_cycle('cpumem')
+        cache_data.set('cpumem', {'nodename': 'node2'})
+        # however long the cycles take
+        now.return_value = 100000
+        self.assertIsNotNone(cache_data.get('cpumem', 'node1'))
+        cache_data.start_cycle('cpumem')
+        cache_data.start_cycle('disks')
+        self.assertIsNone(cache_data.get('cpumem', 'node1'))
+        self.assertIsNotNone(cache_data.get('cpumem', 'node2'))
+
+    def test_retain(self):
+        zvmutils.METRICS.clear()
+        self.addCleanup(zvmutils.METRICS.clear)
+        self.cache_data.set('cpumem', {'nodename': 'node1', 'userid': 'U1'})
+        self.cache_data.set('cpumem', {'nodename': 'node2', 'userid': 'U2'})
+        self.cache_data.set('disks', {'nodename': 'node3', 'userid': 'U3'})
+        self.cache_data.retain({'node1': 'u1', 'node2': 'U9'})
+        self.assertEqual(['node1'],
+                         list(self.cache_data.snapshot('cpumem').keys()))
+        self.assertEqual({}, self.cache_data.snapshot('disks'))
+        self.assertEqual(1, zvmutils.METRICS.get('cache.departed.cpumem'))
+        self.assertEqual(1, zvmutils.METRICS.get('cache.departed.disks'))
+
+
+class TestUseridCache(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestUseridCache, self).setUp()
+        self.userids = zvmutils.UseridCache(60)
+
+    def test_update_and_get(self):
+        self.userids.update({'node1': 'NODE1'}, ['node1', 'node2'])
+        self.assertEqual('NODE1', self.userids.get('node1'))
+        self.assertIn('node2', self.userids)
+        self.assertIsNone(self.userids.get('node2'))
+        self.assertNotIn('node3', self.userids)
+
+    @mock.patch('oslo_utils.timeutils.utcnow_ts')
+    def test_expired(self, now):
+        now.return_value = 1000
+        self.userids.update({'node1': 'NODE1'})
+        now.return_value = 1060
+        self.assertNotIn('node1', self.userids)
+        self.assertIsNone(self.userids.get('node1'))
+
+    def test_clear(self):
+        self.userids.update({'node1': 'NODE1'})
+        self.userids.clear()
+        self.assertNotIn('node1', self.userids)
+
+
+class TestRateLimiter(base.BaseTestCase):
+
+    def test_unlimited(self):
+        limiter = zvmutils.RateLimiter()
+        for i in range(100):
+            self.assertEqual(0, limiter.acquire())
+        self.assertEqual(100, limiter.active)
+
+    @mock.patch.object(zvmutils.eventlet, 'sleep')
+    @mock.patch.object(zvmutils.time, 'time')
+    def test_token_bucket(self, now, sleep):
+        now.return_value = 1000.0
+        limiter = zvmutils.RateLimiter(rate=2, burst=2)
+        self.assertEqual(0, limiter.acquire())
+        self.assertEqual(0, limiter.acquire())
+
+        def _sleep(seconds):
+            now.return_value += seconds
+        sleep.side_effect = _sleep
+        self.assertAlmostEqual(0.5, limiter.acquire())
+        sleep.assert_called_once_with(0.5)
+
+    def test_concurrency_and_priority(self):
+        limiter = zvmutils.RateLimiter(concurrency=1)
+        limiter.acquire()
+        order = []
+
+        def _call(priority):
+            limiter.acquire(priority)
+            order.append(priority)
+            limiter.release()
+
+        adhoc = eventlet.spawn(_call, zvmutils.PRIORITY_ADHOC)
+        eventlet.sleep(0.05)
+        bulk = eventlet.spawn(_call, zvmutils.PRIORITY_BULK)
+        eventlet.sleep(0.05)
+        self.assertEqual([], order)
+        limiter.release()
+        adhoc.wait()
+        bulk.wait()
+        self.assertEqual([zvmutils.PRIORITY_BULK, zvmutils.PRIORITY_ADHOC],
+                         order)
+        self.assertEqual(0, limiter.active)
+
+    def test_request_priority(self):
+        self.assertEqual(zvmutils.PRIORITY_ADHOC,
+                         zvmutils.current_request_priority())
+        with zvmutils.request_priority(zvmutils.PRIORITY_BULK):
+            self.assertEqual(zvmutils.PRIORITY_BULK,
+                             zvmutils.current_request_priority())
+        self.assertEqual(zvmutils.PRIORITY_ADHOC,
+                         zvmutils.current_request_priority())
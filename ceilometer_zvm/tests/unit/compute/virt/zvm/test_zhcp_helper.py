@@ -0,0 +1,98 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import mock
+from oslotest import base
+from six import moves
+
+from ceilometer_zvm.compute.virt.zvm import utils as zvmutils
+from ceilometer_zvm.compute.virt.zvm import zhcp_helper
+
+
+IPQ_OUTPUT = [
+    'Number of virtual server IDs: 2',
+    'Guest name: INST1',
+    'Used CPU time: "1710205201 uS"',
+    'Used memory: "4189268 KB"',
+    'Max memory: "8388608 KB"',
+    'Guest CPUs: "2"',
+    '',
+    'Guest name: INST2',
+    'Used CPU time: "1710205201 uS"',
+    'Guest CPUs: "4"',
+]
+
+VSW_OUTPUT = [
+    'vswitch count: 1',
+    'vswitch name: XCATVSW1',
+    'uplink count: 0',
+    'nic count: 2',
+    'nic_id: INST1 0600',
+    'nic_fr_rx:        573952',
+    'nic_fr_rx_dsc:    0',
+    'nic_fr_rx_err:    0',
+    'nic_fr_tx:        548780',
+    'nic_fr_tx_dsc:    0',
+    'nic_fr_tx_err:    4',
+    'nic_rx:           103024058',
+    'nic_tx:           102030890',
+    'nic_id: OTHER 0600',
+    'nic_fr_rx:        1',
+    'vlan count: 0',
+]
+
+
+class TestZHCPHelper(base.BaseTestCase):
+
+    @mock.patch.object(zhcp_helper, 'smcli')
+    def test_ipq(self, smcli):
+        smcli.return_value = IPQ_OUTPUT
+        out = []
+        zhcp_helper.ipq(['INST1', 'INST2'], out.append)
+        smcli.assert_called_once_with(['Image_Performance_Query', '-T',
+                                       'INST1 INST2', '-c', '2'])
+        self.assertEqual(['cpumem,INST1,2,1710205201,4189268'], out)
+
+        out = []
+        zhcp_helper.ipq(['INST1'], out.append, ['max_memory'])
+        self.assertEqual(['cpumem,INST1,2,1710205201,4189268,'
+                          'max_memory=8388608'], out)
+
+    @mock.patch.object(zhcp_helper, 'smcli')
+    def test_ipq_invalid_extra_field(self, smcli):
+        smcli.return_value = [line.replace('8388608 KB', 'unlimited')
+                              for line in IPQ_OUTPUT]
+        out = []
+        zhcp_helper.ipq(['INST1'], out.append, ['max_memory'])
+        self.assertEqual(['cpumem,INST1,2,1710205201,4189268'], out)
+
+    def test_extra_fields_match_inspector(self):
+        self.assertEqual(zvmutils.IPQ_EXTRA_KWS,
+                         dict(zhcp_helper.IPQ_EXTRA_KWS))
+
+    @mock.patch.object(zhcp_helper, 'smcli')
+    def test_vswitch(self, smcli):
+        smcli.return_value = VSW_OUTPUT
+        out = []
+        zhcp_helper.vswitch('zhcp', '*', ['INST1'], out.append)
+        self.assertEqual(['vnics,INST1,XCATVSW1,0600,573952,0,0,548780,0,'
+                          '4,103024058,102030890'], out)
+
+    @mock.patch('sys.stdout', new_callable=moves.StringIO)
+    @mock.patch.object(zhcp_helper, 'smcli')
+    def test_main_reports_errors(self, smcli, stdout):
+        smcli.side_effect = RuntimeError('Failed, rc=8')
+        zhcp_helper.main(['--meter', 'cpumem', 'inst1'])
+        self.assertEqual('error,cpumem,Failed  rc=8\n', stdout.getvalue())
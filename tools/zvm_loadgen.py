@@ -0,0 +1,138 @@
+# Copyright 2015 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Drive many concurrent ZVMInspector pollsters against an xCAT server.
+
+Each worker owns its own ZVMInspector and polls CPU, memory and NIC stats of
+every guest in a loop, the way one ceilometer compute agent would. Without
+--server a local fake xCAT server is started in process::
+
+    python tools/zvm_loadgen.py --workers 8 --guests 500 --duration 60
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from oslo_config import cfg
+
+from ceilometer_zvm.compute.virt.zvm import inspector as zvm_inspector
+from ceilometer_zvm.tests import fakexcat
+
+
+CONF = cfg.CONF
+
+
+class FakeInstance(object):
+
+    def __init__(self, name):
+        setattr(self, 'OS-EXT-SRV-ATTR:instance_name', name)
+        setattr(self, 'OS-EXT-STS:power_state', 0x01)
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def _worker(instances, deadline, result):
+    inspector = zvm_inspector.ZVMInspector()
+    while time.time() < deadline:
+        for inst in instances:
+            for inspect in (inspector.inspect_cpus,
+                            inspector.inspect_memory_usage,
+                            lambda i: list(inspector.inspect_vnics(i))):
+                start = time.time()
+                try:
+                    inspect(inst)
+                except Exception:
+                    result['errors'] += 1
+                else:
+                    result['latencies'].append(time.time() - start)
+                if time.time() >= deadline:
+                    return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', default=None,
+                        help='host:port of the xCAT server, a local fake '
+                             'server is started when omitted')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--guests', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--max-connections', type=int, default=None)
+    parser.add_argument('--cache-update-interval', type=int, default=600)
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.server is None:
+        host = fakexcat.FakeZVMHost(guests=args.guests)
+        server = fakexcat.FakeXCATServer(
+                        host=host, latency=args.latency,
+                        error_rate=args.error_rate,
+                        max_connections=args.max_connections).start()
+        address, port = '127.0.0.1', server.port
+        nodes = sorted(host.nodes)
+    else:
+        address, _sep, port = args.server.rpartition(':')
+        nodes = ['node%05d' % i for i in range(args.guests)]
+
+    CONF([], project='ceilometer')
+    CONF.set_override('zvm_xcat_server', address, 'zvm')
+    CONF.set_override('zvm_xcat_port', int(port), 'zvm')
+    CONF.set_override('zvm_xcat_username', 'admin', 'zvm')
+    CONF.set_override('zvm_xcat_password', 'passw0rd', 'zvm')
+    CONF.set_override('zvm_host', 'zvmhost1', 'zvm')
+    CONF.set_override('cache_update_interval', args.cache_update_interval,
+                      'zvm')
+
+    instances = [FakeInstance(n) for n in nodes]
+    deadline = time.time() + args.duration
+    results = []
+    threads = []
+    for i in range(args.workers):
+        result = {'latencies': [], 'errors': 0}
+        results.append(result)
+        t = threading.Thread(target=_worker,
+                             args=(instances, deadline, result))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    latencies = [lat for r in results for lat in r['latencies']]
+    report = {
+        'workers': args.workers,
+        'guests': len(instances),
+        'calls': len(latencies),
+        'errors': sum(r['errors'] for r in results),
+        'calls_per_second': len(latencies) / args.duration,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p95_ms': _percentile(latencies, 95) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+    }
+    if server is not None:
+        server.stop()
+        report['server'] = server.stats
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()